@@ -1,5 +1,9 @@
-from femenums import FemState
+from typing import List
+
+from femenums import SubmissionPhase
+from progress import TaskProgress
 from controller import ControllerEventDelegate
+from submission import QarnotSubmission
 
 from PySide import QtCore
 
@@ -8,35 +12,54 @@ import FreeCAD as App
 
 class DocumentObserver(QtCore.QObject):
     # A simple document observer class use to tell the window to
-    # actualize when it's solver selector panel.
-    document_changed = QtCore.Signal()
+    # actualize its solver select panel, one node at a time.
+    # document_updated is emitted with documents that were opened, saved
+    # or got a solver, which may make some old tasks retrievable, and
+    # document_closed with documents that are about to be closed.
+    # Removed objects are given by document and object names since they
+    # are deleted by the time the signal is handled
+    document_created = QtCore.Signal(object)
+    document_updated = QtCore.Signal(object)
+    document_closed = QtCore.Signal(object)
+    object_added = QtCore.Signal(object)
+    object_removed = QtCore.Signal(str, str)
+    object_relabelled = QtCore.Signal(object)
+    analysis_changed = QtCore.Signal(object)
 
     def __init__(self):
         super().__init__()
 
-    def slotActivateDocument(self, doc):
-        self.document_changed.emit()
-
     def slotCreatedDocument(self, doc):
-        self.document_changed.emit()
+        self.document_created.emit(doc)
+        self.document_updated.emit(doc)
 
     def slotDeletedDocument(self, doc):
-        self.document_changed.emit()
+        self.document_closed.emit(doc)
+
+    def slotFinishSaveDocument(self, doc, filename):
+        self.document_updated.emit(doc)
 
     def slotChangedObject(self, obj, prop):
-        if (obj.TypeId == 'Fem::FemSolverObjectPython' or
-                obj.TypeId == 'Fem::FemAnalysis') and prop == 'Label':
-            self.document_changed.emit()
+        if not self.isObserved(obj):
+            return
+        if prop == 'Label':
+            self.object_relabelled.emit(obj)
+        elif prop == 'Group' and obj.TypeId == 'Fem::FemAnalysis':
+            self.analysis_changed.emit(obj)
 
     def slotCreatedObject(self, obj):
-        if (obj.TypeId == 'Fem::FemSolverObjectPython' or
-                obj.TypeId == 'Fem::FemAnalysis'):
-            self.document_changed.emit()
+        if self.isObserved(obj):
+            self.object_added.emit(obj)
+            self.document_updated.emit(obj.Document)
 
     def slotDeletedObject(self, obj):
-        if (obj.TypeId == 'Fem::FemSolverObjectPython' or
-                obj.TypeId == 'Fem::FemAnalysis'):
-            self.document_changed.emit()
+        if self.isObserved(obj):
+            self.object_removed.emit(obj.Document.Name, obj.Name)
+
+    @staticmethod
+    def isObserved(obj) -> bool:
+        return (obj.TypeId == 'Fem::FemSolverObjectPython' or
+                obj.TypeId == 'Fem::FemAnalysis')
 
 
 class GuiControllerEventDelegate(ControllerEventDelegate):
@@ -45,13 +68,16 @@ class GuiControllerEventDelegate(ControllerEventDelegate):
     task_finished = QtCore.Signal(str)
     task_submitted = QtCore.Signal(str)
     task_failed = QtCore.Signal(str)
+    submission_progressed = QtCore.Signal(str, object, object)
+    upload_progressed = QtCore.Signal(str, object, object)
 
     def __init__(self) -> None:
         super().__init__()
         # Timer is used to periodically call the callback function that
-        # actualizes tasks' states. Timer_interval defines the time between
-        # each callback calls. If, it is set to a non positive value, no
-        # callback will be called.
+        # actualizes tasks' states. Timer_interval defines the minimum time
+        # between each callback calls, the actual time follows the
+        # controller's poll scheduler. If, it is set to a non positive
+        # value, no callback will be called.
         # The state_changed signal is made so that when in occurs multiple
         # in a row, only when signal is emitted, thanks to a timer that is
         # reset
@@ -72,6 +98,27 @@ class GuiControllerEventDelegate(ControllerEventDelegate):
         App.Console.PrintMessage(
             f'task {self.controller.tasks[uuid].name} submitted\n')
 
+    def on_submission_progress(self, submission: QarnotSubmission,
+                               phase: SubmissionPhase) -> None:
+        # Queued submissions are written and handed over by
+        # actualize_tasks, so the callback must run until they are done.
+        # Writing starts right away
+        self.start_callback()
+        if phase == SubmissionPhase.QUEUED:
+            QtCore.QTimer.singleShot(0, self.actualize_tasks)
+        self.submission_progressed.emit(submission.name, phase,
+                                        submission.fem_task.estimate)
+        if phase == SubmissionPhase.FAILED:
+            App.Console.PrintError(
+                f'task {submission.name} could not be submitted\n')
+
+    def on_upload_progress(self, submission: QarnotSubmission,
+                           uploaded: int, upload_size: int) -> None:
+        self.upload_progressed.emit(submission.name, uploaded, upload_size)
+
+    def on_task_downloading(self, uuid: str) -> None:
+        self.send_state_change()
+
     def on_task_finished(self, uuid: str) -> None:
         self.task_finished.emit(uuid)
         self.send_state_change()
@@ -85,14 +132,26 @@ class GuiControllerEventDelegate(ControllerEventDelegate):
         self.start_callback()
         self.send_state_change()
 
+    def on_old_tasks_found(self, uuids: List[str]):
+        # Previous tasks come in pages, retrieve those whose document
+        # is open
+        self.controller.retrieve_all(uuids)
+        self.send_state_change()
+
     def on_task_deleted(self, uuid: str):
         self.send_state_change()
 
     def on_task_failed(self, uuid: str):
         self.send_state_change()
 
+    def on_task_progress(self, uuid: str, progress: TaskProgress):
+        self.send_state_change()
+
     def on_connection_established(self):
         App.Console.PrintMessage('Connection established with Qarnot !\n')
+        # Previous tasks are discovered in the background and handed
+        # over by actualize_tasks
+        self.start_callback()
 
     def on_connection_failed(self, err: Exception):
         App.Console.PrintError('Unable to connect to Qarnot. ' +
@@ -100,23 +159,19 @@ class GuiControllerEventDelegate(ControllerEventDelegate):
 
     @QtCore.Slot()
     def actualize_tasks(self) -> None:
-        # Call tasks wait callbacks and check if states have changed
-        for t in self.controller.list_task():
-            if t.state != FemState.COMPUTING:
-                continue
-            t.wait_callback()
-            if t.state == FemState.FINISHED:
-                self.on_task_finished(t.uuid)
-            elif t.state == FemState.ERROR:
-                self.on_task_failed(t.uuid)
-            elif t.state != FemState.COMPUTING:
-                self.send_state_change()
-        if not self.controller.is_computing():
+        # Actualize tasks' states, the controller sends the events
+        self.controller.actualize_tasks()
+        next_check = self.controller.time_to_next_check()
+        if next_check is None:
             self.stop_callback()
+        elif self.timer.isActive():
+            self.timer.setInterval(
+                max(self.timer_interval, int(1000 * next_check)))
 
     def start_callback(self) -> None:
-        # Starts the callback that will periodically actualize tasks' state
-        if self.timer_interval > 0 and not self.timer.isActive():
+        # Starts the callback that will periodically actualize tasks' state,
+        # or bring the next call forward if it is already started
+        if self.timer_interval > 0:
             self.timer.start(self.timer_interval)
 
     def stop_callback(self) -> None:
@@ -0,0 +1,171 @@
+from typing import Dict, Set, Tuple
+
+from PySide import QtGui, QtCore
+
+import FreeCAD as App
+
+from Gui.utils import insert_analysis_item, insert_document_item, \
+    insert_solver_item, list_documents, list_analysis, list_solver
+
+
+class SolverTree(QtCore.QObject):
+    # Keeps the solver selector (documents > analyses > solvers) up to
+    # date from document observer events. Events only mark the
+    # documents, analyses or objects they concern, and are applied
+    # together once no event came for delay ms, so that a burst of
+    # events (e.g opening a document) updates the tree once. Only the
+    # marked nodes are updated, the rest of the tree and the selection
+    # are kept. Items are found by their path of object names:
+    # (document,), (document, analysis) or (document, analysis, solver)
+    updated = QtCore.Signal()
+
+    def __init__(self, tree_widget: QtGui.QTreeWidget,
+                 delay: int = 200) -> None:
+        super().__init__(tree_widget)
+        self.tree_widget = tree_widget
+        self._items: Dict[Tuple[str, ...], QtGui.QTreeWidgetItem] = {}
+        # Pending updates. Documents to build again, closed documents,
+        # analyses to synchronize, removed and relabelled objects
+        self._documents: Set[str] = set()
+        self._closed: Set[str] = set()
+        self._analyses: Set[Tuple[str, str]] = set()
+        self._removed: Set[Tuple[str, str]] = set()
+        self._relabelled: Set[Tuple[str, str]] = set()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.flush)
+
+    def rebuild(self) -> None:
+        # Build the whole tree again
+        self.tree_widget.clear()
+        self._items.clear()
+        for doc in list_documents():
+            self._build_document(doc)
+
+    #
+    # Observer events
+    #
+    @QtCore.Slot(object)
+    def documentCreated(self, doc: App.Document) -> None:
+        self._documents.add(doc.Name)
+        self._closed.discard(doc.Name)
+        self.timer.start()
+
+    @QtCore.Slot(object)
+    def documentClosed(self, doc: App.Document) -> None:
+        self._closed.add(doc.Name)
+        self._documents.discard(doc.Name)
+        self.timer.start()
+
+    @QtCore.Slot(object)
+    def objectAdded(self, obj: App.DocumentObject) -> None:
+        # A solver or an analysis was created. Solvers are put in their
+        # analysis after their creation, which changes the analysis'
+        # group, so only analyses are synchronized
+        if obj.TypeId == 'Fem::FemAnalysis':
+            self._analyses.add((obj.Document.Name, obj.Name))
+            self.timer.start()
+
+    @QtCore.Slot(object)
+    def analysisChanged(self, obj: App.DocumentObject) -> None:
+        # The group of an analysis changed
+        self._analyses.add((obj.Document.Name, obj.Name))
+        self.timer.start()
+
+    @QtCore.Slot(str, str)
+    def objectRemoved(self, doc_name: str, name: str) -> None:
+        self._removed.add((doc_name, name))
+        self._analyses.discard((doc_name, name))
+        self.timer.start()
+
+    @QtCore.Slot(object)
+    def objectRelabelled(self, obj: App.DocumentObject) -> None:
+        self._relabelled.add((obj.Document.Name, obj.Name))
+        self.timer.start()
+
+    @QtCore.Slot()
+    def flush(self) -> None:
+        # Apply pending updates
+        self.timer.stop()
+        documents = App.listDocuments()
+        for name in self._closed:
+            self._remove((name,))
+        for name in self._documents:
+            if name in documents:
+                self._remove((name,))
+                self._build_document(documents[name])
+        for doc_name, name in self._removed:
+            for path in self._paths_ending_with(doc_name, name):
+                self._remove(path)
+        for doc_name, name in self._analyses:
+            if doc_name in documents and doc_name not in self._documents:
+                ana = documents[doc_name].getObject(name)
+                if ana is not None:
+                    self._sync_analysis(ana)
+        for doc_name, name in self._relabelled:
+            if doc_name not in documents:
+                continue
+            obj = documents[doc_name].getObject(name)
+            if obj is None:
+                continue
+            for path in self._paths_ending_with(doc_name, name):
+                self._items[path].setText(0, obj.Label)
+        self._documents.clear()
+        self._closed.clear()
+        self._analyses.clear()
+        self._removed.clear()
+        self._relabelled.clear()
+        self.updated.emit()
+
+    #
+    # Tree updates
+    #
+    def _build_document(self, doc: App.Document) -> None:
+        self._items[(doc.Name,)] = insert_document_item(self.tree_widget,
+                                                        doc)
+        for ana in list_analysis(doc):
+            self._sync_analysis(ana)
+
+    def _sync_analysis(self, ana: App.DocumentObject) -> None:
+        # Create the analysis item if needed and make its children match
+        # the analysis' solvers
+        doc = ana.Document
+        doc_path = (doc.Name,)
+        if doc_path not in self._items:
+            self._items[doc_path] = insert_document_item(self.tree_widget,
+                                                         doc)
+        ana_path = (doc.Name, ana.Name)
+        if ana_path not in self._items:
+            self._items[ana_path] = insert_analysis_item(
+                self._items[doc_path], ana)
+        solvers = {solver.Name: solver for solver in list_solver(ana)}
+        for path in [path for path in self._items
+                     if len(path) == 3 and path[:2] == ana_path]:
+            if path[2] not in solvers:
+                self._remove(path)
+        for name, solver in solvers.items():
+            path = ana_path + (name,)
+            if path not in self._items:
+                self._items[path] = insert_solver_item(
+                    self._items[ana_path], solver)
+
+    def _remove(self, path: Tuple[str, ...]) -> None:
+        # Remove an item and its children
+        item = self._items.pop(path, None)
+        if item is None:
+            return
+        for child in [p for p in self._items
+                      if len(p) > len(path) and p[:len(path)] == path]:
+            del self._items[child]
+        parent = item.parent()
+        if parent is None:
+            self.tree_widget.takeTopLevelItem(
+                self.tree_widget.indexOfTopLevelItem(item))
+        else:
+            parent.removeChild(item)
+
+    def _paths_ending_with(self, doc_name: str, name: str):
+        return [path for path in self._items
+                if len(path) > 1 and path[0] == doc_name and
+                path[-1] == name]
@@ -0,0 +1,163 @@
+from typing import Any, Dict, List, Tuple
+
+from PySide import QtGui, QtCore
+
+from controller import QarnotController
+from femenums import FemState
+from Gui.utils import format_progress, format_progress_details, \
+    get_femstate_icon
+
+# Role of the values the proxy model sorts on (dates, states order)
+SORT_ROLE = QtCore.Qt.UserRole + 1
+
+HEADERS = ['Name', 'Start date', 'status', 'progress', 'document']
+
+
+class TaskTableModel(QtCore.QAbstractTableModel):
+    # Model of the task panel, one row per task and old task. sync diffs
+    # the controller's tasks against the rows so only added, removed or
+    # changed rows are sent to the view, which keeps its selection and
+    # does not rebuild anything else. The task uuid is in Qt.UserRole
+
+    def __init__(self, parent: QtCore.QObject = None) -> None:
+        super().__init__(parent)
+        # Uuid and displayed values of each row
+        self._uuids: List[str] = []
+        self._rows: Dict[str, Tuple] = {}
+
+    def sync(self, controller: QarnotController) -> None:
+        # Update the rows from the controller's tasks and old tasks
+        rows = {}
+        for task in controller.list_task():
+            progress = None
+            if task.state == FemState.COMPUTING:
+                progress = task.progress
+            rows[task.uuid] = (task.name, task.creation_date, task.state,
+                               progress, task.document_name, False)
+        for task in controller.old_tasks.values():
+            if task.uuid not in rows:
+                rows[task.uuid] = (task.name, task.creation_date, None,
+                                   None, task.document_path, True)
+        # Removed rows, from the last one so row numbers stay valid
+        for i in reversed(range(len(self._uuids))):
+            uuid = self._uuids[i]
+            if uuid not in rows:
+                self.beginRemoveRows(QtCore.QModelIndex(), i, i)
+                del self._uuids[i]
+                del self._rows[uuid]
+                self.endRemoveRows()
+        # Changed rows
+        last_column = len(HEADERS) - 1
+        for i, uuid in enumerate(self._uuids):
+            if rows[uuid] != self._rows[uuid]:
+                self._rows[uuid] = rows[uuid]
+                self.dataChanged.emit(self.index(i, 0),
+                                      self.index(i, last_column))
+        # Added rows, appended at once
+        added = [uuid for uuid in rows if uuid not in self._rows]
+        if len(added):
+            first = len(self._uuids)
+            self.beginInsertRows(QtCore.QModelIndex(),
+                                 first, first + len(added) - 1)
+            for uuid in added:
+                self._uuids.append(uuid)
+                self._rows[uuid] = rows[uuid]
+            self.endInsertRows()
+
+    def rowCount(self, parent: QtCore.QModelIndex
+                 = QtCore.QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self._uuids)
+
+    def columnCount(self, parent: QtCore.QModelIndex
+                    = QtCore.QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(HEADERS)
+
+    def headerData(self, section: int, orientation: QtCore.Qt.Orientation,
+                   role: int = QtCore.Qt.DisplayRole) -> Any:
+        if (orientation == QtCore.Qt.Horizontal and
+                role == QtCore.Qt.DisplayRole):
+            return HEADERS[section]
+        return None
+
+    def data(self, index: QtCore.QModelIndex,
+             role: int = QtCore.Qt.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+        uuid = self._uuids[index.row()]
+        name, date, state, progress, document, old = self._rows[uuid]
+        column = index.column()
+        if role == QtCore.Qt.UserRole:
+            return uuid
+        if role == QtCore.Qt.DisplayRole:
+            if column == 0:
+                return name
+            if column == 1:
+                return date.strftime('%H:%M:%S')
+            if column == 3 and progress is not None:
+                return format_progress(progress)
+            if column == 4:
+                return document
+        elif role == QtCore.Qt.DecorationRole:
+            if column == 2 and state is not None:
+                return get_femstate_icon(state)
+        elif role == QtCore.Qt.ToolTipRole:
+            if column == 1:
+                return date.strftime('%Y-%m-%d %H:%M:%S')
+            if column == 2 and state is not None:
+                return state.name.lower()
+            if column == 3 and progress is not None:
+                return format_progress_details(progress)
+        elif role == QtCore.Qt.ForegroundRole:
+            if old:
+                return QtGui.QBrush(QtCore.Qt.gray)
+            if column == 3 and progress is not None and progress.diverging:
+                return QtGui.QBrush(QtCore.Qt.red)
+        elif role == SORT_ROLE:
+            if column == 0:
+                return name
+            if column == 1:
+                return date.timestamp()
+            if column == 2:
+                return -1 if state is None else state.value
+            if column == 3:
+                if progress is None or progress.fraction is None:
+                    return -1.
+                return progress.fraction
+            if column == 4:
+                return document
+        return None
+
+    def flags(self, index: QtCore.QModelIndex) -> QtCore.Qt.ItemFlags:
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+        return QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled
+
+
+class TaskFilterProxyModel(QtCore.QSortFilterProxyModel):
+    # Sorts the task panel on SORT_ROLE values and filters it on the
+    # task name or document, case insensitive
+
+    def __init__(self, parent: QtCore.QObject = None) -> None:
+        super().__init__(parent)
+        self.text: str = ''
+        self.setSortRole(SORT_ROLE)
+        self.setDynamicSortFilter(True)
+
+    @QtCore.Slot(str)
+    def setFilterText(self, text: str) -> None:
+        self.text = text.lower()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row: int,
+                         source_parent: QtCore.QModelIndex) -> bool:
+        if not self.text:
+            return True
+        model = self.sourceModel()
+        return any(
+            self.text in str(model.data(
+                model.index(source_row, column, source_parent))).lower()
+            for column in (0, 4))
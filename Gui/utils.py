@@ -1,6 +1,8 @@
 import functools
-from typing import List
-from femenums import FemState
+from typing import Dict, List, Optional
+from estimator import RunEstimate
+from femenums import FemState, SubmissionPhase
+from progress import TaskProgress
 
 from PySide import QtGui, QtCore
 
@@ -82,22 +84,30 @@ def list_solver(ana: App.DocumentObjectGroup):
             if sol.TypeId == 'Fem::FemSolverObjectPython']
 
 
+# Icons of each state, created on first use
+_femstate_icons: Dict[FemState, QtGui.QIcon] = {}
+
+
 def get_femstate_icon(state: FemState) -> QtGui.QIcon:
+    if state not in _femstate_icons:
+        _femstate_icons[state] = _create_femstate_icon(state)
+    return _femstate_icons[state]
+
+
+def _create_femstate_icon(state: FemState) -> QtGui.QIcon:
+    style = QtGui.QApplication.style()
     if state is FemState.SETTING_UP:
-        return QtGui.QWidget().style().standardIcon(
-            QtGui.QStyle.SP_FileIcon)
+        return style.standardIcon(QtGui.QStyle.SP_FileIcon)
     elif state is FemState.WRITING:
-        return QtGui.QWidget().style().standardIcon(
-            QtGui.QStyle.SP_FileIcon)
+        return style.standardIcon(QtGui.QStyle.SP_FileIcon)
     elif state is FemState.COMPUTING:
-        return QtGui.QWidget().style().standardIcon(
-            QtGui.QStyle.SP_ComputerIcon)
+        return style.standardIcon(QtGui.QStyle.SP_ComputerIcon)
+    elif state is FemState.DOWNLOADING:
+        return style.standardIcon(QtGui.QStyle.SP_ArrowDown)
     elif state is FemState.FINISHED:
-        return QtGui.QWidget().style().standardIcon(
-            QtGui.QStyle.SP_DialogApplyButton)
+        return style.standardIcon(QtGui.QStyle.SP_DialogApplyButton)
     elif state is FemState.ERROR:
-        return QtGui.QWidget().style().standardIcon(
-            QtGui.QStyle.SP_MessageBoxCritical)
+        return style.standardIcon(QtGui.QStyle.SP_MessageBoxCritical)
     elif state is FemState.LOADED:
         return QtGui.QIcon.fromTheme('emblem-downloads')
     else:
@@ -110,3 +120,74 @@ def format_task_output(output: str) -> str:
     # instead of the newline character
     output = output.replace('\\n', '\n')
     return output
+
+
+def format_submission_phase(name: str, phase: SubmissionPhase,
+                            estimate: Optional[RunEstimate] = None) -> str:
+    # Return a short text describing the submission phase of a task and
+    # its estimated run time and memory, once written
+    texts = {
+        SubmissionPhase.QUEUED: 'queued',
+        SubmissionPhase.WRITING: 'writing files...',
+        SubmissionPhase.CREATING_TASK: 'creating task...',
+        SubmissionPhase.UPLOADING: 'uploading files...',
+        SubmissionPhase.SUBMITTING: 'submitting...',
+        SubmissionPhase.SUBMITTED: 'submitted',
+        SubmissionPhase.FAILED: 'submission failed',
+        SubmissionPhase.CANCELLED: 'cancelled',
+    }
+    text = f'{name}: {texts[phase]}'
+    if estimate is not None and phase != SubmissionPhase.FAILED:
+        text += f' ({format_estimate(estimate)})'
+    return text
+
+
+def format_estimate(estimate: RunEstimate) -> str:
+    # Return the estimated run time and peak memory of a task
+    return f'about {format_duration(estimate.run_time)}, ' + \
+        f'{format_size(estimate.peak_memory_mb * 1e6)}'
+
+
+def format_size(size: int) -> str:
+    # Format a size in bytes in a human readable way
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1000:
+            return f'{size:.3g} {unit}'
+        size = size / 1000
+    return f'{size:.3g} TB'
+
+
+def format_duration(seconds: float) -> str:
+    # Format a duration in a short human readable way
+    if seconds < 60:
+        return f'{seconds:.0f} s'
+    if seconds < 3600:
+        return f'{seconds / 60:.0f} min'
+    return f'{seconds // 3600:.0f} h {seconds % 3600 / 60:02.0f}'
+
+
+def format_progress(progress: TaskProgress) -> str:
+    # Return a short text with the percentage done and the time left
+    texts = []
+    if progress.fraction is not None:
+        texts.append(f'{progress.fraction:.0%}')
+    eta = progress.eta_left()
+    if eta is not None:
+        texts.append(f'{format_duration(eta)} left')
+    if not len(texts):
+        texts.append(progress.phase)
+    if progress.diverging:
+        texts.append('diverging')
+    return ', '.join(texts)
+
+
+def format_progress_details(progress: TaskProgress) -> str:
+    # Return the phase, iteration and residual of a task's progress
+    texts = [progress.phase] if progress.phase else []
+    if progress.iteration is not None:
+        texts.append(f'iteration {progress.iteration}')
+    if progress.residual is not None:
+        texts.append(f'residual {progress.residual:.3g}')
+    if progress.diverging:
+        texts.append('the run seems to diverge')
+    return '\n'.join(texts)
@@ -6,25 +6,32 @@ from PySide import QtGui, QtCore
 
 class LogDisplayer(QtGui.QWidget):
     # A widget that consists in a window which displays stdout and stderr
-    # in two read-only text edit. It is used to display tasks logs
-    def __init__(self, stdout, stderr) -> None:
+    # in two read-only text edit. It is used to display tasks logs, which
+    # are appended as they are fetched. Only the last max_lines lines of
+    # each output are kept. While Follow is checked, the views stay
+    # scrolled to the end of the outputs. closed is emitted when the
+    # window is closed, so the log stream can be stopped. outputReceived
+    # and streamFinished can be emitted from the log stream's worker
+    # thread, their slots are then queued to the GUI thread
+    closed = QtCore.Signal()
+    outputReceived = QtCore.Signal(str, str)
+    streamFinished = QtCore.Signal(object)
+
+    def __init__(self, max_lines: int = 10000) -> None:
         super().__init__()
-        self.initGui(stdout, stderr)
+        self.max_lines = max_lines
+        self.initGui()
+        self.outputReceived.connect(self.appendOutput,
+                                    QtCore.Qt.QueuedConnection)
+        self.streamFinished.connect(self.streamDone,
+                                    QtCore.Qt.QueuedConnection)
 
-    def initGui(self, stdout, stderr):
+    def initGui(self) -> None:
         self.setWindowTitle("Log report")
 
-        self.textEditStdout = QtGui.QTextEdit()
-        self.textEditStdout.setReadOnly(True)
-        self.textEditStdout.setText(stdout)
-        if not len(stdout):
-            self.textEditStdout.setText("Task has no stdout")
-
-        self.textEditStderr = QtGui.QTextEdit()
-        self.textEditStderr.setReadOnly(True)
-        self.textEditStderr.setText(stderr)
-        if not len(stderr):
-            self.textEditStderr.setText("Task has no stderr")
+        self.textEditStdout = self.createTextEdit("Fetching stdout...")
+        self.textEditStderr = self.createTextEdit("Fetching stderr...")
+        self._empty = {'stdout': True, 'stderr': True}
 
         self.groupBoxStdout = QtGui.QGroupBox("Standard output :")
         self.groupBoxStdoutLayout = QtGui.QHBoxLayout()
@@ -36,13 +43,63 @@ class LogDisplayer(QtGui.QWidget):
         self.groupBoxStderrLayout.addWidget(self.textEditStderr)
         self.groupBoxStderr.setLayout(self.groupBoxStderrLayout)
 
-        self.layout = QtGui.QHBoxLayout()
-        self.layout.addWidget(self.groupBoxStdout)
-        self.layout.addWidget(self.groupBoxStderr)
+        self.checkBoxFollow = QtGui.QCheckBox("Follow")
+        self.checkBoxFollow.setChecked(True)
+        self.labelStatus = QtGui.QLabel()
+
+        self.hboxOutputs = QtGui.QHBoxLayout()
+        self.hboxOutputs.addWidget(self.groupBoxStdout)
+        self.hboxOutputs.addWidget(self.groupBoxStderr)
+        self.hboxStatus = QtGui.QHBoxLayout()
+        self.hboxStatus.addWidget(self.checkBoxFollow)
+        self.hboxStatus.addWidget(self.labelStatus, 1)
+
+        self.layout = QtGui.QVBoxLayout()
+        self.layout.addLayout(self.hboxOutputs)
+        self.layout.addLayout(self.hboxStatus)
         self.setLayout(self.layout)
 
         self.show()
 
+    def createTextEdit(self, text: str) -> QtGui.QPlainTextEdit:
+        textEdit = QtGui.QPlainTextEdit()
+        textEdit.setReadOnly(True)
+        textEdit.setMaximumBlockCount(self.max_lines)
+        textEdit.setPlainText(text)
+        return textEdit
+
+    @QtCore.Slot(str, str)
+    def appendOutput(self, name: str, text: str) -> None:
+        # Add text at the end of the stdout or stderr view
+        textEdit = (self.textEditStdout if name == 'stdout'
+                    else self.textEditStderr)
+        if self._empty[name]:
+            textEdit.clear()
+            self._empty[name] = False
+        cursor = textEdit.textCursor()
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText(text)
+        if self.checkBoxFollow.isChecked():
+            textEdit.verticalScrollBar().setValue(
+                textEdit.verticalScrollBar().maximum())
+
+    @QtCore.Slot(object)
+    def streamDone(self, error: Exception = None) -> None:
+        # The log is fully fetched, or fetching it failed
+        if self._empty['stdout']:
+            self.textEditStdout.setPlainText("Task has no stdout")
+        if self._empty['stderr']:
+            self.textEditStderr.setPlainText("Task has no stderr")
+        self.checkBoxFollow.setEnabled(False)
+        if error is not None:
+            self.labelStatus.setText(f'Log fetching failed : {error}')
+        else:
+            self.labelStatus.setText('End of log')
+
+    def closeEvent(self, event) -> None:
+        self.closed.emit()
+        super().closeEvent(event)
+
     def sizeHint(self):
         return QtCore.QSize(800, 400)
 
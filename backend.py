@@ -0,0 +1,211 @@
+import os
+import re
+from typing import List, Optional, Tuple
+
+from femenums import SolverType
+
+# Each solver thread gets at least this many degrees of freedom, so
+# small models do not pay for starting and synchronizing threads
+DOFS_PER_THREAD = 25000
+# CalculiX models with more degrees of freedom are solved with its
+# iterative solver, whose memory use grows linearly, when possible
+CCX_ITERATIVE_DOFS = 2000000
+# Z88 models with more degrees of freedom than the first bound are
+# solved with the SIC preconditioned conjugate gradient solver instead
+# of the direct Cholesky solver, and with the SOR preconditioned one,
+# which needs the least memory, above the second
+Z88_SICCG_DOFS = 100000
+Z88_SORCG_DOFS = 1000000
+
+# CalculiX procedures whose equation solver can be chosen. The others
+# (e.g *FREQUENCY, *BUCKLE) need a direct solver
+_CCX_PROCEDURES = ('*STATIC', '*HEAT TRANSFER')
+_CCX_KEYWORD = re.compile(r'^\*([A-Za-z][A-Za-z \-]*)')
+
+
+class MeshStats():
+    # Size of a model as written in the solver's input files
+
+    def __init__(self, nodes: int, elements: int, dofs: int) -> None:
+        self.nodes = nodes
+        self.elements = elements
+        self.dofs = dofs
+
+    def __repr__(self) -> str:
+        return f'MeshStats({self.nodes} nodes, {self.elements} ' + \
+            f'elements, {self.dofs} dofs)'
+
+
+class SolverBackend():
+    # How the solver runs on the node. solver is, for CalculiX, the
+    # SOLVER parameter set on the procedure (e.g 'ITERATIVE CHOLESKY'),
+    # None to keep the input file's, and for Z88, the z88r solver flag:
+    # 'choly', 'siccg' or 'sorcg'. threads is the maximum number of
+    # solver threads, None to use all the node's cores
+
+    def __init__(self, solver: Optional[str] = None,
+                 threads: Optional[int] = None) -> None:
+        self.solver = solver
+        self.threads = threads
+
+    def __repr__(self) -> str:
+        return f'SolverBackend({self.solver}, {self.threads} threads)'
+
+
+def ccx_mesh_stats(inp_path: str) -> MeshStats:
+    # Count the nodes and elements of a CalculiX input file and the files
+    # it includes. Nodes have 3 degrees of freedom, 1 for heat transfer
+    # analyses and 4 for coupled ones
+    counts = {'nodes': 0, 'elements': 0, 'dofs_per_node': 3}
+    _count_ccx_file(inp_path, counts)
+    return MeshStats(counts['nodes'], counts['elements'],
+                     counts['nodes'] * counts['dofs_per_node'])
+
+
+def _count_ccx_file(path: str, counts) -> None:
+    block = None
+    continued = False
+    with open(path, errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('**'):
+                continue
+            match = _CCX_KEYWORD.match(line)
+            if match:
+                keyword = match.group(1).strip().upper()
+                block = keyword
+                continued = False
+                if keyword == 'INCLUDE':
+                    name = _ccx_parameter(line, 'INPUT')
+                    if name is not None:
+                        _count_ccx_file(os.path.join(
+                            os.path.dirname(path), name), counts)
+                elif keyword == 'HEAT TRANSFER':
+                    counts['dofs_per_node'] = 1
+                elif keyword.startswith('COUPLED TEMPERATURE'):
+                    counts['dofs_per_node'] = 4
+                continue
+            if block == 'NODE':
+                counts['nodes'] += 1
+            elif block == 'ELEMENT':
+                # Elements with many nodes go on several lines, ending
+                # with a comma
+                if not continued:
+                    counts['elements'] += 1
+                continued = line.endswith(',')
+
+
+def _ccx_parameter(line: str, name: str) -> Optional[str]:
+    # Return the value of a keyword line's parameter, e.g INPUT
+    for parameter in line.split(',')[1:]:
+        key, _, value = parameter.partition('=')
+        if key.strip().upper() == name:
+            return value.strip()
+    return None
+
+
+def ccx_set_solver(inp_path: str, solver: str) -> bool:
+    # Set the equation solver of the procedures of a CalculiX input file
+    # that do not set one. Return wether the file was changed. Files
+    # with procedures needing a direct solver are left unchanged
+    with open(inp_path, errors='replace') as f:
+        lines = f.readlines()
+    changed: List[Tuple[int, str]] = []
+    for i, line in enumerate(lines):
+        match = _CCX_KEYWORD.match(line)
+        if match is None or line.startswith('**'):
+            continue
+        keyword = '*' + match.group(1).strip().upper()
+        if keyword in ('*FREQUENCY', '*BUCKLE', '*DYNAMIC',
+                       '*MODAL DYNAMIC', '*COMPLEX FREQUENCY'):
+            return False
+        if keyword in _CCX_PROCEDURES and \
+                _ccx_parameter(line, 'SOLVER') is None:
+            changed.append((i, f'{line.rstrip()}, SOLVER={solver}\n'))
+    if not len(changed):
+        return False
+    for i, line in changed:
+        lines[i] = line
+    with open(inp_path, 'w') as f:
+        f.writelines(lines)
+    return True
+
+
+def z88_mesh_stats(i1_path: str) -> MeshStats:
+    # Read the size of a Z88 model from the header of its z88i1.txt:
+    # dimension, nodes, elements and degrees of freedom
+    with open(i1_path, errors='replace') as f:
+        fields = f.readline().split()
+    return MeshStats(int(fields[1]), int(fields[2]), int(fields[3]))
+
+
+def elmer_mesh_stats(header_path: str) -> MeshStats:
+    # Read the size of an Elmer mesh from its mesh.header: nodes, elements
+    # and boundary elements. The equations solved are not read, so nodes
+    # are counted as one degree of freedom each
+    with open(header_path, errors='replace') as f:
+        fields = f.readline().split()
+    return MeshStats(int(fields[0]), int(fields[1]), int(fields[0]))
+
+
+def fem_mesh_stats(fem_mesh, solver_type: SolverType) -> MeshStats:
+    # Size of a FreeCAD FemMesh, to estimate a run before its input files
+    # are written. Elements are the volumes, or the faces or edges of
+    # shell and beam models. The analysis type is not known yet, so nodes
+    # have 3 degrees of freedom, 1 for Elmer as in elmer_mesh_stats
+    elements = fem_mesh.VolumeCount or fem_mesh.FaceCount or \
+        fem_mesh.EdgeCount
+    dofs_per_node = 1 if solver_type == SolverType.ELMER else 3
+    return MeshStats(fem_mesh.NodeCount, elements,
+                     fem_mesh.NodeCount * dofs_per_node)
+
+
+def mesh_stats(solver_type: SolverType, working_dir: str,
+               file: Optional[str] = None) -> Optional[MeshStats]:
+    # Return the size of the model written in working_dir, None if it
+    # cannot be read. file is the name of CalculiX input file, without
+    # extension
+    try:
+        if solver_type in (SolverType.CCX_TOOLS, SolverType.CCX):
+            if file is None:
+                return None
+            return ccx_mesh_stats(os.path.join(working_dir, file + '.inp'))
+        if solver_type == SolverType.Z88:
+            return z88_mesh_stats(os.path.join(working_dir, 'z88i1.txt'))
+        if solver_type == SolverType.ELMER:
+            return elmer_mesh_stats(os.path.join(working_dir, 'mesh.header'))
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def select_backend(solver_type: SolverType,
+                   stats: Optional[MeshStats]) -> SolverBackend:
+    # Choose the solver and number of threads from the size of the
+    # model. Without stats, the solver's defaults on all cores are kept
+    if stats is None:
+        if solver_type == SolverType.Z88:
+            return SolverBackend('choly')
+        return SolverBackend()
+    threads = max(1, stats.dofs // DOFS_PER_THREAD)
+    if solver_type in (SolverType.CCX_TOOLS, SolverType.CCX):
+        solver = None
+        if stats.dofs > CCX_ITERATIVE_DOFS:
+            solver = 'ITERATIVE CHOLESKY'
+        return SolverBackend(solver, threads)
+    if solver_type == SolverType.Z88:
+        if stats.dofs > Z88_SORCG_DOFS:
+            return SolverBackend('sorcg', threads)
+        if stats.dofs > Z88_SICCG_DOFS:
+            return SolverBackend('siccg', threads)
+        return SolverBackend('choly', threads)
+    return SolverBackend()
+
+
+def threads_command(threads: Optional[int]) -> str:
+    # Return the command setting OMP_NUM_THREADS to threads, or to the
+    # number of cores of the node if it has less or threads is None
+    if threads is None:
+        return 'export OMP_NUM_THREADS=$(nproc)'
+    return f'N=$(nproc) && export OMP_NUM_THREADS=$(( N < {threads} ' + \
+        f'? N : {threads} ))'
@@ -0,0 +1,428 @@
+import argparse
+from concurrent.futures import wait
+import json
+import os
+import sys
+from time import monotonic, sleep
+from typing import Any, Dict, List, Optional
+
+import FreeCAD as App
+
+from controller import ControllerEventDelegate, QarnotController
+from elmerparallel import vtk_available
+from femenums import BatchJobState, SubmissionPhase
+from femtask import write_lock
+from submission import QarnotSubmission
+
+# Seconds between two refreshes of a batch
+POLL_INTERVAL = 2.
+# Default number of analyses submitted and not loaded yet at a time
+MAX_RUNNING = 8
+_DONE_STATES = (BatchJobState.LOADED, BatchJobState.FAILED,
+                BatchJobState.TIMED_OUT)
+
+
+class BatchJob():
+    # An analysis of a batch: the solver of a FreeCAD document, by name or
+    # label. Without solver, the job stands for all the solvers of the
+    # document and is replaced by a job per solver once it is opened
+
+    def __init__(self, document_path: str, solver: Optional[str] = None,
+                 name: Optional[str] = None,
+                 result_patterns: Optional[List[str]] = None) -> None:
+        self.document_path = os.path.abspath(document_path)
+        self.solver = solver
+        self.name = name
+        self.result_patterns = result_patterns
+        self.state = BatchJobState.PENDING
+        self.submission: Optional[QarnotSubmission] = None
+        self.uuid: Optional[str] = None
+        self.error: Optional[str] = None
+        # Monotonic times the job was started and was done at
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'document': self.document_path, 'solver': self.solver,
+                'name': self.name, 'state': self.state.name,
+                'uuid': self.uuid, 'error': self.error,
+                'duration': self.duration}
+
+
+def read_manifest(path: str) -> List[BatchJob]:
+    # Read the jobs of a JSON manifest: a list of objects with a
+    # "document" path, relative to the manifest, and optionally the
+    # "solvers" to run (all of the document's by default), a task "name"
+    # and the "result_patterns" to download
+    with open(path) as f:
+        entries = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in entries:
+        document = os.path.join(directory, entry['document'])
+        solvers = entry.get('solvers') or [None]
+        name = entry.get('name')
+        for solver in solvers:
+            job_name = name
+            if name is not None and len(solvers) > 1:
+                job_name = f'{name}_{solver}'
+            jobs.append(BatchJob(document, solver, job_name,
+                                 entry.get('result_patterns')))
+    return jobs
+
+
+def list_solvers(doc: App.Document) -> List:
+    # Return the solver objects of a document
+    return [obj for obj in doc.Objects
+            if obj.TypeId == 'Fem::FemSolverObjectPython']
+
+
+class BatchRunner(ControllerEventDelegate):
+    # Runs a batch of analyses without GUI nor Qt event loop, e.g from
+    # FreeCADCmd. It is the event delegate of the controller it runs on:
+    # create the runner, then a QarnotController with it, establish the
+    # connection and call run. Documents are opened as their jobs start.
+    # At most max_running jobs are submitted and not loaded yet at a
+    # time. Results are loaded as tasks finish. Once all their jobs are
+    # done, documents are closed, and saved if results were loaded in
+    # them, unless save is False. Qarnot tasks are deleted once their
+    # results are loaded, unless delete_tasks is False. Failed tasks are
+    # kept, for their logs.
+    # Each task gets a directory named after it in working_dir, or a
+    # temporary directory if working_dir is not given. Jobs still running
+    # after timeout seconds are aborted, and no job starts past it
+
+    def __init__(self, jobs: List[BatchJob], max_running: int = MAX_RUNNING,
+                 working_dir: Optional[str] = None, save: bool = True,
+                 delete_tasks: bool = True, timeout: Optional[float] = None,
+                 poll_interval: float = POLL_INTERVAL) -> None:
+        super().__init__()
+        self.jobs = jobs
+        self.max_running = max_running
+        self.working_dir = working_dir
+        self.save = save
+        self.delete_tasks = delete_tasks
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # Documents opened by the runner, by path
+        self._documents: Dict[str, App.Document] = {}
+        self._jobs_by_uuid: Dict[str, BatchJob] = {}
+        self._finished: List[str] = []
+        self._names: Dict[str, int] = {}
+
+    def run(self) -> bool:
+        # Run the jobs until they are all done. Return wether all their
+        # results were loaded
+        start = monotonic()
+        while True:
+            self._start_jobs()
+            self.controller.actualize_tasks()
+            self._load_finished()
+            self._close_documents()
+            if not any(job.state not in _DONE_STATES for job in self.jobs):
+                break
+            if (self.timeout is not None and
+                    monotonic() - start > self.timeout):
+                self._abort_jobs()
+                break
+            if not self.controller.submission_queue.writes_pending():
+                sleep(self.poll_interval)
+        self._close_documents()
+        return all(job.state == BatchJobState.LOADED for job in self.jobs)
+
+    def print_summary(self) -> None:
+        loaded = 0
+        for job in self.jobs:
+            text = f'{job.name or job.document_path}: {job.state.name}'
+            if job.duration is not None:
+                text += f' in {job.duration:.0f} s'
+            if job.error is not None:
+                text += f' ({job.error})'
+            App.Console.PrintMessage(text + '\n')
+            loaded += job.state == BatchJobState.LOADED
+        App.Console.PrintMessage(f'{loaded}/{len(self.jobs)} analyses ' +
+                                 'loaded\n')
+
+    def write_report(self, path: str) -> None:
+        # Write the state, task and duration of each job to a JSON file
+        with open(path, 'w') as f:
+            json.dump([job.to_dict() for job in self.jobs], f, indent=2)
+
+    #
+    # Controller events
+    #
+    def on_submission_progress(self, submission: QarnotSubmission,
+                               phase: SubmissionPhase) -> None:
+        job = self._job_of_submission(submission)
+        if job is None:
+            return
+        if phase == SubmissionPhase.SUBMITTED:
+            job.uuid = submission.uuid
+            self._jobs_by_uuid[job.uuid] = job
+        elif phase in (SubmissionPhase.FAILED, SubmissionPhase.CANCELLED) \
+                and job.state not in _DONE_STATES:
+            self._done(job, BatchJobState.FAILED, 'submission failed')
+
+    def on_task_finished(self, uuid: str) -> None:
+        if uuid in self._jobs_by_uuid:
+            self._finished.append(uuid)
+
+    def on_task_failed(self, uuid: str) -> None:
+        job = self._jobs_by_uuid.get(uuid)
+        if job is not None and job.state not in _DONE_STATES:
+            self._done(job, BatchJobState.FAILED, 'computation failed')
+
+    def on_task_loaded(self, uuid: str) -> None:
+        job = self._jobs_by_uuid.get(uuid)
+        if job is not None:
+            self._done(job, BatchJobState.LOADED)
+
+    #
+    # Internals
+    #
+    def _start_jobs(self) -> None:
+        running = sum(job.state == BatchJobState.RUNNING
+                      for job in self.jobs)
+        i = 0
+        while running < self.max_running and i < len(self.jobs):
+            job = self.jobs[i]
+            i += 1
+            if job.state != BatchJobState.PENDING:
+                continue
+            if job.solver is None:
+                # Replace it with a job per solver of the document
+                solver_jobs = self._expand(job)
+                self.jobs[i - 1:i] = solver_jobs
+                i -= 1
+                continue
+            if self._start(job):
+                running += 1
+
+    def _expand(self, job: BatchJob) -> List[BatchJob]:
+        doc = self._open(job)
+        if doc is None:
+            return [job]
+        solvers = list_solvers(doc)
+        if not len(solvers):
+            self._done(job, BatchJobState.FAILED, 'no solver')
+            return [job]
+        return [BatchJob(job.document_path, solver.Name,
+                         f'{job.name}_{solver.Label}'
+                         if job.name is not None else None,
+                         job.result_patterns)
+                for solver in solvers]
+
+    def _start(self, job: BatchJob) -> bool:
+        # Queue the job's task. Return wether it was queued
+        job.start_time = monotonic()
+        doc = self._open(job)
+        if doc is None:
+            return False
+        solver = doc.getObject(job.solver)
+        if solver is None:
+            labelled = doc.getObjectsByLabel(job.solver)
+            solver = labelled[0] if len(labelled) else None
+        if solver is None:
+            self._done(job, BatchJobState.FAILED,
+                       f'no solver {job.solver} in {doc.Label}')
+            return False
+        if job.name is None:
+            job.name = f'{doc.Label}_{solver.Label}'
+        job.name = self._unique_name(job.name)
+        working_dir = None
+        if self.working_dir is not None:
+            working_dir = os.path.join(self.working_dir, job.name)
+            os.makedirs(working_dir, exist_ok=True)
+        job.state = BatchJobState.RUNNING
+        job.submission = self.controller.start_fem(
+            solver, job.name, working_dir, job.result_patterns)
+        if job.submission is None:
+            self._done(job, BatchJobState.FAILED, 'task creation failed')
+            return False
+        return True
+
+    def _open(self, job: BatchJob) -> Optional[App.Document]:
+        path = job.document_path
+        if path in self._documents:
+            return self._documents[path]
+        for doc in App.listDocuments().values():
+            if doc.FileName and os.path.abspath(doc.FileName) == path:
+                return doc
+        try:
+            doc = App.openDocument(path)
+        except Exception as err:
+            self._done(job, BatchJobState.FAILED, f'unable to open: {err}')
+            return None
+        self._documents[path] = doc
+        self.controller.update_document(doc)
+        return doc
+
+    def _unique_name(self, name: str) -> str:
+        count = self._names.get(name, 0)
+        self._names[name] = count + 1
+        return name if count == 0 else f'{name}_{count}'
+
+    def _load_finished(self) -> None:
+        # Load the results of the tasks that finished since last call in
+        # one batch, then delete their qarnot tasks
+        if not len(self._finished):
+            return
+        uuids = [uuid for uuid in self._finished
+                 if uuid in self.controller.tasks]
+        self._finished = []
+        with write_lock:
+            self.controller.load_results(uuids)
+        for uuid in uuids:
+            job = self._jobs_by_uuid[uuid]
+            if job.state not in _DONE_STATES:
+                self._done(job, BatchJobState.FAILED,
+                           'unable to load results')
+            elif self.delete_tasks and job.state == BatchJobState.LOADED:
+                self.controller.delete_task(uuid)
+
+    def _close_documents(self) -> None:
+        # Close the documents opened by the runner whose jobs are all
+        # done, saving those results were loaded in
+        busy = {job.document_path for job in self.jobs
+                if job.state not in _DONE_STATES}
+        loaded = {job.document_path for job in self.jobs
+                  if job.state == BatchJobState.LOADED}
+        for path in [path for path in self._documents if path not in busy]:
+            doc = self._documents.pop(path)
+            try:
+                if self.save and path in loaded:
+                    doc.save()
+            except Exception as err:
+                App.Console.PrintError(f'Unable to save {path} : {err}\n')
+            self.controller.remove_document(doc)
+            App.closeDocument(doc.Name)
+
+    def _abort_jobs(self) -> None:
+        # Abort the jobs that are not done. Submissions being uploaded or
+        # submitted cannot be cancelled: they are waited for, and the
+        # tasks they submitted deleted
+        aborted = [job for job in self.jobs if job.state not in _DONE_STATES]
+        in_flight = [job.submission for job in aborted
+                     if job.submission is not None and
+                     not job.submission.cancel() and
+                     job.submission.future is not None]
+        wait([submission.future for submission in in_flight])
+        # Sends the submitted tasks to the controller and the jobs
+        self.controller.process_events()
+        for job in aborted:
+            if job.uuid is not None:
+                self.controller.delete_task(job.uuid)
+            if job.state not in _DONE_STATES:
+                self._done(job, BatchJobState.TIMED_OUT)
+
+    def _done(self, job: BatchJob, state: BatchJobState,
+              error: Optional[str] = None) -> None:
+        job.state = state
+        job.error = error
+        job.end_time = monotonic()
+        if state == BatchJobState.LOADED:
+            App.Console.PrintMessage(f'{job.name} loaded\n')
+        else:
+            App.Console.PrintWarning(f'{job.name or job.document_path}: ' +
+                                     f'{state.name} {error or ""}\n')
+
+    def _job_of_submission(self, submission: QarnotSubmission) \
+            -> Optional[BatchJob]:
+        for job in self.jobs:
+            if job.submission is submission:
+                return job
+        return None
+
+
+def main(argv: List[str]) -> int:
+    # Run the analyses given on the command line. Return 0 if all their
+    # results were loaded, 1 if some were not and 2 if none could start
+    user_data = App.ConfigGet('UserAppData')
+    parser = argparse.ArgumentParser(
+        prog='batch.py',
+        description='Compute FEM analyses of FreeCAD documents on Qarnot, '
+                    'load their results and save the documents')
+    parser.add_argument('documents', nargs='*', help='FreeCAD documents')
+    parser.add_argument('-s', '--solver', action='append', dest='solvers',
+                        help='name or label of the solver to run in each '
+                             'document, may be repeated. All the solvers '
+                             'of a document run by default')
+    parser.add_argument('-m', '--manifest',
+                        help='JSON file listing analyses to run')
+    parser.add_argument('-j', '--max-running', type=int,
+                        default=MAX_RUNNING,
+                        help='analyses submitted and not loaded at a time')
+    parser.add_argument('-d', '--working-dir',
+                        help='directory of the tasks inputs and results')
+    parser.add_argument('--timeout', type=float,
+                        help='seconds after which running analyses are '
+                             'aborted')
+    parser.add_argument('--token-file', default=user_data + 'qarnot.txt',
+                        help='file holding the Qarnot token, unless '
+                             'QARNOT_TOKEN is set')
+    parser.add_argument('--index', default=user_data + 'qarnot_tasks.sqlite',
+                        help='task index file')
+    parser.add_argument('--report', help='JSON file to write the report to')
+    parser.add_argument('--timings',
+                        help='JSON file to write the phase timings of the '
+                             'tasks to')
+    parser.add_argument('--chrome-trace', action='store_true',
+                        help='write the timings in the Chrome trace format')
+    parser.add_argument('--no-save', action='store_true',
+                        help='do not save documents')
+    parser.add_argument('--keep-tasks', action='store_true',
+                        help='do not delete loaded tasks from Qarnot')
+    parser.add_argument('--compress', action='store_true',
+                        help='upload inputs as a compressed archive')
+    parser.add_argument('--mpi', action='store_true',
+                        help='run Elmer with MPI on all the cores')
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest) if args.manifest else []
+    for document in args.documents:
+        for solver in args.solvers or [None]:
+            jobs.append(BatchJob(document, solver))
+    if not len(jobs):
+        parser.print_usage()
+        return 2
+    if args.mpi and not vtk_available():
+        App.Console.PrintError('--mpi needs VTK python module (vtk) to '
+                               'merge partitioned results\n')
+        return 2
+    token = os.environ.get('QARNOT_TOKEN')
+    if token is None:
+        try:
+            with open(args.token_file) as f:
+                token = f.readline(1000).strip()
+        except OSError as err:
+            App.Console.PrintError(f'Unable to read the token : {err}\n')
+            return 2
+
+    runner = BatchRunner(jobs, args.max_running, args.working_dir,
+                         not args.no_save, not args.keep_tasks, args.timeout)
+    controller = QarnotController(runner, compress_inputs=args.compress,
+                                  use_mpi=args.mpi, index_path=args.index)
+    if not controller.establish_connection(token, discover=False):
+        App.Console.PrintError('Connection with Qarnot failed\n')
+        controller.shutdown()
+        return 2
+    try:
+        success = runner.run()
+    finally:
+        controller.shutdown()
+    runner.print_summary()
+    if args.report is not None:
+        runner.write_report(args.report)
+    if args.timings is not None:
+        controller.export_timings(args.timings, args.chrome_trace)
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
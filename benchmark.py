@@ -0,0 +1,375 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from time import monotonic, perf_counter, sleep
+from typing import Callable, Dict, List, Optional
+
+from controller import ControllerEventDelegate, QarnotController
+from fakeqarnot import FakeConfig, FakeConnection
+from femenums import FemState, SubmissionPhase
+from femtask import QARNOT_RUNNING_STATES, QarnotFemTask
+from progress import ProgressParser
+from submission import QarnotSubmission
+from tasklog import OutputPoller, TaskLogStream, TaskOutput
+
+# Numbers of tasks each benchmark runs with
+SIZES = [1, 10, 100, 1000]
+# A benchmark's cost per task at the largest size may be at most this
+# many times its cost at the smallest size of at least 10 tasks
+MAX_RATIO = 3.
+# Seconds to wait for submissions or downloads before giving up
+TIMEOUT = 600.
+# Seconds the computing tasks are polled for
+POLL_WINDOW = 10.
+
+
+class BenchSolver():
+    # Stands for a CalculiX solver object, with what fem tasks read of it
+
+    class Proxy():
+        Type = 'Fem::SolverCalculix'
+
+    class Document():
+        Name = 'Benchmark'
+        FileName = 'benchmark.FCStd'
+
+    Name = 'SolverCalculiX'
+    Label = 'SolverCalculiX'
+
+
+class BenchFemTask(QarnotFemTask):
+    # A fem task whose input is a file of input_size random bytes, so that
+    # no document is needed
+
+    def __init__(self, name: str, input_size: int) -> None:
+        self.input_size = input_size
+        super().__init__(BenchSolver(), name)
+
+    def setMachineAndDirectory(self):
+        self.working_dir = tempfile.mkdtemp(prefix='qarnot-bench-')
+
+    def prepare(self) -> bool:
+        with open(os.path.join(self.working_dir, 'bench.inp'), 'wb') as f:
+            f.write(os.urandom(self.input_size))
+        self.file = 'bench'
+        self.prepared = True
+        return True
+
+
+class BenchEventDelegate(ControllerEventDelegate):
+    # Records when submissions are done and tasks downloaded
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.submitted: Dict[QarnotSubmission, float] = {}
+        self.failed = 0
+        self.downloading: Dict[str, float] = {}
+        self.finished: Dict[str, float] = {}
+
+    def on_submission_progress(self, submission: QarnotSubmission,
+                               phase: SubmissionPhase) -> None:
+        if phase == SubmissionPhase.SUBMITTED:
+            self.submitted[submission] = perf_counter()
+        elif phase in (SubmissionPhase.FAILED, SubmissionPhase.CANCELLED):
+            self.failed += 1
+
+    def on_task_downloading(self, uuid: str) -> None:
+        self.downloading[uuid] = perf_counter()
+
+    def on_task_finished(self, uuid: str) -> None:
+        self.finished[uuid] = perf_counter()
+
+    def on_task_failed(self, uuid: str) -> None:
+        self.failed += 1
+
+
+class Bench():
+    # A controller on a fake connection with n benchmark tasks
+
+    def __init__(self, config: FakeConfig, n: int, input_size: int) -> None:
+        self.n = n
+        self.input_size = input_size
+        self.delegate = BenchEventDelegate()
+        self.controller = QarnotController(
+            self.delegate, connection_factory=FakeConnection.factory(config))
+        self.controller.establish_connection('', discover=False)
+        self.tasks: List[BenchFemTask] = []
+
+    @property
+    def conn(self) -> FakeConnection:
+        return self.controller.conn
+
+    def submit(self) -> Dict[str, float]:
+        # Queue the tasks and process events until they are submitted.
+        # Return the time taken and the mean and worst submission latency
+        start = perf_counter()
+        queued = {}
+        for i in range(self.n):
+            t = BenchFemTask(f'bench-{i}', self.input_size)
+            self.tasks.append(t)
+            # Tasks are queued directly since they have no solver object
+            queued[self.controller._queue_task(t)] = perf_counter()
+        self._wait(lambda: len(self.delegate.submitted) +
+                   self.delegate.failed >= self.n)
+        total = perf_counter() - start
+        latencies = [self.delegate.submitted[s] - t
+                     for s, t in queued.items()
+                     if s in self.delegate.submitted]
+        return {'total': total,
+                'mean': sum(latencies) / max(len(latencies), 1),
+                'max': max(latencies, default=0.)}
+
+    def poll(self, window: float = POLL_WINDOW) -> Dict[str, float]:
+        # Actualize the computing tasks for window seconds, refreshing them
+        # as their checks are due. Return the mean time spent on the
+        # calling thread per refresh, starting the listing and applying
+        # it, and the number of requests made during the window by all
+        # threads, e.g those listing tasks or fetching their output
+        computing = self.controller.list_task([FemState.COMPUTING])
+        # Schedules the tasks' checks
+        self.controller.actualize_tasks()
+        requests = self.conn.requests
+        ticks = 0
+        busy = 0.
+        end = monotonic() + window
+        while monotonic() < end:
+            if not self.controller._events.empty():
+                start = perf_counter()
+                self.controller.process_events()
+                busy += perf_counter() - start
+            if len(self.controller.poll_scheduler.due()) and \
+                    not self.controller.state_lister.running:
+                start = perf_counter()
+                self.controller.refresh_tasks(computing)
+                busy += perf_counter() - start
+                ticks += 1
+            sleep(0.005)
+        return {'tick': busy / max(ticks, 1),
+                'requests': self.conn.requests - requests}
+
+    def download(self) -> Dict[str, float]:
+        # Process events until the tasks' results are downloaded. Return
+        # the time from the first download to the last and the bytes
+        # downloaded per second
+        self._wait(lambda: len(self.delegate.finished) +
+                   self.delegate.failed >= self.n, actualize=True)
+        if not len(self.delegate.finished):
+            return {'total': 0., 'throughput': 0.}
+        total = max(self.delegate.finished.values()) - \
+            min(self.delegate.downloading.values())
+        size = sum(self.conn.config.result_files.values()) * \
+            len(self.delegate.finished)
+        return {'total': total, 'throughput': size / max(total, 1e-9)}
+
+    def close(self) -> None:
+        self.controller.shutdown()
+        for t in self.tasks:
+            shutil.rmtree(t.working_dir, ignore_errors=True)
+
+    def _wait(self, done: Callable[[], bool], actualize: bool = False) \
+            -> None:
+        end = monotonic() + TIMEOUT
+        while not done():
+            if monotonic() > end:
+                raise TimeoutError('benchmark tasks did not complete')
+            if actualize:
+                self.controller.actualize_tasks()
+            else:
+                self.controller.process_events()
+            sleep(0.005)
+
+
+def bench_panel(controller: QarnotController) -> Optional[Dict[str, float]]:
+    # Time the task panel's first sync, which adds every row, and a sync
+    # with no change. None if Qt is not available
+    try:
+        from PySide import QtCore
+        from Gui.taskmodel import TaskTableModel
+    except ImportError:
+        return None
+    if QtCore.QCoreApplication.instance() is None:
+        bench_panel.app = QtCore.QCoreApplication([])
+    model = TaskTableModel()
+    start = perf_counter()
+    model.sync(controller)
+    first = perf_counter() - start
+    start = perf_counter()
+    model.sync(controller)
+    return {'first': first, 'steady': perf_counter() - start}
+
+
+def run(sizes: List[int], config: FakeConfig, input_size: int,
+        write: Callable[[str], None]) -> Dict[str, Dict[int, float]]:
+    # Run the benchmarks at each size and write a line per size. Return
+    # the cost per task of each benchmark by size, and the requests made
+    # while polling, which should not grow with the number of tasks
+    costs: Dict[str, Dict[int, float]] = {
+        'submission': {}, 'polling': {}, 'panel': {}, 'download': {},
+        'polling requests': {}}
+    write(f'{"tasks":>6} {"submit s":>9} {"latency":>8} {"max":>8} '
+          f'{"tick ms":>8} {"requests":>8} {"panel ms":>9} '
+          f'{"steady":>7} {"dl s":>7} {"MB/s":>7}')
+    for n in sizes:
+        # Tasks keep computing for the submission and polling benchmarks
+        computing = FakeConfig(**vars(config))
+        computing.task_duration = 3600.
+        bench = Bench(computing, n, input_size)
+        try:
+            submission = bench.submit()
+            polling = bench.poll()
+            panel = bench_panel(bench.controller)
+        finally:
+            bench.close()
+        finished = FakeConfig(**vars(config))
+        finished.task_duration = 0.
+        bench = Bench(finished, n, input_size)
+        try:
+            bench.submit()
+            download = bench.download()
+        finally:
+            bench.close()
+        costs['submission'][n] = submission['total'] / n
+        costs['polling'][n] = polling['tick'] / n
+        costs['polling requests'][n] = polling['requests']
+        costs['download'][n] = download['total'] / n
+        panel_text = f'{"-":>9} {"-":>7}'
+        if panel is not None:
+            costs['panel'][n] = panel['first'] / n
+            panel_text = f'{panel["first"] * 1e3:9.2f} ' + \
+                f'{panel["steady"] * 1e3:7.2f}'
+        write(f'{n:6d} {submission["total"]:9.3f} '
+              f'{submission["mean"]:8.3f} {submission["max"]:8.3f} '
+              f'{polling["tick"] * 1e3:8.2f} {polling["requests"]:8d} '
+              f'{panel_text} {download["total"]:7.2f} '
+              f'{download["throughput"] / 1e6:7.1f}')
+    return costs
+
+
+def check_log_stream(write: Callable[[str], None]) -> bool:
+    # Follow the log of a fake task from the middle of its run. Return
+    # wether each line it wrote was received once
+    conn = FakeConnection(FakeConfig(task_duration=1.,
+                                     output_interval=0.01))
+    task = conn.create_task('log', 'docker-batch')
+    task.submit()
+    sleep(0.3)
+    lines: List[str] = []
+    stream = TaskLogStream(task, interval=0.05)
+    stream.subscribe(lambda name, text: lines.extend(text.splitlines()),
+                     lambda error: None)
+    stream.start()
+    stream.future.result(TIMEOUT)
+    ok = stream.error is None and lines == task.stdout().splitlines()
+    write(f'log stream: {len(lines)} lines, {len(set(lines))} distinct, '
+          f'{"ok" if ok else "DUPLICATE OUTPUT"}')
+    return ok
+
+
+class StepCounter(ProgressParser):
+    # Counts the times each line of a fake task's stdout is parsed
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.steps: Dict[str, int] = {}
+
+    def parse_line(self, line: str) -> None:
+        self.steps[line] = self.steps.get(line, 0) + 1
+
+
+def check_output_poller(write: Callable[[str], None]) -> bool:
+    # Parse a fake task's stdout fetched by an OutputPoller from the
+    # middle of its run. Return wether each step was parsed once
+    conn = FakeConnection(FakeConfig(task_duration=1.,
+                                     output_interval=0.01))
+    task = conn.create_task('poll', 'docker-batch')
+    task.submit()
+    sleep(0.3)
+    parser = StepCounter()
+    poller = OutputPoller(lambda uuid, text: parser.feed(text))
+    output = TaskOutput()
+    running = True
+    while running:
+        running = task.state in QARNOT_RUNNING_STATES
+        poller.poll([(task, output)])
+        # Wait for the fetch, a task still queued is not polled again
+        poller.executor.submit(lambda: None).result(TIMEOUT)
+        sleep(0.05)
+    poller.shutdown()
+    steps = task.stdout().splitlines()
+    ok = sorted(parser.steps) == sorted(steps) and \
+        all(count == 1 for count in parser.steps.values())
+    write(f'output poller: {len(steps)} steps, '
+          f'{sum(parser.steps.values())} parsed, '
+          f'{"ok" if ok else "DUPLICATE OUTPUT"}')
+    return ok
+
+
+def check_scaling(costs: Dict[str, Dict[int, float]], max_ratio: float,
+                  write: Callable[[str], None]) -> bool:
+    # Compare each cost at the largest size with the cost at the smallest
+    # size of at least 10 tasks, smaller sizes being dominated by fixed
+    # costs. Return wether none grew more than max_ratio times
+    ok = True
+    for name, by_size in costs.items():
+        sizes = sorted(n for n in by_size if n >= 10)
+        if len(sizes) < 2 or by_size[sizes[0]] <= 0:
+            continue
+        ratio = by_size[sizes[-1]] / by_size[sizes[0]]
+        verdict = 'ok'
+        if ratio > max_ratio:
+            verdict = 'REGRESSION'
+            ok = False
+        write(f'{name}: x{ratio:.2f} from {sizes[0]} to {sizes[-1]} '
+              f'tasks, {verdict}')
+    return ok
+
+
+def main(argv: List[str]) -> int:
+    # Run the benchmarks. Return 1 if a cost grew more than --max-ratio
+    # times or a task's output was received twice, 0 otherwise
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py',
+        description='Measure how submission, polling, panel refresh and '
+                    'downloads scale with the number of tasks, on a fake '
+                    'Qarnot connection')
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES,
+                        help='numbers of tasks')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=50e6,
+                        help='bytes per second of each transfer')
+    parser.add_argument('--request-failure-rate', type=float, default=0.)
+    parser.add_argument('--input-size', type=int, default=256 << 10,
+                        help='bytes of input per task')
+    parser.add_argument('--result-size', type=int, default=256 << 10,
+                        help='bytes of results per task')
+    parser.add_argument('--max-ratio', type=float, default=MAX_RATIO)
+    parser.add_argument('--output', help='file to also write results to')
+    args = parser.parse_args(argv)
+
+    config = FakeConfig(latency=args.latency, bandwidth=args.bandwidth,
+                        request_failure_rate=args.request_failure_rate,
+                        result_files={'result.frd': args.result_size},
+                        seed=0)
+    output = open(args.output, 'w') if args.output else None
+
+    def write(line: str) -> None:
+        print(line)
+        if output is not None:
+            output.write(line + '\n')
+
+    try:
+        costs = run(sorted(args.sizes), config, args.input_size, write)
+        ok = check_scaling(costs, args.max_ratio, write)
+        ok = check_log_stream(write) and ok
+        ok = check_output_poller(write) and ok
+    finally:
+        if output is not None:
+            output.close()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,14 +1,43 @@
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set
 import qarnot
+from qarnot.exceptions import MissingTaskException
 from qarnot.task import Task
-from time import localtime, strftime
+from queue import Empty, SimpleQueue
+import threading
+from time import localtime, monotonic, strftime, time
 
 from PySide import QtCore
 
 import FreeCAD as App
 
-from femtask import QarnotFemTask, QarnotOldFemTask
-from femenums import FemState, SolverType
+from backend import MeshStats, SolverBackend, fem_mesh_stats
+from discovery import DiscoveryCancelled, OldTaskDiscovery
+from elmerparallel import vtk_available
+from estimator import DEFAULT_PROFILES, HardwareProfile, RunEstimate, \
+    RunEstimator, RunSample
+from femtask import QarnotFemTask, QarnotOldFemTask, recomputes_frozen, \
+    solver_type_of, write_lock
+from femenums import FemState, SolverType, SubmissionPhase, TaskPhase
+from packing import QarnotPackedFemTask
+from polling import PollScheduler, StateLister
+from submission import QarnotSubmission, SubmissionQueue
+from sweep import DocumentOverrides, QarnotSweep
+from progress import ProgressParser, TaskProgress, create_progress_parser
+from taskindex import TaskIndex
+from tasklog import OutputPoller, TaskLogStream, TaskOutput
+from tracing import TraceRecord, write_traces
+from transfer import RESOURCE_CACHE_MAX_AGE, DownloadCancelled, \
+    DownloadQueue, ResourceCache
+
+
+# Seconds the GUI thread spends writing queued tasks' inputs before it
+# processes other events
+WRITE_TIME_SLICE = 0.5
+
+
+def qarnot_connection(token: str) -> qarnot.Connection:
+    return qarnot.Connection(client_token=token)
 
 
 class ControllerEventDelegate(QtCore.QObject):
@@ -25,21 +54,41 @@ class ControllerEventDelegate(QtCore.QObject):
     def on_task_submitted(self, uuid: str):
         pass
 
+    def on_submission_progress(self, submission: QarnotSubmission,
+                               phase: SubmissionPhase):
+        pass
+
+    def on_upload_progress(self, submission: QarnotSubmission,
+                           uploaded: int, upload_size: int):
+        pass
+
     def on_task_retrieved(self, uuid: str):
         pass
 
+    def on_old_tasks_found(self, uuids: List[str]):
+        pass
+
+    def on_old_tasks_discovered(self):
+        pass
+
     def on_task_loaded(self, uuid: str):
         pass
 
     def on_task_deleted(self, uuid: str):
         pass
 
+    def on_task_downloading(self, uuid: str):
+        pass
+
     def on_task_finished(self, uuid: str):
         pass
 
     def on_task_failed(self, uuid: str):
         pass
 
+    def on_task_progress(self, uuid: str, progress: TaskProgress):
+        pass
+
 
 class QarnotController(QtCore.QObject):
     # This class is used to oversee Femtasks management. It encapsulate
@@ -48,65 +97,326 @@ class QarnotController(QtCore.QObject):
     # in self.old_tasks
     # The class also include an event delegate which can be used to handle
     # events in a gui or multi threaded environnement
+    # Long operations such as submissions run on worker threads. They post
+    # their events which are dispatched to the event delegate when
+    # process_events (called by actualize_tasks) is called, so the delegate
+    # is always called from the thread that actualizes tasks
 
     def __init__(self, event_delegate: ControllerEventDelegate
-                 = ControllerEventDelegate()) -> None:
+                 = ControllerEventDelegate(),
+                 max_submission_workers: int = 4,
+                 use_resource_cache: bool = True,
+                 resource_cache_max_age: Optional[timedelta]
+                 = RESOURCE_CACHE_MAX_AGE,
+                 compress_inputs: bool = False,
+                 use_mpi: bool = False,
+                 old_tasks_window: Optional[timedelta]
+                 = timedelta(days=30),
+                 index_path: Optional[str] = None,
+                 profiles: Optional[List[HardwareProfile]] = None,
+                 connection_factory: Optional[
+                     Callable[[str], qarnot.Connection]] = None) -> None:
         super().__init__()
         self.conn: qarnot.Connection = None
+        # Creates the connection from the token. A stand-in can be given,
+        # e.g fakeqarnot.FakeConnection for tests and benchmarks
+        self.connection_factory = connection_factory or qarnot_connection
+        # Big input files are shared between tasks through the resource
+        # cache, unless use_resource_cache is False
+        self.use_resource_cache = use_resource_cache
+        self.resource_cache: Optional[ResourceCache] = None
+        # Files of the cache older than this that no task references are
+        # evicted in the background at connection time, unless it is None
+        self.resource_cache_max_age = resource_cache_max_age
+        # Inputs are packed in a compressed archive for upload if set
+        self.compress_inputs = compress_inputs
+        # Elmer runs on all the cores of the node with MPI if set. Its
+        # partitioned results can only be merged with VTK's python module
+        self.use_mpi = use_mpi
+        if use_mpi and not vtk_available():
+            App.Console.PrintError(
+                'VTK python module not found, it is needed to merge the '
+                'results of MPI runs. Elmer runs on a single core\n')
+            self.use_mpi = False
+        # Hardware profiles tasks are sent to, the one with the least
+        # memory the estimated peak memory fits in is chosen
+        self.profiles = profiles or DEFAULT_PROFILES
+        # Estimates run time and memory from past runs, recorded in the
+        # index if there is one
+        self.estimator = RunEstimator()
+        # Results of finished tasks are downloaded on worker threads
+        self.download_queue: Optional[DownloadQueue] = None
+        # Previous tasks are listed in the background at connection time.
+        # Only tasks created within old_tasks_window are listed, all of
+        # them if it is None
+        self.old_tasks_window = old_tasks_window
+        self.discovery: Optional[OldTaskDiscovery] = None
         self.tasks: Dict[str, QarnotFemTask] = {}
         self.old_tasks: Dict[str, QarnotOldFemTask] = {}
+        # Uuids of old tasks by the path of the document they were sent
+        # from, and open documents by path (built on first use, see
+        # update_document). They let retrieval only check the tasks of a
+        # document instead of every old task against every document
+        self._old_tasks_by_document: Dict[str, Set[str]] = {}
+        self._documents: Optional[Dict[str, App.Document]] = None
+        self._document_paths: Dict[str, str] = {}
+        self.sweeps: List[QarnotSweep] = []
+        # Phase timings of the tasks submitted or retrieved in this
+        # session by uuid, kept once tasks are deleted (see timings)
+        self.traces: Dict[str, TraceRecord] = {}
+        # Logs being fetched or followed by task uuid, see log_stream,
+        # and the output read so far of the tasks they were opened for
+        self.log_streams: Dict[str, TaskLogStream] = {}
+        self.task_outputs: Dict[str, TaskOutput] = {}
+        # Progress parsers of computing tasks by uuid, fed by a single
+        # output poller, see track_progress
+        self.progress_parsers: Dict[str, ProgressParser] = {}
+        self._progress_lock = threading.Lock()
+        self.output_poller = OutputPoller(self._on_task_output)
         self.event_delegate = event_delegate
         self.event_delegate.controller = self
+        self._events: SimpleQueue = SimpleQueue()
+        self.submission_queue = SubmissionQueue(
+            self._on_submission_progress, self._on_upload_progress,
+            max_submission_workers)
+        self.poll_scheduler = PollScheduler()
+        # Lists the computing tasks' states, see refresh_tasks, and the
+        # tasks whose check was due when the listing was started
+        self.state_lister = StateLister(self._on_states_listed)
+        self._listing_due: Set[str] = set()
+        # Tasks are recorded in a local index, if index_path is given.
+        # Previous tasks are loaded from it right away, discovery then
+        # only adds the tasks the index does not know
+        self.index: Optional[TaskIndex] = None
+        if index_path is not None:
+            self.index = TaskIndex(index_path)
+            self.load_index()
+            for solver_type, nodes, elements, dofs, run_time, peak in \
+                    self.index.runs():
+                if solver_type in SolverType.__members__:
+                    self.estimator.add(RunSample(
+                        SolverType[solver_type],
+                        MeshStats(nodes, elements, dofs), run_time, peak))
 
-    def establish_connection(self, token: str) -> bool:
+    def establish_connection(self, token: str,
+                             discover: bool = True) -> bool:
         # Establish a Qarnot connection with the given
         # token and return if it was successful.
+        # Previous tasks are then discovered in the background, see
+        # discover_old_tasks, unless discover is False
         self.conn = None
         try:
-            self.conn = qarnot.Connection(client_token=token)
+            self.conn = self.connection_factory(token)
+            if self.use_resource_cache:
+                self.resource_cache = ResourceCache(self.conn)
+                if self.resource_cache_max_age is not None:
+                    self.evict_resources()
+            if self.download_queue is not None:
+                self.download_queue.shutdown()
+            self.download_queue = DownloadQueue(
+                self.conn, self._on_download_done)
             self.event_delegate.on_connection_established()
-            for t in self.find_old_tasks():
-                old_task = QarnotOldFemTask(t)
-                if old_task.complete:
-                    self.old_tasks[old_task.uuid] = old_task
+            if discover:
+                self.discover_old_tasks()
         except Exception as err:
             self.event_delegate.on_connection_failed(err)
         return self.conn is not None
 
+    def evict_resources(self) -> None:
+        # Evict, on a worker thread, the resource cache files older than
+        # resource_cache_max_age that neither the index nor the tasks of
+        # this session reference, nor were used by a task of the index
+        # within resource_cache_max_age
+        max_age = self.resource_cache_max_age
+        referenced = set(self.index.resource_keys(
+            time() - max_age.total_seconds())) \
+            if self.index is not None else set()
+        for t in self.tasks.values():
+            referenced.update(t.cache_keys)
+        cache = self.resource_cache
+
+        def evict():
+            try:
+                evicted = cache.evict(referenced, max_age)
+            except Exception as err:
+                App.Console.PrintWarning(
+                    f'Unable to clean the resource cache up : {err}\n')
+                return
+            if evicted:
+                App.Console.PrintMessage(
+                    f'{evicted} old files removed from the resource cache\n')
+        threading.Thread(target=evict, name='qarnot-cache-eviction',
+                         daemon=True).start()
+
+    def load_index(self) -> None:
+        # Add the tasks recorded in the index to old_tasks. Their qarnot
+        # task is attached when discovery lists them or fetched when needed
+        for entry in self.index.entries():
+            if entry.uuid in self.tasks or entry.uuid in self.old_tasks:
+                continue
+            old_task = QarnotOldFemTask(None, entry)
+            if old_task.complete:
+                self._add_old_task(old_task)
+            else:
+                # Indexed before tasks that cannot be retrieved (e.g
+                # packed tasks) were left out of the index
+                self.index.remove(entry.uuid)
+
+    def discover_old_tasks(self) -> None:
+        # Start listing previous tasks page by page on a worker thread.
+        # Each page's tasks are added to old_tasks and sent with
+        # on_old_tasks_found as actualize_tasks is called, then
+        # on_old_tasks_discovered is sent once the listing is over
+        # With an index, only the tasks created since the newest indexed
+        # one are listed, the others are loaded from the index
+        if self.discovery is not None:
+            self.discovery.cancel()
+        since = None
+        if self.index is not None:
+            since = self.index.newest_creation_date()
+        self.discovery = OldTaskDiscovery(
+            self.conn, self._on_old_tasks_found, self._on_discovery_done,
+            self.old_tasks_window, since=since)
+        self.discovery.start()
+
     def start_fem(self, solver, name: str = '',
-                  working_dir: str = None) -> None:
-        # Start a fem calculation. If no name is given,
-        # an arbitrary name based on launch time will be given
+                  working_dir: str = None,
+                  result_patterns: Optional[List[str]] = None,
+                  backend: Optional[SolverBackend] = None) \
+            -> Optional[QarnotSubmission]:
+        # Queue a fem calculation and return its submission handle, or None
+        # if the task could not be created. If no name is given, an
+        # arbitrary name based on launch time will be given.
+        # result_patterns overrides the result files to download (see
+        # femtask.RESULT_PATTERNS), ['*'] downloads all of them and
+        # backend the solver and threads of CalculiX and Z88, chosen from
+        # the size of the model if not given (see backend.select_backend)
+        # The task is written, uploaded and submitted on a worker thread,
+        # on_task_submitted is sent once it is computing
         if name is None or name == '':
             name = f'{solver.Label}_{strftime("%H.%M.%S", localtime())}'
         if self.conn is None:
             raise RuntimeError('Connection with Qarnot ' +
                                'has not been established yet\n')
-        t = None
         try:
             t = QarnotFemTask(solver, name, working_dir)
         except Exception as err:
             App.Console.PrintError(err)
+            return None
+        t.backend = backend
+        return self._queue_task(t, result_patterns)
+
+    def estimate_solver(self, solver) -> Optional[RunEstimate]:
+        # Estimate the run time and peak memory of a solver's analysis
+        # from the size of its mesh, before its inputs are written, e.g
+        # when the solver is selected. None if the analysis has no mesh.
+        # Tasks are estimated again from their written inputs
+        analysis = solver.getParentGroup()
+        if analysis is None:
+            return None
+        meshes = [obj for obj in analysis.Group
+                  if obj.isDerivedFrom('Fem::FemMeshObject')]
+        if not len(meshes):
+            return None
+        solver_type = solver_type_of(solver)
+        return self.estimator.estimate(
+            solver_type, fem_mesh_stats(meshes[0].FemMesh, solver_type))
+
+    def start_fems(self, solvers: List, working_dir: str = None) \
+            -> List[QarnotSubmission]:
+        # Queue a fem calculation for each solver. Tasks are named after
+        # their solver. Return the submission handles of queued tasks
+        submissions = []
+        for solver in solvers:
+            submission = self.start_fem(solver, '', working_dir)
+            if submission is not None:
+                submissions.append(submission)
+        return submissions
+
+    def start_sweep(self, solver, variants: List[Dict[str, Any]],
+                    name: str = '', working_dir: str = None,
+                    result_patterns: Optional[List[str]] = None,
+                    pack: bool = False,
+                    backend: Optional[SolverBackend] = None) -> QarnotSweep:
+        # Queue a fem calculation for each variant of the solver's analysis
+        # and return the sweep tracking them. A variant is a dict of
+        # property overrides, e.g {'Mesh.CharacteristicLengthMax': 2.}
+        # (see sweep.DocumentOverrides). Variants are written one at a
+        # time by process_events, since writing modifies the document, and
+        # are then uploaded and submitted on worker threads. Each variant
+        # gets a directory named after it in working_dir, or a temporary
+        # directory if working_dir is not given. If pack is set, the
+        # variants are computed by a single multi-instance task, submitted
+        # once they are all written (see packing.QarnotPackedFemTask).
+        # backend is that of every variant, see start_fem
+        if name is None or name == '':
+            name = f'{solver.Label}_{strftime("%H.%M.%S", localtime())}'
+        if self.conn is None:
+            raise RuntimeError('Connection with Qarnot ' +
+                               'has not been established yet\n')
+        sweep = QarnotSweep(name, solver, variants, working_dir, pack)
+        sweep.backend = backend
+        self.sweeps.append(sweep)
+        self.post_event(self._write_next_variant, sweep, result_patterns)
+        return sweep
+
+    def load_sweep(self, sweep: QarnotSweep) -> None:
+        # Load results from all finished tasks of a sweep
+        if sweep.pack:
+            t = sweep.packed_task
+            if t is not None and t.state == FemState.FINISHED:
+                self.load_results([t.uuid])
             return
-        try:
-            t.run(self.conn)
-            if t is not None and t.state == FemState.COMPUTING:
-                self.tasks[t.uuid] = t
-                self.event_delegate.on_task_submitted(t.uuid)
-        except Exception as err:
-            App.Console.PrintError(err)
-            del t
+        self.load_results(
+            [t.uuid for t in sweep.list_task([FemState.FINISHED])])
+
+    def delete_sweep(self, sweep: QarnotSweep) -> None:
+        # Stop writing a sweep's variants, cancel queued submissions
+        # and delete its tasks
+        sweep.next_variant = len(sweep.variants)
+        for submission in sweep.submissions:
+            if submission is not None:
+                submission.cancel()
+        for t in sweep.list_task() + [sweep.packed_task]:
+            if t is not None and t.uuid in self.tasks:
+                self.delete_task(t.uuid)
+        if sweep in self.sweeps:
+            self.sweeps.remove(sweep)
 
     def load_result(self, uuid: str) -> None:
         # Load result from task
-        self.tasks[uuid].load_result()
+        t = self.tasks[uuid]
+        with t.trace.span(TaskPhase.LOADING):
+            t.load_result()
+        self._record_state(self.tasks[uuid])
         self.event_delegate.on_task_loaded(uuid)
 
+    def load_results(self, uuids: List[str]) -> None:
+        # Load results from several tasks at once. Recomputes of their
+        # documents are frozen until all results are loaded, then each
+        # document is recomputed once and on_task_loaded is sent for each
+        # loaded task
+        tasks = [self.tasks[uuid] for uuid in uuids]
+        docs = {t.solver.Document.Name: t.solver.Document for t in tasks}
+        loaded = []
+        with recomputes_frozen(docs.values()):
+            for t in tasks:
+                try:
+                    with t.trace.span(TaskPhase.LOADING):
+                        t.load_result()
+                except Exception as err:
+                    App.Console.PrintError(
+                        f'Unable to load task {t.name} results : {err}\n')
+                    continue
+                loaded.append(t)
+        for t in loaded:
+            self._record_state(t)
+            self.event_delegate.on_task_loaded(t.uuid)
+
     def load_all(self) -> None:
         # Load results from all tasks in LOADING states
         task_to_load = self.list_task([FemState.FINISHED])
-        for task in task_to_load:
-            self.load_result(task.uuid)
+        self.load_results([task.uuid for task in task_to_load])
 
     def delete_task(self, uuid: str) -> None:
         # Abort if needed and deletes task or old task
@@ -114,8 +424,17 @@ class QarnotController(QtCore.QObject):
             t = self.tasks[uuid]
         elif uuid in self.old_tasks:
             t = self.old_tasks[uuid]
+            if not self.fetch_old_task(t):
+                return
         else:
             return
+        self.cancel_download(uuid)
+        stream = self.log_streams.pop(uuid, None)
+        if stream is not None:
+            stream.cancel()
+        self.task_outputs.pop(uuid, None)
+        self.progress_parsers.pop(uuid, None)
+        self.output_poller.forget(uuid)
         try:
             t.task.abort()
         except qarnot.exceptions.QarnotGenericException:
@@ -126,33 +445,412 @@ class QarnotController(QtCore.QObject):
         finally:
             t.delete()
             del t
+            self.poll_scheduler.remove(uuid)
+            if self.index is not None:
+                self.index.remove(uuid)
             if uuid in self.tasks:
                 self.tasks.pop(uuid)
             elif uuid in self.old_tasks:
-                self.old_tasks.pop(uuid)
+                self._remove_old_task(uuid)
             self.event_delegate.on_task_deleted(uuid)
 
     def actualize_tasks(self) -> None:
-        # Call tasks wait callbacks and check if states have changed
-        for t in self.list_task():
-            if t.state != FemState.COMPUTING:
-                continue
-            t.wait_callback()
-            if t.state == FemState.FINISHED:
-                self.event_delegate.on_task_finished(t.uuid)
+        # Dispatch worker threads events and, if the poll scheduler says a
+        # task's check is due, refresh computing tasks states and send
+        # events for tasks that are done. It is cheap to call often, see
+        # time_to_next_check
+        self.process_events()
+        computing = self.list_task([FemState.COMPUTING])
+        for t in computing:
+            if t.uuid not in self.poll_scheduler:
+                self.poll_scheduler.add(t.uuid)
+        if len(self.poll_scheduler.due()):
+            self.refresh_tasks(computing)
+
+    def time_to_next_check(self) -> Optional[float]:
+        # Return the time in seconds before actualize_tasks has something
+        # to do (0 if it already has), or None if nothing is computing
+        if len(self.submission_queue.pending()) or not self._events.empty():
+            return 0.
+        if self.discovery is not None and self.discovery.running:
+            return 0.
+        if len(self.list_task([FemState.DOWNLOADING])):
+            return 0.
+        if not self.is_computing():
+            return None
+        if len(self.list_task([FemState.COMPUTING])) > \
+                len(self.poll_scheduler):
+            # Some tasks are not scheduled yet
+            return 0.
+        return max(self.poll_scheduler.time_to_next_check() or 0., 0.)
+
+    def refresh_tasks(self, tasks: List[QarnotFemTask]) -> None:
+        # Refresh the given computing tasks with a single task listing
+        # instead of one request per task. The listing is made by the
+        # state lister's worker thread, which stops once it listed the
+        # tasks, and applied by _handle_states_listed. Does nothing while
+        # a listing is running, due tasks stay due until it is applied
+        tasks = [t for t in tasks
+                 if t.state == FemState.COMPUTING and t.task is not None]
+        if not len(tasks):
+            return
+        dates = [t.task.creation_date for t in tasks
+                 if t.task.creation_date is not None]
+        due = set(self.poll_scheduler.due())
+        if self.state_lister.list(self.conn, {t.uuid for t in tasks},
+                                  min(dates, default=None)):
+            self._listing_due = due
+
+    def _on_states_listed(self, uuids: Set[str], snapshots: Dict[str, Task],
+                          error: Optional[Exception]) -> None:
+        # Called from the state lister's worker thread
+        self.post_event(self._handle_states_listed, uuids, snapshots, error)
+
+    def _handle_states_listed(self, uuids: Set[str],
+                              snapshots: Dict[str, Task],
+                              error: Optional[Exception]) -> None:
+        # Tasks missing from the listing fall back to their own wait
+        # callback. The stdout of tasks whose check was due is then
+        # fetched to parse their progress, see track_progress
+        tasks = [self.tasks[uuid] for uuid in uuids
+                 if uuid in self.tasks and
+                 self.tasks[uuid].state == FemState.COMPUTING]
+        if error is not None:
+            App.Console.PrintWarning(
+                f'Unable to list the computing tasks : {error}\n')
+            for t in tasks:
+                self.poll_scheduler.postpone(t.uuid)
+            return
+        for t in tasks:
+            if t.uuid in snapshots:
+                t.update_callback(snapshots[t.uuid])
+                q_state = snapshots[t.uuid].state
+            else:
+                t.wait_callback()
+                q_state = None
+            if t.state == FemState.COMPUTING:
+                self.poll_scheduler.checked(t.uuid, q_state)
+            else:
+                self.poll_scheduler.remove(t.uuid)
+                self._record_state(t)
+            if t.state == FemState.DOWNLOADING:
+                self.start_download(t)
             elif t.state == FemState.ERROR:
                 self.event_delegate.on_task_failed(t.uuid)
+        self.output_poller.poll(
+            [(t.task, self._task_output(t.uuid)) for t in tasks
+             if t.uuid in self._listing_due and
+             t.state == FemState.COMPUTING and
+             t.uuid in self.progress_parsers and
+             not self._streaming(t.uuid)])
+
+    def start_download(self, t: QarnotFemTask) -> None:
+        # Queue the download of a task's results. The task is FINISHED
+        # once its results are downloaded
+        self._record_runs(t)
+        t.trace.begin(TaskPhase.DOWNLOADING)
+        self.download_queue.download(t.uuid, t.task.results, t.working_dir,
+                                     t.result_patterns)
+        self._record_state(t)
+        self.event_delegate.on_task_downloading(t.uuid)
+
+    def cancel_download(self, uuid: str) -> None:
+        # Cancel the download of a task's results. The task is put in
+        # ERROR state once the download is stopped
+        if self.download_queue is not None:
+            self.download_queue.cancel(uuid)
+
+    def shutdown(self) -> None:
+        # Cancel queued submissions and downloads and stop worker threads
+        self.submission_queue.shutdown()
+        if self.discovery is not None:
+            self.discovery.cancel()
+        for stream in self.log_streams.values():
+            stream.cancel()
+        self.state_lister.shutdown()
+        self.output_poller.shutdown()
+        if self.download_queue is not None:
+            self.download_queue.shutdown()
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    #
+    # Worker threads events
+    #
+    def post_event(self, callback: Callable, *args) -> None:
+        # Queue a call to be made by process_events. Can be called from
+        # any thread
+        self._events.put((callback, args))
+
+    def process_events(self) -> None:
+        # Make the calls posted by worker threads, in order. Calls posted
+        # while processing are made by the next process_events
+        for _ in range(self._events.qsize()):
+            try:
+                callback, args = self._events.get_nowait()
+            except Empty:
+                return
+            callback(*args)
+
+    def _queue_task(self, t: QarnotFemTask,
+                    result_patterns: Optional[List[str]] = None) \
+            -> QarnotSubmission:
+        t.resource_cache = self.resource_cache
+        t.compress_inputs = self.compress_inputs
+        t.mpi = self.use_mpi
+        t.estimator = self.estimator
+        t.profiles = self.profiles
+        if result_patterns is not None:
+            t.result_patterns = result_patterns
+        writing = self.submission_queue.writes_pending()
+        submission = self.submission_queue.submit(t, self.conn)
+        if not writing:
+            self.post_event(self._write_submissions)
+        self.event_delegate.on_submission_progress(
+            submission, SubmissionPhase.QUEUED)
+        return submission
+
+    def _write_submissions(self) -> None:
+        # Write queued submissions' inputs, in order, for at most
+        # WRITE_TIME_SLICE seconds, then post the writing of the following
+        # ones so that other events are processed in between
+        end = monotonic() + WRITE_TIME_SLICE
+        while self.submission_queue.write_next():
+            if not self.submission_queue.writes_pending():
+                return
+            if monotonic() >= end:
+                self.post_event(self._write_submissions)
+                return
+
+    def _write_next_variant(self, sweep: QarnotSweep,
+                            result_patterns: Optional[List[str]]) -> None:
+        # Write the next variant of a sweep and queue its submission, then
+        # post the writing of the following one so that other events are
+        # processed in between
+        if sweep.written:
+            return
+        i = sweep.next_variant
+        sweep.next_variant += 1
+        doc = sweep.solver.Document
+        t = None
+        try:
+            with write_lock, DocumentOverrides(doc, sweep.variants[i]):
+                t = QarnotFemTask(sweep.solver, sweep.variant_name(i),
+                                  sweep.make_variant_dir(i))
+                t.backend = sweep.backend
+                written = t.prepare()
+        except Exception as err:
+            App.Console.PrintError(
+                f'Unable to write variant {sweep.variant_name(i)} : {err}\n')
+            written = False
+        if written and sweep.pack:
+            sweep.members[i] = t
+        elif written:
+            sweep.submissions[i] = self._queue_task(t, result_patterns)
+        elif t is not None:
+            t.display_report()
+        if not sweep.written:
+            self.post_event(self._write_next_variant, sweep, result_patterns)
+        elif sweep.pack:
+            self._queue_pack(sweep, result_patterns)
+
+    def _queue_pack(self, sweep: QarnotSweep,
+                    result_patterns: Optional[List[str]]) -> None:
+        # Queue the submission of the task computing a packed sweep's
+        # written variants
+        members = sweep.list_task()
+        if not len(members):
+            return
+        for member in members:
+            member.mpi = self.use_mpi
+        try:
+            t = QarnotPackedFemTask(members, sweep.name,
+                                    sweep.make_pack_dir())
+        except Exception as err:
+            App.Console.PrintError(
+                f'Unable to pack sweep {sweep.name} : {err}\n')
+            return
+        sweep.packed_task = t
+        submission = self._queue_task(t, result_patterns)
+        sweep.submissions = [None if member is None else submission
+                             for member in sweep.members]
+
+    def _on_submission_progress(self, submission: QarnotSubmission) -> None:
+        # Called from submission worker threads
+        self.post_event(self._handle_submission_progress,
+                        submission, submission.phase)
+
+    def _on_upload_progress(self, submission: QarnotSubmission) -> None:
+        # Called from submission worker threads
+        self.post_event(self.event_delegate.on_upload_progress, submission,
+                        submission.uploaded, submission.upload_size)
+
+    def _handle_submission_progress(self, submission: QarnotSubmission,
+                                    phase: SubmissionPhase) -> None:
+        t = submission.fem_task
+        if phase == SubmissionPhase.SUBMITTED:
+            self.tasks[t.uuid] = t
+            self._index_task(t)
+            self._trace_task(t)
+        elif phase == SubmissionPhase.FAILED:
+            t.display_report()
+        self.event_delegate.on_submission_progress(submission, phase)
+        if phase == SubmissionPhase.SUBMITTED:
+            self.track_progress(t)
+            self.event_delegate.on_task_submitted(t.uuid)
+
+    def _on_download_done(self, uuid: str,
+                          error: Optional[Exception]) -> None:
+        # Called from download worker threads
+        self.post_event(self._handle_download_done, uuid, error, time())
+
+    def _handle_download_done(self, uuid: str, error: Optional[Exception],
+                              end: Optional[float] = None) -> None:
+        if uuid not in self.tasks:
+            # Task was deleted during the download
+            return
+        t = self.tasks[uuid]
+        t.trace.end(TaskPhase.DOWNLOADING, end)
+        if error is None and isinstance(t, QarnotPackedFemTask):
+            try:
+                if not t.split_results():
+                    error = RuntimeError('no instance produced results')
+            except OSError as err:
+                error = err
+        if error is None:
+            t.state = FemState.FINISHED
+            self._record_state(t)
+            if self.index is not None:
+                self.index.record_results(uuid, t.working_dir)
+            self.event_delegate.on_task_finished(uuid)
+            return
+        if isinstance(error, DownloadCancelled):
+            App.Console.PrintWarning(
+                f'Download of task {t.name} results cancelled\n')
+        else:
+            App.Console.PrintError(
+                f'Unable to download task {t.name} results : {error}\n')
+        t.state = FemState.ERROR
+        self._record_state(t)
+        self.event_delegate.on_task_failed(uuid)
+
+    def _on_old_tasks_found(self, old_tasks: List[QarnotOldFemTask]) -> None:
+        # Called from the discovery worker thread
+        self.post_event(self._handle_old_tasks_found, old_tasks)
+
+    def _on_discovery_done(self, error: Optional[Exception]) -> None:
+        # Called from the discovery worker thread
+        self.post_event(self._handle_discovery_done, error)
+
+    def _handle_old_tasks_found(self,
+                                old_tasks: List[QarnotOldFemTask]) -> None:
+        uuids = []
+        for old_task in old_tasks:
+            if old_task.uuid in self.tasks:
+                continue
+            if self.index is not None:
+                self.index.record_task(
+                    old_task.uuid, old_task.name,
+                    old_task.utc_creation_date, old_task.constants,
+                    old_task.task.state)
+            known = self.old_tasks.get(old_task.uuid)
+            if known is None:
+                self._add_old_task(old_task)
+            elif known.task is None:
+                # Loaded from the index
+                known.task = old_task.task
+            else:
+                # Found by a previous discovery
+                continue
+            uuids.append(old_task.uuid)
+        if len(uuids):
+            self.event_delegate.on_old_tasks_found(uuids)
+
+    def _handle_discovery_done(self, error: Optional[Exception]) -> None:
+        if error is not None and not isinstance(error, DiscoveryCancelled):
+            App.Console.PrintError(
+                f'Unable to list previous tasks : {error}\n')
+        elif error is None:
+            # Indexed tasks the listing should have found were deleted
+            since = self.discovery.since
+            for uuid, old_task in list(self.old_tasks.items()):
+                if old_task.task is None and \
+                        (since is None or old_task.utc_creation_date >= since):
+                    self._forget_old_task(uuid)
+        self.event_delegate.on_old_tasks_discovered()
+
+    def _index_task(self, t: QarnotFemTask) -> None:
+        # Tasks that cannot be retrieved (e.g packed tasks, which have no
+        # FREECAD_* constants) are not indexed
+        if self.index is None or not QarnotOldFemTask.is_complete(t.task):
+            return
+        creation_date = t.task.creation_date or datetime.utcnow()
+        self.index.record_task(t.uuid, t.name, creation_date,
+                               t.task.constants, t.state.name)
+        if len(t.cache_keys):
+            self.index.record_resources(t.uuid, t.cache_keys)
+
+    def _record_runs(self, t: QarnotFemTask) -> None:
+        # Add the measured runs of a task, or of a packed task's members,
+        # to the estimator's samples and to the index
+        runs = t.members if isinstance(t, QarnotPackedFemTask) else [t]
+        for run in runs:
+            if run.mesh_stats is None or not run.run_time:
+                continue
+            self.estimator.add(RunSample(run.solver_type, run.mesh_stats,
+                                         run.run_time, run.peak_memory_mb))
+            if self.index is not None:
+                self.index.record_run(
+                    t.uuid, run.solver_type.name, run.mesh_stats.nodes,
+                    run.mesh_stats.elements, run.mesh_stats.dofs,
+                    run.run_time, run.peak_memory_mb)
+
+    def _trace_task(self, t: QarnotFemTask) -> None:
+        self.traces[t.uuid] = TraceRecord(t.uuid, t.name,
+                                          t.solver_type.name, t.trace)
+
+    def _record_state(self, t: QarnotFemTask) -> None:
+        if self.index is not None:
+            self.index.record_state(t.uuid, t.state.name)
+
+    def _forget_old_task(self, uuid: str) -> None:
+        # Remove an old task that no longer exists on qarnot
+        self._remove_old_task(uuid)
+        if self.index is not None:
+            self.index.remove(uuid)
+        self.event_delegate.on_task_deleted(uuid)
 
     #
     # Infos and general methods
     #
     def is_computing(self) -> bool:
-        # Returns if at least one task is currently computing
+        # Returns if at least one task is currently computing, waiting to
+        # be submitted or downloading its results
+        if len(self.submission_queue.pending()) or not self._events.empty():
+            return True
+        if self.discovery is not None and self.discovery.running:
+            return True
         for t in self.list_task():
-            if t.state == FemState.COMPUTING:
+            if t.state in (FemState.COMPUTING, FemState.DOWNLOADING):
                 return True
         return False
 
+    def timings(self, uuids: Optional[List[str]] = None) \
+            -> List[TraceRecord]:
+        # Return the phase timings of the given tasks, or of all the tasks
+        # submitted or retrieved in this session, deleted ones included
+        if uuids is None:
+            return list(self.traces.values())
+        return [self.traces[uuid] for uuid in uuids if uuid in self.traces]
+
+    def export_timings(self, path: str, chrome: bool = False,
+                       uuids: Optional[List[str]] = None) -> None:
+        # Write the phase timings of tasks (see timings) to path as JSON
+        # with a summary per phase, or in the Chrome trace event format if
+        # chrome is set
+        write_traces(self.timings(uuids), path, chrome)
+
     def list_task(self, states: Optional[List[FemState]] = None) \
             -> List[QarnotFemTask]:
         # Return the list of task that are in the given state,
@@ -167,7 +865,9 @@ class QarnotController(QtCore.QObject):
     def find_old_tasks(self) -> List[Task]:
         # Return the list of tasks that were sent with the 'FreeCAD macro'
         # tag but are not in the current dictionnary, e.g task that were
-        # presumably sent by previous occurrences of the macro
+        # presumably sent by previous occurrences of the macro.
+        # This lists all tasks at once, discover_old_tasks does it in the
+        # background
         old = []
         for task in self.conn.tasks(['FreeCAD macro']):
             if task.uuid not in self.tasks:
@@ -175,35 +875,43 @@ class QarnotController(QtCore.QObject):
         return old
 
     @staticmethod
-    def retrieve_solver(task: QarnotOldFemTask) -> App.DocumentObject:
+    def retrieve_solver(task: QarnotOldFemTask,
+                        documents: Optional[Dict[str, App.Document]] = None) \
+            -> App.DocumentObject:
         # Try to retrieve solver from tasks constants and returns
-        # the solver or None
+        # the solver or None. documents maps open documents' paths to
+        # documents, open documents are listed if it is not given
         if not task.complete:
             return None
-        doc = None
-        for d in App.listDocuments().values():
-            if d.FileName == task.document_path:
-                doc = d
+        if documents is None:
+            documents = {d.FileName: d
+                         for d in App.listDocuments().values()}
+        doc = documents.get(task.document_path)
         if doc is None:
             return None
         return doc.getObject(task.solver_name)
 
     @staticmethod
-    def is_retrievable(task: QarnotOldFemTask) -> bool:
+    def is_retrievable(task: QarnotOldFemTask,
+                       documents: Optional[Dict[str, App.Document]] = None) \
+            -> bool:
         # Tells if the task is retrievable which is the case if:
         #   - the task has the correct constants
         #   - the document used to send the task is open and has not moved
         #   - the solver used is still presents
         if not task.complete:
             return False
-        solver = QarnotController.retrieve_solver(task)
+        solver = QarnotController.retrieve_solver(task, documents)
         return solver is not None
 
     @staticmethod
-    def create_fem_task_from_old(task: QarnotOldFemTask) -> QarnotFemTask:
-        if not QarnotController.is_retrievable(task):
+    def create_fem_task_from_old(task: QarnotOldFemTask,
+                                 solver: App.DocumentObject = None) \
+            -> QarnotFemTask:
+        if solver is None:
+            solver = QarnotController.retrieve_solver(task)
+        if solver is None:
             raise RuntimeError("task is not complete")
-        solver = QarnotController.retrieve_solver(task)
         t = QarnotFemTask(solver, task.name, task.working_dir)
         q_task = task.task
         t.task = q_task
@@ -213,17 +921,178 @@ class QarnotController(QtCore.QObject):
             t.ccx.inp_file_name = task.ccx_inp_filename
         return t
 
+    def fetch_old_task(self, task: QarnotOldFemTask) -> bool:
+        # Fetch the qarnot task of an old task loaded from the index, if
+        # needed. Return wether the old task has its qarnot task. Tasks
+        # that no longer exist on qarnot are removed
+        if task.task is not None:
+            return True
+        if self.conn is None:
+            return False
+        try:
+            task.task = self.conn.retrieve_task(task.uuid)
+        except MissingTaskException:
+            self._forget_old_task(task.uuid)
+            return False
+        return True
+
+    def log_stream(self, task: Task, follow: bool = True) \
+            -> TaskLogStream:
+        # Return the stream fetching a task's stdout and stderr, started
+        # if the task has none. Qarnot sends fresh output once, so a task
+        # has a single stream, shared by the log windows, and its output
+        # read so far is kept for the next streams. While it runs, the
+        # task's progress is parsed from it instead of being polled
+        stream = self.log_streams.get(task.uuid)
+        if stream is None or stream.done or stream.cancelled:
+            stream = TaskLogStream(task, follow,
+                                   output=self._task_output(task.uuid))
+            self.log_streams[task.uuid] = stream
+            if task.uuid in self.progress_parsers:
+                self._parse_stream(task.uuid, stream)
+            stream.start()
+        return stream
+
+    def _task_output(self, uuid: str) -> TaskOutput:
+        if uuid not in self.task_outputs:
+            self.task_outputs[uuid] = TaskOutput()
+        return self.task_outputs[uuid]
+
+    def _parse_stream(self, uuid: str, stream: TaskLogStream) -> None:
+        # Parse the progress from the stream while it is open. It reads
+        # the fresh output the poller would, into the same TaskOutput, and
+        # the poller goes on with what is written once the stream is over
+
+        def on_output(name: str, text: str) -> None:
+            if name == 'stdout':
+                self._on_task_output(uuid, text)
+
+        stream.subscribe(on_output, lambda error: None, passive=True)
+
+    def _streaming(self, uuid: str) -> bool:
+        stream = self.log_streams.get(uuid)
+        return stream is not None and stream.follow and stream.running \
+            and not stream.cancelled
+
+    def track_progress(self, t: QarnotFemTask) -> None:
+        # Parse a computing task's stdout, see progress.py. The output of
+        # the computing tasks is fetched by a single worker thread as
+        # their state checks are due, or read from their log stream if
+        # one is open. t.progress is updated and on_task_progress sent as
+        # actualize_tasks is called
+        # Instances of packed tasks share the stdout, it cannot be parsed
+        if isinstance(t, QarnotPackedFemTask):
+            return
+        parser = create_progress_parser(t.solver_type, t.working_dir,
+                                        t.file)
+        if parser is None or t.task is None:
+            return
+        self.progress_parsers[t.uuid] = parser
+
+    def _on_task_output(self, uuid: str, text: str) -> None:
+        # Called from the output poller's or a log stream's worker thread
+        parser = self.progress_parsers.get(uuid)
+        if parser is None:
+            return
+        with self._progress_lock:
+            changed = parser.feed(text)
+            progress = parser.progress()
+        if changed:
+            self.post_event(self._handle_progress, uuid, progress)
+
+    def _handle_progress(self, uuid: str, progress: TaskProgress) -> None:
+        if uuid not in self.tasks:
+            return
+        t = self.tasks[uuid]
+        if progress.diverging and (t.progress is None or
+                                   not t.progress.diverging):
+            App.Console.PrintWarning(
+                f'task {t.name} seems to diverge ({progress.phase})\n')
+        t.progress = progress
+        self.event_delegate.on_task_progress(uuid, progress)
+
     def retrieve_task(self, task: QarnotOldFemTask):
         # retrieve the old task and add it to the current task dictionary
-        t = QarnotController.create_fem_task_from_old(task)
+        if not self.fetch_old_task(task):
+            return
+        t = QarnotController.create_fem_task_from_old(
+            task, QarnotController.retrieve_solver(task, self.documents()))
         t.state = FemState.COMPUTING
         self.tasks[task.uuid] = t
-        self.old_tasks.pop(task.uuid)
+        self._remove_old_task(task.uuid)
+        self._trace_task(t)
         t.wait_callback()
+        self._index_task(t)
+        if t.state == FemState.COMPUTING:
+            self.track_progress(t)
         self.event_delegate.on_task_retrieved(task.uuid)
+        if t.state == FemState.DOWNLOADING:
+            self.start_download(t)
 
-    def retrieve_all(self):
-        for key in list(self.old_tasks.keys()):
-            task = self.old_tasks[key]
-            if QarnotController.is_retrievable(task):
+    def retrieve_all(self, uuids: Optional[List[str]] = None):
+        # Retrieve the given old tasks, or all of them, that are
+        # retrievable. Retrieving all of them also rebuilds the document
+        # index, in case documents were opened without update_document
+        if uuids is None:
+            uuids = list(self.old_tasks.keys())
+            self._documents = None
+        documents = self.documents()
+        for key in uuids:
+            task = self.old_tasks.get(key)
+            if (task is not None and
+                    QarnotController.is_retrievable(task, documents)):
                 self.retrieve_task(task)
+
+    def retrieve_document(self, doc: App.Document) -> None:
+        # Update the document index and retrieve the old tasks sent from
+        # doc that are retrievable. To be called when a document is
+        # opened, saved or gets a solver
+        self.update_document(doc)
+        uuids = self._old_tasks_by_document.get(doc.FileName)
+        if uuids:
+            self.retrieve_all(list(uuids))
+
+    def documents(self) -> Dict[str, App.Document]:
+        # Return open documents by path. The index is built on first use
+        # and must then be kept up to date with update_document and
+        # remove_document
+        if self._documents is None:
+            self._documents = {}
+            self._document_paths = {}
+            for doc in App.listDocuments().values():
+                self.update_document(doc)
+        return self._documents
+
+    def update_document(self, doc: App.Document) -> None:
+        # Add or update a document in the document index, e.g when it
+        # is opened or saved under another path
+        if self._documents is None:
+            return
+        self.remove_document(doc)
+        if doc.FileName:
+            self._documents[doc.FileName] = doc
+            self._document_paths[doc.Name] = doc.FileName
+
+    def remove_document(self, doc: App.Document) -> None:
+        # Remove a closed document from the document index
+        if self._documents is None:
+            return
+        path = self._document_paths.pop(doc.Name, None)
+        if path is not None:
+            self._documents.pop(path, None)
+
+    def _add_old_task(self, old_task: QarnotOldFemTask) -> None:
+        self.old_tasks[old_task.uuid] = old_task
+        if old_task.complete:
+            self._old_tasks_by_document.setdefault(
+                old_task.document_path, set()).add(old_task.uuid)
+
+    def _remove_old_task(self, uuid: str) -> None:
+        old_task = self.old_tasks.pop(uuid, None)
+        if old_task is None or not old_task.complete:
+            return
+        uuids = self._old_tasks_by_document.get(old_task.document_path)
+        if uuids is not None:
+            uuids.discard(uuid)
+            if not len(uuids):
+                del self._old_tasks_by_document[old_task.document_path]
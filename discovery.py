@@ -0,0 +1,103 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import threading
+from typing import Callable, List, Optional
+
+import qarnot
+
+from femtask import QarnotOldFemTask
+
+
+class DiscoveryCancelled(Exception):
+    pass
+
+
+class OldTaskDiscovery():
+    # Lists the tasks tagged 'FreeCAD macro' page by page on a worker
+    # thread, so that accounts with a long history do not freeze the
+    # caller. Tasks created more than window ago and tasks missing the
+    # constants needed to retrieve them are skipped. qarnot's listing
+    # cannot be filtered by date, but once it is seen to list tasks
+    # newest first, it stops at the first page entirely older than the
+    # window instead of fetching the rest of the history.
+    # notify_page is called with the old tasks of each page and
+    # notify_done once the listing is over, with the error that stopped
+    # it or None. They are called from the worker thread and should only
+    # hand over the event, e.g to QarnotController.post_event
+
+    def __init__(self, conn: qarnot.Connection,
+                 notify_page: Callable[[List[QarnotOldFemTask]], None],
+                 notify_done: Callable[[Optional[Exception]], None],
+                 window: Optional[timedelta] = None,
+                 page_size: int = 50,
+                 since: Optional[datetime] = None) -> None:
+        self.conn = conn
+        self.notify_page = notify_page
+        self.notify_done = notify_done
+        self.window = window
+        self.page_size = page_size
+        # Tasks created before since, or more than window ago, are
+        # skipped. It is a naive UTC date, like task creation dates, or
+        # None
+        self.since: Optional[datetime] = since
+        if window is not None:
+            start = datetime.utcnow() - window
+            self.since = start if since is None else max(since, start)
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='qarnot-discovery')
+        self.future: Optional[Future] = None
+        self._cancelled = threading.Event()
+
+    def start(self) -> None:
+        self.future = self.executor.submit(self._run)
+        self.executor.shutdown(wait=False)
+
+    def cancel(self) -> None:
+        # Stop the listing after the current page
+        self._cancelled.set()
+
+    @property
+    def running(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def _run(self) -> None:
+        error = None
+        try:
+            self._list_pages()
+        except Exception as err:
+            error = err
+        self.notify_done(error)
+
+    def _list_pages(self) -> None:
+        since = self.since
+        token = None
+        # Creation date of the last task listed, and wether tasks were
+        # listed newest first so far, None until dates differ
+        previous: Optional[datetime] = None
+        newest_first: Optional[bool] = None
+        while True:
+            if self._cancelled.is_set():
+                raise DiscoveryCancelled()
+            page = self.conn.tasks_page(token, self.page_size,
+                                        tags=['FreeCAD macro'])
+            old_tasks = [QarnotOldFemTask(task) for task in page.page_data
+                         if since is None or task.creation_date >= since]
+            old_tasks = [t for t in old_tasks if t.complete]
+            if len(old_tasks):
+                self.notify_page(old_tasks)
+            if not page.is_truncated or page.next_token is None:
+                return
+            dates = [task.creation_date for task in page.page_data
+                     if task.creation_date is not None]
+            for date in dates:
+                if previous is not None and date != previous:
+                    if newest_first is None:
+                        newest_first = date < previous
+                    elif newest_first != (date < previous):
+                        # Not sorted by date, every page must be listed
+                        newest_first = False
+                previous = date
+            if (since is not None and newest_first and len(dates) and
+                    all(date < since for date in dates)):
+                return
+            token = page.next_token
@@ -0,0 +1,69 @@
+import importlib.util
+import os
+from typing import List
+import xml.etree.ElementTree as ElementTree
+
+# Directory of Elmer's executables in the docker image
+ELMER_BIN = '/usr/local/Elmer-devel/bin'
+
+
+def elmer_command(mpi: bool = False) -> str:
+    # Return the command running ElmerSolver in the case directory. With
+    # mpi, the mesh is partitioned with ElmerGrid in as many parts as the
+    # node has cores and ElmerSolver_mpi runs a process per part. Nodes
+    # with a single core run the serial solver
+    serial = f'{ELMER_BIN}/ElmerSolver'
+    if not mpi:
+        return serial
+    return (f'N=$(nproc) && if [ $N -gt 1 ]; then '
+            f'{ELMER_BIN}/ElmerGrid 2 2 . -partdual -metiskway $N && '
+            f'mpirun --allow-run-as-root -np $N '
+            f'{ELMER_BIN}/ElmerSolver_mpi; else {serial}; fi')
+
+
+def vtk_available() -> bool:
+    # Return wether VTK's python module, needed to merge partitioned
+    # results, can be imported
+    return importlib.util.find_spec('vtk') is not None
+
+
+def merge_partitions(directory: str) -> List[str]:
+    # Merge the pieces of each partitioned result (.pvtu) of directory
+    # that has no serial result (.vtu of the same name) into that serial
+    # result, which FreeCAD loads. Needs VTK's python module, without it
+    # a RuntimeError is raised and nothing is written, a single piece is
+    # not the whole result. Return the paths of the merged results
+    pvtus = [os.path.join(directory, name)
+             for name in sorted(os.listdir(directory))
+             if name.endswith('.pvtu')]
+    pvtus = [path for path in pvtus
+             if not os.path.exists(path[:-len('.pvtu')] + '.vtu')]
+    if not len(pvtus):
+        return []
+    if not vtk_available():
+        names = ', '.join(os.path.basename(pvtu) for pvtu in pvtus)
+        raise RuntimeError(
+            f'{names} are partitioned results of an MPI run, merging them '
+            f'needs VTK\'s python module (vtk), which was not found')
+    import vtk
+    merged = []
+    for pvtu in pvtus:
+        # Pieces are appended as separate inputs so that nodes on the
+        # boundaries of partitions, which are in several pieces, are
+        # merged
+        append = vtk.vtkAppendFilter()
+        append.MergePointsOn()
+        for piece in ElementTree.parse(pvtu).iter('Piece'):
+            reader = vtk.vtkXMLUnstructuredGridReader()
+            reader.SetFileName(os.path.join(os.path.dirname(pvtu),
+                                            piece.get('Source')))
+            append.AddInputConnection(reader.GetOutputPort())
+        vtu = pvtu[:-len('.pvtu')] + '.vtu'
+        writer = vtk.vtkXMLUnstructuredGridWriter()
+        writer.SetFileName(vtu)
+        writer.SetInputConnection(append.GetOutputPort())
+        if not writer.Write():
+            raise RuntimeError(f'Unable to merge {pvtu}')
+        merged.append(vtu)
+    return merged
+
@@ -0,0 +1,150 @@
+from math import exp, log
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from backend import MeshStats
+from femenums import SolverType
+
+# Number of past runs of a solver from which its model is fitted. With
+# less, the prior model's exponent is kept and only its coefficient is
+# fitted
+MIN_FIT_SAMPLES = 3
+# Bounds of the fitted exponents
+_MIN_EXPONENT = 0.
+_MAX_EXPONENT = 3.
+# Models used before any run of a solver is recorded: coefficient and
+# exponent of the power laws of the degrees of freedom giving the run
+# time in seconds and the peak memory in MB. They are rough orders of
+# magnitude for direct solvers on a few cores
+_PRIORS: Dict[SolverType, Tuple[Tuple[float, float], Tuple[float, float]]] \
+    = {
+        SolverType.CCX_TOOLS: ((1e-6, 1.4), (2e-3, 1.1)),
+        SolverType.CCX: ((1e-6, 1.4), (2e-3, 1.1)),
+        SolverType.ELMER: ((1e-5, 1.3), (5e-3, 1.)),
+        SolverType.Z88: ((1e-6, 1.4), (2e-3, 1.1)),
+    }
+# Peak memory is multiplied by it to choose a hardware profile
+MEMORY_MARGIN = 1.25
+
+
+class HardwareProfile():
+    # A qarnot profile tasks can run on and the memory of its nodes in MB
+
+    def __init__(self, name: str, memory_mb: float) -> None:
+        self.name = name
+        self.memory_mb = memory_mb
+
+    def __repr__(self) -> str:
+        return f'HardwareProfile({self.name}, {self.memory_mb} MB)'
+
+
+# The memory of docker-batch nodes is an assumption, QarnotController's
+# profiles should list those available to the account
+DEFAULT_PROFILES = [HardwareProfile('docker-batch', 16000)]
+
+
+class RunSample():
+    # A past run: the size of its model, its run time in seconds and its
+    # peak memory in MB, if known
+
+    def __init__(self, solver_type: SolverType, stats: MeshStats,
+                 run_time: float,
+                 peak_memory_mb: Optional[float] = None) -> None:
+        self.solver_type = solver_type
+        self.stats = stats
+        self.run_time = run_time
+        self.peak_memory_mb = peak_memory_mb
+
+
+class RunEstimate():
+    # Predicted run time in seconds and peak memory in MB of a task.
+    # samples is the number of past runs it is fitted on, 0 if it comes
+    # from the prior model only
+
+    def __init__(self, run_time: float, peak_memory_mb: float,
+                 samples: int) -> None:
+        self.run_time = run_time
+        self.peak_memory_mb = peak_memory_mb
+        self.samples = samples
+
+    def __repr__(self) -> str:
+        return f'RunEstimate({self.run_time:.0f} s, ' + \
+            f'{self.peak_memory_mb:.0f} MB, {self.samples} samples)'
+
+
+class RunEstimator():
+    # Predicts the run time and peak memory of tasks from the degrees of
+    # freedom of their model, with a power law per solver type fitted on
+    # past runs. Samples are added from the GUI thread and estimates are
+    # made from submission worker threads
+
+    def __init__(self, samples: Iterable[RunSample] = ()) -> None:
+        self._samples: Dict[SolverType, List[RunSample]] = {}
+        self._lock = threading.Lock()
+        for sample in samples:
+            self.add(sample)
+
+    def add(self, sample: RunSample) -> None:
+        if sample.stats.dofs <= 0 or sample.run_time <= 0:
+            return
+        with self._lock:
+            self._samples.setdefault(sample.solver_type, []).append(sample)
+
+    def samples(self, solver_type: SolverType) -> List[RunSample]:
+        with self._lock:
+            return list(self._samples.get(solver_type, []))
+
+    def estimate(self, solver_type: SolverType,
+                 stats: Optional[MeshStats]) -> Optional[RunEstimate]:
+        # Return the estimate for a model of the solver, None if its size
+        # is unknown
+        if stats is None or stats.dofs <= 0 or solver_type not in _PRIORS:
+            return None
+        samples = self.samples(solver_type)
+        time_prior, memory_prior = _PRIORS[solver_type]
+        time_law = _fit([(s.stats.dofs, s.run_time) for s in samples],
+                        time_prior)
+        memory_law = _fit([(s.stats.dofs, s.peak_memory_mb)
+                           for s in samples if s.peak_memory_mb],
+                          memory_prior)
+        return RunEstimate(_power(time_law, stats.dofs),
+                           _power(memory_law, stats.dofs), len(samples))
+
+
+def _power(law: Tuple[float, float], x: float) -> float:
+    coefficient, exponent = law
+    return coefficient * x ** exponent
+
+
+def _fit(points: List[Tuple[float, float]],
+         prior: Tuple[float, float]) -> Tuple[float, float]:
+    # Fit y = a * x ** b by least squares on logarithms. With less than
+    # MIN_FIT_SAMPLES points or a single x, b is the prior's
+    points = [(log(x), log(y)) for x, y in points if x > 0 and y > 0]
+    if not len(points):
+        return prior
+    exponent = prior[1]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if len(points) >= MIN_FIT_SAMPLES and variance > 0:
+        covariance = sum((x - mean_x) * (y - mean_y) for x, y in points)
+        exponent = min(max(covariance / variance, _MIN_EXPONENT),
+                       _MAX_EXPONENT)
+    return exp(mean_y - exponent * mean_x), exponent
+
+
+def choose_profile(estimate: Optional[RunEstimate],
+                   profiles: List[HardwareProfile]) \
+        -> Tuple[HardwareProfile, bool]:
+    # Return the profile with the least memory the estimated peak memory
+    # fits in, with MEMORY_MARGIN, and wether it fits. If it fits in none,
+    # the profile with the most memory is returned. profiles must not be
+    # empty, the first one is returned without estimate
+    if estimate is None:
+        return profiles[0], True
+    needed = estimate.peak_memory_mb * MEMORY_MARGIN
+    fitting = [p for p in profiles if p.memory_mb >= needed]
+    if len(fitting):
+        return min(fitting, key=lambda p: p.memory_mb), True
+    return max(profiles, key=lambda p: p.memory_mb), False
@@ -0,0 +1,399 @@
+from datetime import datetime, timezone
+import random
+import threading
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List, Optional, Union
+from uuid import uuid4
+
+from qarnot.exceptions import MissingTaskException, QarnotGenericException
+
+# Chunk size transfers are simulated with
+_CHUNK_SIZE = 1 << 20
+
+
+class FakeConfig():
+    # Behaviour of a FakeConnection. Times are in seconds and sizes in
+    # bytes
+    # - latency: time taken by each API request
+    # - bandwidth: bytes per second of each upload or download, None for
+    #   no limit
+    # - request_failure_rate: probability that a request raises a
+    #   QarnotGenericException
+    # - task_failure_rate: probability that a submitted task fails
+    # - task_duration: time tasks compute for, or a function of the task
+    #   returning it
+    # - result_files: name and size of the result files written by each
+    #   instance. Instances of multi-instance tasks write them in
+    #   instance_prefix, formatted with the instance id
+    # - output_interval: time between two lines written to stdout
+    # - seed: seed of the random failures
+
+    def __init__(self, latency: float = 0.,
+                 bandwidth: Optional[float] = None,
+                 request_failure_rate: float = 0.,
+                 task_failure_rate: float = 0.,
+                 task_duration: Union[float, Callable[['FakeTask'], float]]
+                 = 1.,
+                 result_files: Optional[Dict[str, int]] = None,
+                 instance_prefix: str = 'instance-{}/',
+                 output_interval: float = 0.5,
+                 seed: Optional[int] = None) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.request_failure_rate = request_failure_rate
+        self.task_failure_rate = task_failure_rate
+        self.task_duration = task_duration
+        self.result_files = result_files if result_files is not None \
+            else {'result.frd': 64 << 10, 'result.dat': 1 << 10}
+        self.instance_prefix = instance_prefix
+        self.output_interval = output_interval
+        self.seed = seed
+
+
+class FakeObject():
+    # A file listed in a bucket
+
+    def __init__(self, key: str, size: int,
+                 last_modified: datetime) -> None:
+        self.key = key
+        self.size = size
+        self.last_modified = last_modified
+
+
+class FakeBucket():
+    # A bucket of a FakeConnection. Only file sizes are kept, downloaded
+    # files are filled with zeros
+
+    def __init__(self, conn: 'FakeConnection', name: str) -> None:
+        self._conn = conn
+        self.uuid = name
+        self.files: Dict[str, int] = {}
+        # Upload dates of the files, now if missing
+        self.modified: Dict[str, datetime] = {}
+        self.filtering = None
+        self.transformation = None
+
+    def list_files(self) -> List[FakeObject]:
+        self._conn.request()
+        with self._conn.lock:
+            now = datetime.now(timezone.utc)
+            return [FakeObject(key, size, self.modified.get(key, now))
+                    for key, size in sorted(self.files.items())]
+
+    def directory(self, directory: str = '') -> List[FakeObject]:
+        return [obj for obj in self.list_files()
+                if obj.key.startswith(directory)]
+
+    def with_filtering(self, filtering: Any) -> 'FakeBucket':
+        view = self._view()
+        view.filtering = filtering
+        return view
+
+    def with_resource_transformation(self, transformation: Any) \
+            -> 'FakeBucket':
+        view = self._view()
+        view.transformation = transformation
+        return view
+
+    def delete_file(self, remote: str) -> None:
+        self._conn.request()
+        with self._conn.lock:
+            self.files.pop(remote, None)
+            self.modified.pop(remote, None)
+
+    def delete(self) -> None:
+        self._conn.request()
+        with self._conn.lock:
+            self._conn.buckets.pop(self.uuid, None)
+
+    def _view(self) -> 'FakeBucket':
+        view = FakeBucket(self._conn, self.uuid)
+        view.files = self.files
+        view.modified = self.modified
+        view.filtering = self.filtering
+        view.transformation = self.transformation
+        return view
+
+
+class FakeS3Client():
+    # The part of boto3's S3 client the macro uses, with the bandwidth
+    # of the connection's configuration
+
+    def __init__(self, conn: 'FakeConnection') -> None:
+        self._conn = conn
+
+    def upload_fileobj(self, f, bucket: str, key: str, Config=None,
+                       Callback: Optional[Callable[[int], None]] = None) \
+            -> None:
+        self._conn.request()
+        size = 0
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            self._conn.transfer(len(chunk))
+            size += len(chunk)
+            if Callback is not None:
+                Callback(len(chunk))
+        with self._conn.lock:
+            self._conn.bucket(bucket).files[key] = size
+            self._conn.bucket(bucket).modified[key] = \
+                datetime.now(timezone.utc)
+
+    def download_file(self, bucket: str, key: str, filename: str,
+                      Config=None,
+                      Callback: Optional[Callable[[int], None]] = None) \
+            -> None:
+        self._conn.request()
+        with self._conn.lock:
+            size = self._conn.bucket(bucket).files[key]
+        with open(filename, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                chunk = min(remaining, _CHUNK_SIZE)
+                self._conn.transfer(chunk)
+                f.write(bytes(chunk))
+                remaining -= chunk
+                if Callback is not None:
+                    Callback(chunk)
+
+
+class FakeError():
+
+    def __init__(self, message: str) -> None:
+        self.message = message
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class FakeInstance():
+    # A completed instance, as listed by Task.completed_instances
+
+    def __init__(self, instance_id: int, state: str,
+                 wall_time_sec: float) -> None:
+        self.instance_id = instance_id
+        self.state = state
+        self.wall_time_sec = wall_time_sec
+        self.exec_time_sec = wall_time_sec
+        self.peak_memory_mb = 100.
+
+
+class FakeTask():
+    # A task of a FakeConnection. Once submitted, it computes for the
+    # configured duration then succeeds or fails, and its instances
+    # write the configured result files in its results bucket
+
+    def __init__(self, conn: 'FakeConnection', name: str, profile: str,
+                 instance_count: int = 1) -> None:
+        self._conn = conn
+        self.uuid = str(uuid4())
+        self.name = name
+        self.profile = profile
+        self.instance_count = instance_count
+        self.constants: Dict[str, str] = {}
+        self.tags: List[str] = []
+        self.resources: List[FakeBucket] = []
+        self.results: Optional[FakeBucket] = None
+        self.creation_date: Optional[datetime] = None
+        self.errors: List[FakeError] = []
+        self.completed_instances: List[FakeInstance] = []
+        self._state = 'UnSubmitted'
+        self._submit_time: Optional[float] = None
+        self._duration = 0.
+        self._fails = False
+        self._stdout_sent = 0
+
+    @property
+    def state(self) -> str:
+        self._advance()
+        return self._state
+
+    def submit(self) -> None:
+        self._conn.request()
+        config = self._conn.config
+        duration = config.task_duration
+        if callable(duration):
+            duration = duration(self)
+        with self._conn.lock:
+            self._duration = duration
+            self._fails = \
+                self._conn.random.random() < config.task_failure_rate
+            self._submit_time = monotonic()
+            self.creation_date = datetime.utcnow()
+            self._state = 'FullyExecuting'
+            self._conn.tasks_by_uuid[self.uuid] = self
+
+    def update(self, flush: bool = False) -> None:
+        self._conn.request()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        # Return wether the task is over, after at most timeout seconds
+        self._conn.request()
+        end = None if timeout is None else monotonic() + timeout
+        while self.state not in ('Success', 'Failure', 'Cancelled'):
+            if end is not None and monotonic() >= end:
+                return False
+            sleep(0.01 if end is None else
+                  max(0., min(0.01, end - monotonic())))
+        return True
+
+    def abort(self) -> None:
+        self._conn.request()
+        with self._conn.lock:
+            if self._state not in ('FullyExecuting', 'Submitted'):
+                raise QarnotGenericException('task is not running')
+            self._state = 'Cancelled'
+
+    def delete(self, purge_resources: bool = False,
+               purge_results: bool = False) -> None:
+        self._conn.request()
+        with self._conn.lock:
+            self._conn.tasks_by_uuid.pop(self.uuid, None)
+            if purge_results and self.results is not None:
+                self._conn.buckets.pop(self.results.uuid, None)
+            if purge_resources:
+                for bucket in self.resources:
+                    self._conn.buckets.pop(bucket.uuid, None)
+
+    def stdout(self) -> str:
+        self._conn.request()
+        return self._output(0)
+
+    def fresh_stdout(self) -> str:
+        self._conn.request()
+        with self._conn.lock:
+            text = self._output(self._stdout_sent)
+            self._stdout_sent += text.count('\n')
+        return text
+
+    def stderr(self) -> str:
+        self._conn.request()
+        return ''
+
+    def fresh_stderr(self) -> str:
+        self._conn.request()
+        return ''
+
+    def _output(self, first_line: int) -> str:
+        if self._submit_time is None:
+            return ''
+        elapsed = min(monotonic() - self._submit_time, self._duration)
+        interval = self._conn.config.output_interval
+        lines = int(elapsed / interval) if interval > 0 else 0
+        return ''.join(f'{self.name}: step {i}\n'
+                       for i in range(first_line, lines))
+
+    def _advance(self) -> None:
+        # Finish the task once its duration has elapsed
+        with self._conn.lock:
+            if (self._state != 'FullyExecuting' or
+                    monotonic() - self._submit_time < self._duration):
+                return
+            state = 'Failure' if self._fails else 'Success'
+            self._state = state
+            if self._fails:
+                self.errors.append(FakeError('simulated failure'))
+            self.completed_instances = [
+                FakeInstance(i, state, self._duration)
+                for i in range(self.instance_count)]
+            if state == 'Success' and self.results is not None:
+                files = self._conn.config.result_files
+                for i in range(self.instance_count):
+                    prefix = '' if self.instance_count == 1 else \
+                        self._conn.config.instance_prefix.format(i)
+                    for name, size in files.items():
+                        self.results.files[prefix + name] = size
+
+
+class FakePage():
+
+    def __init__(self, page_data: List[FakeTask],
+                 next_token: Optional[str]) -> None:
+        self.page_data = page_data
+        self.next_token = next_token
+        self.is_truncated = next_token is not None
+
+
+class FakeConnection():
+    # An in-process stand-in for qarnot.Connection, for tests and
+    # benchmarks without Qarnot's API. Requests take config.latency
+    # seconds and may fail, transfers are limited to config.bandwidth.
+    # requests counts the requests made by all threads, e.g to check how
+    # the number of requests grows with the number of tasks. It can be
+    # used from several threads. Give QarnotController
+    # connection_factory=FakeConnection.factory(config) to use it
+
+    def __init__(self, config: Optional[FakeConfig] = None) -> None:
+        self.config = config or FakeConfig()
+        self.random = random.Random(self.config.seed)
+        self.lock = threading.RLock()
+        self.buckets: Dict[str, FakeBucket] = {}
+        self.tasks_by_uuid: Dict[str, FakeTask] = {}
+        self.requests = 0
+        self.s3client = FakeS3Client(self)
+
+    @staticmethod
+    def factory(config: Optional[FakeConfig] = None) \
+            -> Callable[[str], 'FakeConnection']:
+        # Return a connection factory ignoring the token
+        return lambda token: FakeConnection(config)
+
+    def request(self) -> None:
+        # Count a request, wait for its latency and fail it at the
+        # configured rate
+        with self.lock:
+            self.requests += 1
+            fails = self.random.random() < self.config.request_failure_rate
+        if self.config.latency > 0:
+            sleep(self.config.latency)
+        if fails:
+            raise QarnotGenericException('simulated request failure')
+
+    def transfer(self, size: int) -> None:
+        # Wait for size bytes to be transferred
+        if self.config.bandwidth:
+            sleep(size / self.config.bandwidth)
+
+    def bucket(self, name: str) -> FakeBucket:
+        # Return the bucket named name, or a new one. The lock is held
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = FakeBucket(self, name)
+            return self.buckets[name]
+
+    def create_bucket(self, name: str) -> FakeBucket:
+        self.request()
+        return self.bucket(name)
+
+    def create_task(self, name: str, profile: str,
+                    instance_count: int = 1) -> FakeTask:
+        self.request()
+        return FakeTask(self, name, profile, instance_count)
+
+    def retrieve_task(self, uuid: str) -> FakeTask:
+        # Raises MissingTaskException, as qarnot does, for unknown or
+        # deleted tasks
+        self.request()
+        with self.lock:
+            if uuid not in self.tasks_by_uuid:
+                raise MissingTaskException(f'Task {uuid} not found')
+            return self.tasks_by_uuid[uuid]
+
+    def tasks(self, tags: Optional[List[str]] = None) -> List[FakeTask]:
+        self.request()
+        return self._tagged(tags)
+
+    def tasks_page(self, token: Optional[str] = None, maximum: int = 50,
+                   tags: Optional[List[str]] = None) -> FakePage:
+        self.request()
+        tasks = self._tagged(tags)
+        start = int(token) if token else 0
+        end = start + maximum
+        return FakePage(tasks[start:end],
+                        str(end) if end < len(tasks) else None)
+
+    def _tagged(self, tags: Optional[List[str]]) -> List[FakeTask]:
+        with self.lock:
+            tasks = list(self.tasks_by_uuid.values())
+        if tags:
+            tasks = [t for t in tasks if all(tag in t.tags for tag in tags)]
+        return tasks
+
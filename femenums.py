@@ -15,11 +15,45 @@ class FemState(Enum):
     SETTING_UP = 0
     WRITING = 1
     COMPUTING = 2
-    FINISHED = 3
-    ERROR = 4
-    LOADED = 5
+    DOWNLOADING = 3
+    FINISHED = 4
+    ERROR = 5
+    LOADED = 6
 
     def __lt__(self, other):
         if self.__class__ is other.__class__:
             return self.value < other.value
         return NotImplemented
+
+
+@unique
+class SubmissionPhase(Enum):
+    QUEUED = 0
+    WRITING = 1
+    CREATING_TASK = 2
+    UPLOADING = 3
+    SUBMITTING = 4
+    SUBMITTED = 5
+    FAILED = 6
+    CANCELLED = 7
+
+
+@unique
+class BatchJobState(Enum):
+    PENDING = 0
+    RUNNING = 1
+    LOADED = 2
+    FAILED = 3
+    TIMED_OUT = 4
+
+
+@unique
+class TaskPhase(Enum):
+    WRITING = 0
+    CREATING_BUCKETS = 1
+    UPLOADING = 2
+    SUBMITTING = 3
+    QUEUED = 4
+    COMPUTING = 5
+    DOWNLOADING = 6
+    LOADING = 7
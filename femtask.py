@@ -1,39 +1,109 @@
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from dateutil import tz
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 from re import sub
+import os
+import tempfile
+import threading
+from time import time
+from uuid import uuid4
 
 import qarnot
 from qarnot.exceptions import \
     MaxTaskException, NotEnoughCreditsException, UnauthorizedException
 from qarnot.task import Task
 from qarnot.bucket import Bucket
-from femenums import SolverType, FemState
+from backend import MeshStats, SolverBackend, ccx_set_solver, mesh_stats, \
+    select_backend, threads_command
+from estimator import DEFAULT_PROFILES, HardwareProfile, RunEstimate, \
+    RunEstimator, choose_profile
+from elmerparallel import elmer_command, merge_partitions
+from femenums import SolverType, FemState, SubmissionPhase, TaskPhase
+from progress import TaskProgress
+from taskindex import IndexEntry
+from tracing import TaskTrace
+from transfer import INPUT_ARCHIVE, ResourceCache, delete_task, \
+    list_directory, pack_directory, upload_files
 
 import FreeCAD as App
 from femsolver import run, report
 from femtools.ccxtools import CcxTools
 import femsolver.calculix.tasks as ccxt
 
-
-def make_unique_name(name_list: List[str], name: str) -> str:
-    # Appends a number to name to make it unique,
-    # e.g different from any name in name_list
-    if name not in name_list:
-        return name
-    i = 1
-    while f'{name}{i}' in name_list:
-        i = i + 1
-    return f'{name}{i}'
-
-
-def rectify_bucket_name(name_list: List[str], name: str) -> str:
+# Writing input files goes through FreeCAD document objects and femsolver
+# module level variables, none of which are thread safe. Tasks are
+# written from the GUI thread, one at a time, and only the rest of the
+# submission (bucket creation, upload, submit) runs on worker threads.
+# Code writing tasks or modifying documents outside of the GUI thread's
+# events (e.g a batch loading results) must hold it
+write_lock = threading.Lock()
+
+# States of a Qarnot task that has not completed yet
+QARNOT_RUNNING_STATES = ['Submitted', 'PartiallyDispatched',
+                         'FullyDispatched', 'PartiallyExecuting',
+                         'FullyExecuting', 'DownloadingResults',
+                         'UploadingResults']
+# States of a Qarnot task whose instances have started executing
+QARNOT_EXECUTING_STATES = ['PartiallyExecuting', 'FullyExecuting',
+                           'DownloadingResults', 'UploadingResults']
+
+# Command extracting the inputs archive before the solver starts
+UNPACK_COMMAND = f'tar -xzf {INPUT_ARCHIVE} && rm {INPUT_ARCHIVE} && '
+
+# Result files loaded by load_result, by solver type. Other result files
+# (logs, scratch and restart files, inputs) are not downloaded
+RESULT_PATTERNS: Dict[SolverType, List[str]] = {
+    SolverType.CCX_TOOLS: ['*.frd', '*.dat'],
+    SolverType.CCX: ['*.frd', '*.dat'],
+    SolverType.ELMER: ['*.vtu', '*.pvtu', '*.result'],
+    SolverType.Z88: ['z88o*.txt'],
+}
+
+
+@contextmanager
+def recomputes_frozen(docs: Iterable[App.Document]):
+    # Context manager freezing the recomputes of documents, e.g while
+    # several results are loaded. Documents are recomputed once on exit
+    docs = [doc for doc in docs if not doc.RecomputesFrozen]
+    for doc in docs:
+        doc.RecomputesFrozen = True
+    try:
+        yield
+    finally:
+        for doc in docs:
+            doc.RecomputesFrozen = False
+            doc.recompute()
+
+
+def make_unique_name(name: str) -> str:
+    # Appends a random uuid to name to make it unique without having
+    # to list existing names
+    return f'{name}_{uuid4().hex}'
+
+
+def rectify_bucket_name(name: str) -> str:
     # Modify a name so it matches the bucket regex and is unique
     # Does so by replacing not allowed character by _
     name = sub("[^a-zA-Z0-9]", "_", name)
-    if len(name) > 250:
-        name = name[0:250]
-    return make_unique_name(name_list, name)
+    if len(name) > 217:
+        # leave room for the uuid suffix
+        name = name[0:217]
+    return make_unique_name(name)
+
+
+def solver_type_of(solver) -> SolverType:
+    # Return the type of a FreeCAD solver object
+    if solver.Proxy.Type == "Fem::SolverCcxTools":
+        return SolverType.CCX_TOOLS
+    elif solver.Proxy.Type == "Fem::SolverElmer":
+        return SolverType.ELMER
+    elif solver.Proxy.Type == "Fem::SolverCalculix":
+        return SolverType.CCX
+    elif solver.Proxy.Type == "Fem::SolverZ88":
+        return SolverType.Z88
+    # TODO : add other solvers
+    return SolverType.UNKNOWN
 
 
 class QarnotFemTask():
@@ -47,6 +117,35 @@ class QarnotFemTask():
         self.task: Task = None
         self.input_bucket: Bucket = None
         self.output_bucket: Bucket = None
+        # Shared bucket big input files are uploaded to, if set
+        self.resource_cache: Optional[ResourceCache] = None
+        # Keys of the resource cache files the task references
+        self.cache_keys: List[str] = []
+        # Wether inputs are packed in a compressed archive for upload. The
+        # archive is extracted on the node before the solver starts
+        self.compress_inputs: bool = False
+        # Wether Elmer runs on all the node's cores, its mesh partitioned
+        # and one MPI process per part (see elmerparallel)
+        self.mpi: bool = False
+        # Solver and threads of CalculiX and Z88, chosen from the size of
+        # the model once its input is written unless set before
+        self.backend: Optional[SolverBackend] = None
+        # Size of the model, read from the input files once written
+        self.mesh_stats: Optional[MeshStats] = None
+        # Estimator of the run time and memory, and hardware profiles
+        # the task can run on, the first one being the default
+        self.estimator: Optional[RunEstimator] = None
+        self.profiles: List[HardwareProfile] = DEFAULT_PROFILES
+        self.profile: str = DEFAULT_PROFILES[0].name
+        self.estimate: Optional[RunEstimate] = None
+        # Wall time in seconds and peak memory in MB of the computation,
+        # once done
+        self.run_time: Optional[float] = None
+        self.peak_memory_mb: Optional[float] = None
+        # Times of the phases of the task, from writing to loading, and
+        # when it was first seen executing
+        self.trace = TaskTrace()
+        self.executing_since: Optional[float] = None
 
         self.solver = solver
         self.solver_type: SolverType = SolverType.UNKNOWN
@@ -55,19 +154,28 @@ class QarnotFemTask():
         self.ccx = None
         self.working_dir = working_dir
         self.file = None
+        self.report = None
+        # Wether input files are written, in which case run does not
+        # write them again
+        self.prepared: bool = False
         self.state: FemState = FemState.SETTING_UP
 
         self.result_object_names: List[str] = []
+        # Last progress parsed from the task's stdout while computing
+        self.progress: Optional[TaskProgress] = None
+        # Patterns of the result files to download, None to download all
+        self.result_patterns: Optional[List[str]] = None
 
         self.findSolverType()
         if self.solver_type == SolverType.UNKNOWN:
             raise AttributeError("solver type not supported")
+        self.result_patterns = list(RESULT_PATTERNS[self.solver_type])
         self.setMachineAndDirectory()
 
     def delete(self):
         # Delete Qarnot task and buckets
         if self.task is not None:
-            self.task.delete(purge_resources=True, purge_results=True)
+            delete_task(self.task)
             self.task = None
         if self.machine is not None:
             del self.machine
@@ -75,17 +183,7 @@ class QarnotFemTask():
 
     def findSolverType(self):
         # Find solver type
-        if self.solver.Proxy.Type == "Fem::SolverCcxTools":
-            self.solver_type = SolverType.CCX_TOOLS
-        elif self.solver.Proxy.Type == "Fem::SolverElmer":
-            self.solver_type = SolverType.ELMER
-        elif self.solver.Proxy.Type == "Fem::SolverCalculix":
-            self.solver_type = SolverType.CCX
-        elif self.solver.Proxy.Type == "Fem::SolverZ88":
-            self.solver_type = SolverType.Z88
-        # TODO : add other solvers
-        else:
-            self.solver_type == SolverType.UNKNOWN
+        self.solver_type = solver_type_of(self.solver)
 
     def setMachineAndDirectory(self):
         # Creates machine or tool (old ccxTools works differently from other
@@ -105,6 +203,12 @@ class QarnotFemTask():
         # Executes the prepare operation of a fem task,
         # e.g writing the input files for the simulation
         # Returns wether it was a success
+        with self.trace.span(TaskPhase.WRITING):
+            return self.write_inputs()
+
+    def write_inputs(self) -> bool:
+        # Write the input files and choose the backend from them
+        # Should be internal use
         self.state = FemState.WRITING
         if self.solver_type == SolverType.CCX_TOOLS:
             message = self.ccx.check_prerequisites()
@@ -121,102 +225,289 @@ class QarnotFemTask():
             self.machine.start()
             self.machine.join()
             if self.machine.failed is True:
-                report.displayLog(self.machine.report)
+                # The report is displayed later by display_report since
+                # prepare may be called from a worker thread
+                self.report = self.machine.report
                 return False
             if self.solver_type == SolverType.CCX:
                 self.file = ccxt._inputFileName
+        self.prepared = True
+        self.choose_backend()
         return True
 
-    def create_bucket(self, conn: qarnot.Connection) -> None:
+    def choose_backend(self) -> None:
+        # Read the size of the written model and, unless a backend was
+        # set, choose it from that size. A CalculiX solver chosen that way
+        # is only set in the input file if it does not set one (e.g from
+        # the solver object's MatrixSolverType)
+        self.mesh_stats = mesh_stats(self.solver_type, self.working_dir,
+                                     self.file)
+        if self.solver_type == SolverType.ELMER:
+            return
+        if self.backend is not None:
+            backend = self.backend
+        else:
+            backend = select_backend(self.solver_type, self.mesh_stats)
+            self.backend = backend
+        if (self.solver_type != SolverType.Z88 and
+                backend.solver is not None):
+            inp = os.path.join(self.working_dir, self.file + '.inp')
+            try:
+                ccx_set_solver(inp, backend.solver)
+            except OSError as e:
+                App.Console.PrintWarning(
+                    f'Unable to set the solver of {self.name}: {e}\n')
+
+    def create_bucket(self, conn: qarnot.Connection,
+                      on_upload: Optional[Callable[[int, int], None]]
+                      = None) -> None:
         # Create input and output bucket to manage file
-        # input and output toward Qarnot servers
+        # input and output toward Qarnot servers. on_upload is called
+        # with the number of bytes uploaded and the total to upload
         # Should be internal use
-        bucket_names = [buck.description for buck in conn.buckets()]
-
-        in_name = rectify_bucket_name(bucket_names,
-                                      f'input-resource-{self.name}')
-        self.input_bucket = conn.create_bucket(in_name)
-        self.input_bucket.add_directory(self.working_dir)
-        self.task.resources.append(self.input_bucket)
-
-        out_name = rectify_bucket_name(bucket_names, f'output-{self.name}')
-        self.output_bucket = conn.create_bucket(out_name)
-        self.task.results = self.output_bucket
+        with self.trace.span(TaskPhase.CREATING_BUCKETS):
+            in_name = rectify_bucket_name(f'input-resource-{self.name}')
+            self.input_bucket = conn.create_bucket(in_name)
+            self.task.resources.append(self.input_bucket)
+            out_name = rectify_bucket_name(f'output-{self.name}')
+            self.output_bucket = conn.create_bucket(out_name)
+            self.task.results = self.output_bucket
+        with self.trace.span(TaskPhase.UPLOADING):
+            self.upload_inputs(conn, on_upload)
+
+    def upload_inputs(self, conn: qarnot.Connection,
+                      on_upload: Optional[Callable[[int, int], None]]
+                      = None) -> None:
+        # Upload input files in parallel, packed in a compressed archive
+        # if compress_inputs is set. If there is a resource cache, big
+        # files go through it and are only uploaded if their content is
+        # not already there
+        # Should be internal use
+        if self.compress_inputs:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                archive = os.path.join(tmp_dir, INPUT_ARCHIVE)
+                pack_directory(self.working_dir, archive)
+                self.upload_files(conn, {INPUT_ARCHIVE: archive}, on_upload)
+        else:
+            self.upload_files(conn, list_directory(self.working_dir),
+                              on_upload)
+
+    def upload_files(self, conn: qarnot.Connection, files: Dict[str, str],
+                     on_upload: Optional[Callable[[int, int], None]]
+                     = None) -> None:
+        # Upload files given as a dict of remote paths to local paths,
+        # through the resource cache for big files if there is one
+        # Should be internal use
+        uploads = []
+        cached = []
+        for remote, local in files.items():
+            cache = self.resource_cache
+            if cache is not None and cache.accepts(local):
+                key = cache.key(local, remote)
+                self.cache_keys.append(key)
+                if not cache.contains(key):
+                    uploads.append((cache.bucket, key, local))
+                    cached.append(key)
+                self.task.resources.append(cache.view(key))
+            else:
+                uploads.append((self.input_bucket, remote, local))
+        upload_files(conn, uploads, on_upload)
+        for key in cached:
+            self.resource_cache.add(key)
 
     def create_task(self, conn: qarnot.Connection) -> None:
         # Create task and set docker repository and command
         # Should be internal use
-        self.task = conn.create_task(self.name, 'docker-batch', 1)
+        self.task = conn.create_task(self.name, self.profile, 1)
         self.task.tags.append('FreeCAD macro')
         self.task.constants['FREECAD_WORKING_DIR'] = self.working_dir
         self.task.constants['FREECAD_DOCUMENT'] = self.solver.Document.FileName
         self.task.constants['FREECAD_SOLVER'] = self.solver.Name
+        if self.solver_type == SolverType.CCX_TOOLS:
+            self.task.constants['CCX_TOOLS_INP_FILENAME'] = \
+                self.ccx.inp_file_name
+        repo, command = self.solver_command()
+        if self.compress_inputs:
+            command = UNPACK_COMMAND + command
+        self.task.constants['DOCKER_REPO'] = repo
+        self.task.constants['DOCKER_CMD'] = f'bash -c "{command}" '
+
+    def solver_command(self) -> Tuple[str, str]:
+        # Return the docker repository and the command running the solver
+        # in the directory of the input files
         if (self.solver_type == SolverType.CCX_TOOLS or
                 self.solver_type == SolverType.CCX):
-            if self.solver_type == SolverType.CCX_TOOLS:
-                self.task.constants['CCX_TOOLS_INP_FILENAME'] = \
-                    self.ccx.inp_file_name
-            self.task.constants['DOCKER_REPO'] = 'calculix/ccx'
-            self.task.constants['DOCKER_CMD'] = f'bash -c \
-                "export OMP_NUM_THREADS=$(nproc) && ccx -i {self.file}" '
+            threads = threads_command(self.backend.threads
+                                      if self.backend else None)
+            return 'calculix/ccx', f'{threads} && ccx -i {self.file}'
         elif self.solver_type == SolverType.ELMER:
-            self.task.constants['DOCKER_REPO'] = 'nwrichmond/elmerice'
-            self.task.constants['DOCKER_CMD'] = 'bash -c \
-                "/usr/local/Elmer-devel/bin/ElmerSolver" '
+            return 'nwrichmond/elmerice', elmer_command(self.mpi)
         elif self.solver_type == SolverType.Z88:
-            self.task.constants['DOCKER_REPO'] = 'adlf/z88os'
-            self.task.constants['DOCKER_CMD'] = 'bash -c \
-                "z88r -t -choly && z88r -c -choly" '
-
-    def run(self, conn: qarnot.Connection) -> None:
-        # Create the task and submits it
-        if not self.prepare():
-            # Writing failed.
-            return
+            backend = self.backend or select_backend(self.solver_type, None)
+            flag = f'-{backend.solver or "choly"}'
+            return 'adlf/z88os', f'{threads_command(backend.threads)} && ' + \
+                f'z88r -t {flag} && z88r -c {flag}'
+        raise AttributeError("solver type not supported")
+
+    def write(self) -> bool:
+        # Write the input files, unless already written, and estimate the
+        # run. Must be called from the GUI thread. Returns wether the
+        # inputs are written
+        with write_lock:
+            if not self.prepared and not self.prepare():
+                # Writing failed.
+                return False
+        self.estimate_run()
+        return True
+
+    def run(self, conn: qarnot.Connection,
+            on_phase: Optional[Callable[[SubmissionPhase], None]] = None,
+            on_upload: Optional[Callable[[int, int], None]] = None) -> bool:
+        # Create the task and submits it. Its inputs must be written, see
+        # write. It does not touch FreeCAD documents and can be called
+        # from a worker thread. on_phase is called each time the
+        # submission enters a new phase and on_upload with the number of
+        # bytes uploaded and to upload. Returns wether the task was
+        # submitted
+        if on_phase is None:
+            def on_phase(phase):
+                pass
+        if not self.prepared:
+            App.Console.PrintError(
+                f'Inputs of task {self.name} are not written\n')
+            return False
+        on_phase(SubmissionPhase.CREATING_TASK)
         self.create_task(conn)
+        on_phase(SubmissionPhase.UPLOADING)
         try:
-            self.create_bucket(conn)
+            self.create_bucket(conn, on_upload)
         except IOError as err:
             App.Console.PrintError("Unable to create bucket. " + err.strerror)
-            return
+            return False
         except Exception as err:
             App.Console.PrintError(err)
-            return
+            return False
+        on_phase(SubmissionPhase.SUBMITTING)
         try:
-            self.task.submit()
+            with self.trace.span(TaskPhase.SUBMITTING):
+                self.task.submit()
         except MaxTaskException:
             App.Console.PrintError("You have reached the maximum \
                 number of task you can simultaneously have on Qarnot. \
                 You may go to https://console.qarnot.com/app/tasks \
                 to clean up old, not-deleted tasks or consider upgrading \
                 your account\n")
+            return False
         except NotEnoughCreditsException:
             App.Console.PrintError("You don't have anymore credits to perform \
                 this task. Please recharge on \
                 https://account.qarnot.com/account\n")
+            return False
         except UnauthorizedException as err:
             App.Console.PrintError(err)
+            return False
         except Exception as err:
-            App.console.PrintError("Unable to start task. An error happened\n")
-            App.console.PrintError(err)
+            App.Console.PrintError("Unable to start task. An error happened\n")
+            App.Console.PrintError(err)
+            return False
         self.state = FemState.COMPUTING
+        return True
+
+    def estimate_run(self) -> None:
+        # Estimate the run time and peak memory of the written model and
+        # choose the profile with the least memory it fits in
+        if self.estimator is None:
+            return
+        self.estimate = self.estimator.estimate(self.solver_type,
+                                                self.mesh_stats)
+        profile, fits = choose_profile(self.estimate, self.profiles)
+        self.profile = profile.name
+        if not fits:
+            App.Console.PrintWarning(
+                f'Task {self.name} may need ' +
+                f'{self.estimate.peak_memory_mb:.0f} MB of memory, more ' +
+                f'than the {profile.memory_mb:.0f} MB of {profile.name}\n')
+
+    def display_report(self) -> None:
+        # Display the report of a failed writing, if any. Must be called
+        # from the GUI thread
+        if self.report is not None:
+            report.displayLog(self.report)
+            self.report = None
 
     def wait_callback(self) -> bool:
-        # Test if task is done then retrieve result or report errors.
-        # Return wether the task is done
+        # Test if task is done then report errors or set it in
+        # DOWNLOADING state. Return wether the task is done
         if self.state > FemState.COMPUTING:
             return True
         done = self.task.wait(0.001)
         if not done:
             return False
+        self.on_done()
+        return True
+
+    def update_callback(self, snapshot: Task) -> bool:
+        # Same as wait_callback but the task state is read from snapshot,
+        # the same task as returned by a task listing, so that no request
+        # is made for tasks that are still running
+        if self.state > FemState.COMPUTING:
+            return True
+        if snapshot.state in QARNOT_RUNNING_STATES:
+            if (self.executing_since is None and
+                    snapshot.state in QARNOT_EXECUTING_STATES):
+                self.executing_since = time()
+            return False
+        self.task = snapshot
+        self.on_done()
+        return True
+
+    def on_done(self) -> None:
+        # Report errors of a completed task or set it in DOWNLOADING state.
+        # Its results are downloaded by the controller's download queue
         if self.task.state == 'Failure':
             App.Console.PrintError(f'Error on task {self.name}\n : \
                 {self.task.errors[0]}. See log for more details')
             self.state = FemState.ERROR
         else:
-            self.task.download_results(output_dir=self.working_dir)
-            self.state = FemState.FINISHED
-        return True
+            self.measure_run()
+            self.state = FemState.DOWNLOADING
+        self.trace_run()
+
+    def measure_run(self) -> None:
+        # Read the wall time and peak memory of the task's instance, or
+        # take the time from the creation of the task to its completion
+        instances = self.task.completed_instances or []
+        if len(instances) and instances[0].wall_time_sec:
+            self.run_time = instances[0].wall_time_sec
+            self.peak_memory_mb = instances[0].peak_memory_mb
+        elif self.task.creation_date is not None:
+            self.run_time = (datetime.utcnow() -
+                             self.task.creation_date).total_seconds()
+
+    def trace_run(self) -> None:
+        # Time the queue wait and the computation of a completed task,
+        # from its submission (or creation, for a retrieved task) to now.
+        # The computation starts when the task was first seen executing,
+        # or its measured wall time before now, and ends when completion
+        # is noticed. The polling delay is thus in the computation, or in
+        # the queue wait if the task was not seen executing
+        done = time()
+        submitted = self.trace.get(TaskPhase.SUBMITTING)
+        if submitted is not None:
+            start = submitted.end
+        elif self.task.creation_date is not None:
+            start = self.task.creation_date.replace(
+                tzinfo=timezone.utc).timestamp()
+        else:
+            return
+        if self.executing_since is not None:
+            computing = max(start, self.executing_since)
+        elif self.run_time:
+            computing = max(start, done - self.run_time)
+        else:
+            computing = start
+        self.trace.add(TaskPhase.QUEUED, start, computing)
+        self.trace.add(TaskPhase.COMPUTING, computing, done)
 
     def load_result(self) -> List[str]:
         # Load fem results into FreeCAD. Newly created objects are renamed
@@ -224,11 +515,17 @@ class QarnotFemTask():
         if (self.state == FemState.COMPUTING or
                 self.state == FemState.SETTING_UP):
             raise RuntimeError("attempted to load an unfinished task")
-        objects_before = self.solver.Document.findObjects()
+        doc = self.solver.Document
+        # Names are compared as a set so the diff is linear in the
+        # number of objects
+        names_before = {obj.Name for obj in doc.Objects}
 
         if self.solver_type == SolverType.CCX_TOOLS:
             self.ccx.load_results()
         elif self.solver_type == SolverType.ELMER:
+            # Results of MPI runs are split by partition, FreeCAD only
+            # loads serial results
+            merge_partitions(self.working_dir)
             # Elmer auto overrites results if ElmerResult already exists
             try:
                 self.solver.ElmerResult = None
@@ -239,9 +536,8 @@ class QarnotFemTask():
         else:
             self.machine.results.run()
 
-        objects_after = self.solver.Document.findObjects()
-        for obj in objects_after:
-            if obj not in objects_before:
+        for obj in doc.Objects:
+            if obj.Name not in names_before:
                 obj.Label = f'{self.name}_{obj.Label}'
                 self.result_object_names.append(obj.Name)
         self.state = FemState.LOADED
@@ -264,56 +560,75 @@ class QarnotFemTask():
 
 class QarnotOldFemTask():
     # A class to represent a task that was previously sent on
-    # qarnot and that may be retrieved
-
-    def __init__(self, task: Task) -> None:
-        self.task: Task = task
+    # qarnot and that may be retrieved. It is built either from the
+    # qarnot task or from an entry of the local task index, in which case
+    # task is None until the qarnot task is fetched (see
+    # QarnotController.fetch_old_task)
+
+    def __init__(self, task: Optional[Task],
+                 entry: Optional[IndexEntry] = None) -> None:
+        self.task: Optional[Task] = task
+        if task is not None:
+            self._uuid: str = task.uuid
+            self._name: str = task.name
+            # Naive UTC date, as given by qarnot
+            self._creation_date: datetime = task.creation_date
+            self.constants: Dict[str, str] = dict(task.constants)
+        else:
+            self._uuid = entry.uuid
+            self._name = entry.name
+            self._creation_date = entry.creation_date
+            self.constants = dict(entry.constants)
         self.complete: bool = False
         self.missing_constants: List[str] = []
         for const in ['FREECAD_DOCUMENT',
                       'FREECAD_SOLVER',
                       'FREECAD_WORKING_DIR']:
-            if const not in task.constants.keys():
+            if const not in self.constants.keys():
                 self.missing_constants.append(const)
         if ('FREECAD_SOLVER' not in self.missing_constants and
                 'CcxTools' in self.solver_name and
-                'CCX_TOOLS_INP_FILENAME' not in task.constants.keys()):
+                'CCX_TOOLS_INP_FILENAME' not in self.constants.keys()):
             self.missing_constants.append('CCX_TOOLS_INP_FILENAME')
         if len(self.missing_constants) == 0:
             self.complete = True
 
     def delete(self) -> None:
-        self.task.delete(purge_resources=True, purge_results=True)
+        delete_task(self.task)
         self.task = None
 
     @property
     def uuid(self) -> str:
-        return self.task.uuid
+        return self._uuid
 
     @property
     def name(self) -> str:
-        return self.task.name
+        return self._name
 
     @property
-    def creation_date(self) -> str:
-        return self.task.creation_date.replace(
+    def utc_creation_date(self) -> datetime:
+        return self._creation_date
+
+    @property
+    def creation_date(self) -> datetime:
+        return self._creation_date.replace(
             tzinfo=tz.tzutc()).astimezone(tz=None)
 
     @property
     def document_path(self) -> str:
-        return self.task.constants['FREECAD_DOCUMENT']
+        return self.constants['FREECAD_DOCUMENT']
 
     @property
     def solver_name(self) -> str:
-        return self.task.constants['FREECAD_SOLVER']
+        return self.constants['FREECAD_SOLVER']
 
     @property
     def working_dir(self) -> str:
-        return self.task.constants['FREECAD_WORKING_DIR']
+        return self.constants['FREECAD_WORKING_DIR']
 
     @property
     def ccx_inp_filename(self) -> str:
-        return self.task.constants['CCX_TOOLS_INP_FILENAME']
+        return self.constants['CCX_TOOLS_INP_FILENAME']
 
     @staticmethod
     def is_complete(task: Task):
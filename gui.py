@@ -1,31 +1,42 @@
-from femenums import FemState
+from femenums import FemState, SubmissionPhase
 import os
 import inspect
 import re
+from typing import List, Optional
 
 from PySide import QtGui, QtCore
 
 import FreeCAD as App
 
 from controller import QarnotController
+from estimator import RunEstimate, choose_profile
 from Gui.widgets import \
     HelpDisplayer, HyperLinkLabel, LogDisplayer
-from Gui.utils import insert_analysis_item, insert_document_item, \
-    insert_solver_item, waitingSlot, list_documents, list_analysis, \
-    list_solver, get_femstate_icon, format_task_output
+from Gui.utils import waitingSlot, format_task_output, \
+    format_submission_phase, format_size, format_estimate
 from Gui.eventhandler import DocumentObserver, GuiControllerEventDelegate
+from Gui.solvertree import SolverTree
+from Gui.taskmodel import TaskFilterProxyModel, TaskTableModel
 
 
 class QarnotCloudComputingGUI(QtGui.QWidget):
     def __init__(self) -> None:
         super().__init__()
-        self.controller = QarnotController(GuiControllerEventDelegate())
+        self.controller = QarnotController(
+            GuiControllerEventDelegate(), index_path=self.indexFile)
         self.children_windows = []
         self._working_dir = None
+        # Bytes uploaded and to upload by task currently uploading
+        self._uploads = {}
+        # Names of the documents whose old tasks should be checked for
+        # retrieval at the next solver select actualization
+        self._updated_documents = set()
         self.initGui()
         self.initEventHandling()
+        # Show the tasks of the index before connecting
+        self.actualizePanel()
         self.loadToken()
-        if len(self.controller.old_tasks) or len(self.controller.tasks):
+        if self.controller.is_computing():
             self.controller.event_delegate.start_callback()
         self.show()
 
@@ -52,6 +63,7 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
         # Solver selection
         self.treeWidgetSolver = QtGui.QTreeWidget()
         self.treeWidgetSolver.setHeaderHidden(True)
+        self.solverTree = SolverTree(self.treeWidgetSolver)
         self.actualizeSolverSelect()
         # Group box for simulation parameter (name, directory)
         self.groupBoxSimulation = QtGui.QGroupBox('Simulation settings')
@@ -70,8 +82,17 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
         self.buttonStart = QtGui.QPushButton(text=' Start ')
         self.buttonStart.setIcon(self.style().standardIcon(
             QtGui.QStyle.SP_ArrowForward))
+        # Estimated run of the selected solver, only shown if its
+        # analysis has a mesh
+        self.labelEstimate = QtGui.QLabel()
+        self.labelEstimate.hide()
         # State Label
         self.labelState = QtGui.QLabel('Click start to launch a simulation')
+        # Upload progress bar, only shown during uploads
+        self.progressBarUpload = QtGui.QProgressBar()
+        self.progressBarUpload.setRange(0, 1000)
+        self.progressBarUpload.setTextVisible(False)
+        self.progressBarUpload.hide()
         # Label for control panel
         self.labelConPanel = QtGui.QLabel('Current tasks')
         font = QtGui.QFont(self.labelConPanel.font())
@@ -88,14 +109,28 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
                                         .scaled(16, 16))
         self.hyperLinkConsole.setAlignment(
             QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter)
-        # Control panel
-        self.treeWidgetPanel = QtGui.QTreeWidget()
-        self.treeWidgetPanel.setHeaderLabels(['Name',
-                                              'Start date',
-                                              'status',
-                                              'document'])
-        self.treeWidgetPanel.setColumnWidth(1, 70)
-        self.treeWidgetPanel.setColumnWidth(2, 45)
+        # Control panel filter
+        self.lineEditFilter = QtGui.QLineEdit()
+        self.lineEditFilter.setPlaceholderText('Filter tasks')
+        self.lineEditFilter.setClearButtonEnabled(True)
+        # Control panel, a view on the task model sorted and filtered
+        # by the proxy model
+        self.taskModel = TaskTableModel(self)
+        self.taskProxyModel = TaskFilterProxyModel(self)
+        self.taskProxyModel.setSourceModel(self.taskModel)
+        self.treeViewPanel = QtGui.QTreeView()
+        self.treeViewPanel.setModel(self.taskProxyModel)
+        self.treeViewPanel.setRootIsDecorated(False)
+        self.treeViewPanel.setUniformRowHeights(True)
+        self.treeViewPanel.setSelectionBehavior(
+            QtGui.QAbstractItemView.SelectRows)
+        self.treeViewPanel.setSelectionMode(
+            QtGui.QAbstractItemView.ExtendedSelection)
+        self.treeViewPanel.setSortingEnabled(True)
+        self.treeViewPanel.sortByColumn(1, QtCore.Qt.AscendingOrder)
+        self.treeViewPanel.setColumnWidth(1, 70)
+        self.treeViewPanel.setColumnWidth(2, 45)
+        self.treeViewPanel.setColumnWidth(3, 110)
         self.actualizePanel()
         # Discard/stop button
         self.buttonStop = QtGui.QPushButton(text='Discard')
@@ -124,7 +159,9 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
         gridStart.addWidget(self.buttonDirectory, 1, 2)
         gridStart.addWidget(self.lineEditName, 2, 1)
         gridStart.addWidget(self.buttonStart, 2, 2)
-        gridStart.addWidget(self.labelState, 3, 1, 1, 2)
+        gridStart.addWidget(self.labelEstimate, 3, 1, 1, 2)
+        gridStart.addWidget(self.labelState, 4, 1, 1, 2)
+        gridStart.addWidget(self.progressBarUpload, 5, 1, 1, 2)
         self.groupBoxSimulation.setLayout(gridStart)
         self.layout.addWidget(self.groupBoxSimulation)
         hBoxConsole = QtGui.QHBoxLayout()
@@ -136,7 +173,8 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
         hBoxConsole.addStretch(1)
         self.layout.addSpacing(10)
         self.layout.addLayout(hBoxConsole)
-        self.layout.addWidget(self.treeWidgetPanel)
+        self.layout.addWidget(self.lineEditFilter)
+        self.layout.addWidget(self.treeViewPanel)
         hboxButton = QtGui.QHBoxLayout()
         hboxButton.addWidget(self.buttonStop)
         hboxButton.addWidget(self.buttonLog)
@@ -148,13 +186,9 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
     def initEventHandling(self) -> None:
         # Add a document observer to actualize the solver select panel
         # when some document change and new solver are created.
-        # the scheduler has some delay to allow the object to be effectively
-        # created before panel is actualized
+        # the solver tree applies events with some delay to allow the
+        # object to be effectively created before panel is actualized
         self.obs = DocumentObserver()
-        self.solverScheduler = QtCore.QTimer()
-        self.solverScheduler.timeout.connect(self.actualizeSolverSelect)
-        self.solverScheduler.setInterval(200)
-        self.solverScheduler.setSingleShot(True)
         App.addDocumentObserver(self.obs)
 
         self.buttonToken.clicked.connect(self.tokenDialog)
@@ -167,7 +201,24 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
         self.buttonLog.clicked.connect(self.displayLog)
         self.controller.event_delegate.state_changed.connect(
             self.actualizePanel)
-        self.obs.document_changed.connect(self.scheduleActualizeSolver)
+        self.controller.event_delegate.submission_progressed.connect(
+            self.displaySubmissionPhase)
+        self.controller.event_delegate.upload_progressed.connect(
+            self.displayUploadProgress)
+        self.lineEditFilter.textChanged.connect(
+            self.taskProxyModel.setFilterText)
+        self.obs.document_created.connect(self.solverTree.documentCreated)
+        self.obs.document_closed.connect(self.solverTree.documentClosed)
+        self.obs.object_added.connect(self.solverTree.objectAdded)
+        self.obs.object_removed.connect(self.solverTree.objectRemoved)
+        self.obs.object_relabelled.connect(self.solverTree.objectRelabelled)
+        self.obs.analysis_changed.connect(self.solverTree.analysisChanged)
+        self.obs.document_updated.connect(self.scheduleRetrieveDocument)
+        self.obs.document_closed.connect(self.controller.remove_document)
+        self.solverTree.updated.connect(self.retrieveUpdatedDocuments)
+        self.treeWidgetSolver.itemSelectionChanged.connect(
+            self.displayEstimate)
+        self.solverTree.updated.connect(self.displayEstimate)
 
     #
     # Widgets' slots and event endling
@@ -206,30 +257,31 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
                 'Connection with Qarnot has not been ' +
                 'established yet. Please fill in your token first\n')
             return
-        self.labelState.setText('Writing files...')
-        self.labelState.repaint()
         name = self.lineEditName.text()
         self.controller.start_fem(solver, name, self.working_dir)
         self.lineEditName.clear()
-        self.labelState.setText('Task submitted')
-        self.actualizePanel()
 
     @waitingSlot
     def loadResult(self) -> None:
-        uuid = self.getSelectedTask()
-        if uuid == '':
-            return
-        if (self.isOldTask(uuid) or self.controller.tasks[uuid].document_name
-                not in App.listDocuments()):
-            App.Console.PrintWarning('Cannot load this task. Check that the ' +
-                                     'document is opened')
+        # Load the results of the selected tasks, in one batch
+        uuids = []
+        for uuid in self.getSelectedTasks():
+            if (self.isOldTask(uuid) or
+                    self.controller.tasks[uuid].document_name
+                    not in App.listDocuments()):
+                App.Console.PrintWarning('Cannot load this task. Check ' +
+                                         'that the document is opened')
+                continue
+            if self.controller.tasks[uuid].state in (FemState.COMPUTING,
+                                                     FemState.DOWNLOADING):
+                App.Console.PrintWarning('Task is still in progress !')
+                continue
+            elif self.controller.tasks[uuid].state == FemState.LOADED:
+                continue
+            uuids.append(uuid)
+        if not len(uuids):
             return
-        if self.controller.tasks[uuid].state == FemState.COMPUTING:
-            App.Console.PrintWarning('Task is still in progress !')
-            return
-        elif self.controller.tasks[uuid].state == FemState.LOADED:
-            return
-        self.controller.load_result(uuid)
+        self.controller.load_results(uuids)
         self.actualizePanel()
 
     @waitingSlot
@@ -252,65 +304,109 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
             if not self.isOldTask(uuid):
                 q_task = self.controller.tasks[uuid].task
             else:
-                q_task = self.controller.old_tasks[uuid].task
-            ld = LogDisplayer(format_task_output(q_task.stdout()),
-                              format_task_output(q_task.stderr()))
+                old_task = self.controller.old_tasks[uuid]
+                if not self.controller.fetch_old_task(old_task):
+                    App.Console.PrintWarning(
+                        'The log is not available without a connection\n')
+                    return
+                q_task = old_task.task
+            # The log is fetched in the background and followed while the
+            # task runs. Its chunks are sent to the window through queued
+            # signals, they do not wait for the controller's events
+            ld = LogDisplayer()
+            subscription = self.controller.log_stream(
+                q_task, not self.isOldTask(uuid)).subscribe(
+                lambda name, text: ld.outputReceived.emit(
+                    name, format_task_output(text)),
+                ld.streamFinished.emit)
+            ld.closed.connect(subscription.cancel)
+            ld.closed.connect(lambda: self.children_windows.remove(ld))
             self.children_windows.append(ld)
 
     @QtCore.Slot()
     def actualizePanel(self) -> None:
-        # Actualize tasks states
-        self.treeWidgetPanel.clear()
-        for task in self.controller.list_task():
-            item = QtGui.QTreeWidgetItem()
-            # uuid is stored in hidden data Qt.UserRole
-            item.setData(0, QtCore.Qt.UserRole, task.uuid)
-            item.setText(0, task.name)
-            item.setText(1, task.creation_date.strftime('%H:%M:%S'))
-            item.setIcon(2, get_femstate_icon(task.state))
-            item.setText(3, task.document_name)
-            self.treeWidgetPanel.addTopLevelItem(item)
-        self.treeWidgetSolver.sortByColumn(1, QtCore.Qt.AscendingOrder)
-        for task in self.controller.old_tasks.values():
-            item = QtGui.QTreeWidgetItem()
-            item.setData(0, QtCore.Qt.UserRole, task.uuid)
-            item.setText(0, task.name)
-            item.setText(1, task.creation_date.strftime('%H:%M:%S'))
-            item.setText(3, task.document_path)
-            for i in range(0, 4):
-                item.setForeground(i, QtCore.Qt.gray)
-            self.treeWidgetPanel.addTopLevelItem(item)
+        # Actualize tasks states. Only rows that changed are updated
+        self.taskModel.sync(self.controller)
+
+    @QtCore.Slot(str, object, object)
+    def displaySubmissionPhase(self, name: str, phase: SubmissionPhase,
+                               estimate: Optional[RunEstimate]) -> None:
+        self.labelState.setText(
+            format_submission_phase(name, phase, estimate))
+        if phase.value > SubmissionPhase.UPLOADING.value:
+            self._uploads.pop(name, None)
+            self.displayUploadProgress()
+
+    @QtCore.Slot(str, object, object)
+    def displayUploadProgress(self, name: str = None, uploaded: int = 0,
+                              upload_size: int = 0) -> None:
+        # Display the overall progress of the uploads in progress
+        if name is not None:
+            self._uploads[name] = (uploaded, upload_size)
+        total = sum(size for _, size in self._uploads.values())
+        if total == 0:
+            self.progressBarUpload.hide()
+            return
+        done = sum(uploaded for uploaded, _ in self._uploads.values())
+        self.progressBarUpload.setValue(int(1000 * done / total))
+        self.progressBarUpload.setToolTip(
+            f'{format_size(done)} / {format_size(total)} uploaded')
+        self.progressBarUpload.show()
 
     @QtCore.Slot()
-    def scheduleActualizeSolver(self) -> None:
-        # Schedules a solver select actualization. The function is
-        # not called directly to allow enough delay for objects to
-        # be effectively created, since DocumentObserver functions
-        # are called before action is taken
-        if not self.solverScheduler.isActive():
-            self.solverScheduler.start()
+    def displayEstimate(self) -> None:
+        # Display the estimated run time, peak memory and hardware profile
+        # of the selected solver, before it is started
+        solver = self.getSelectedSolver()
+        estimate = None
+        if solver is not None:
+            estimate = self.controller.estimate_solver(solver)
+        if estimate is None:
+            self.labelEstimate.hide()
+            return
+        profile, fits = choose_profile(estimate, self.controller.profiles)
+        text = f'Estimated run: {format_estimate(estimate)} on ' + \
+            f'{profile.name}'
+        if not fits:
+            text += f' (more than its {format_size(profile.memory_mb * 1e6)})'
+        self.labelEstimate.setText(text)
+        self.labelEstimate.show()
+
+    @QtCore.Slot(object)
+    def scheduleRetrieveDocument(self, doc) -> None:
+        # Schedules the retrieval of the old tasks sent from doc, once
+        # the document is fully loaded. It is done with the solver
+        # tree's next update, since DocumentObserver functions are
+        # called before action is taken
+        self._updated_documents.add(doc.Name)
+        self.solverTree.timer.start()
+
+    @QtCore.Slot()
+    def retrieveUpdatedDocuments(self) -> None:
+        # Retrieve the old tasks of updated documents
+        documents = App.listDocuments()
+        for name in self._updated_documents:
+            if name in documents:
+                self.controller.retrieve_document(documents[name])
+        self._updated_documents.clear()
 
     @QtCore.Slot()
     def actualizeSolverSelect(self) -> None:
-        # Actualize Solver selector
-        self.controller.retrieve_all()
+        # Build the whole solver selector again. It is otherwise updated
+        # incrementally by the solver tree from document observer events
         current = self.getSelectedSolver()
-        self.treeWidgetSolver.clear()
-        docs = list_documents()
-        for doc in docs:
-            doc_item = insert_document_item(self.treeWidgetSolver, doc)
-            anas = list_analysis(doc)
-            for ana in anas:
-                ana_item = insert_analysis_item(doc_item, ana)
-                for solver in list_solver(ana):
-                    item = insert_solver_item(ana_item, solver)
-                    if current is not None and solver.Name == current.Name:
-                        item.setSelected(True)
+        self.solverTree.rebuild()
+        if current is not None:
+            for item in self.treeWidgetSolver.findItems(
+                    current.Label, QtCore.Qt.MatchRecursive):
+                if item.data(0, QtCore.Qt.UserRole) == current.Name:
+                    item.setSelected(True)
 
     def closeEvent(self, event):
         self.saveToken()
         App.removeDocumentObserver(self.obs)
         self.controller.event_delegate.stop_callback()
+        self.controller.shutdown()
         QtGui.QApplication.restoreOverrideCursor()
         print("closed\n")
         super().closeEvent(event)
@@ -353,10 +449,15 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
 
     def getSelectedTask(self) -> str:
         # Returns selected task uuid or '' if no task is selected
-        selected = self.treeWidgetPanel.selectedItems()
+        selected = self.getSelectedTasks()
         if len(selected) < 1:
             return ''
-        return selected[0].data(0, QtCore.Qt.UserRole)
+        return selected[0]
+
+    def getSelectedTasks(self) -> List[str]:
+        # Returns selected tasks uuids
+        return [index.data(QtCore.Qt.UserRole) for index
+                in self.treeViewPanel.selectionModel().selectedRows()]
 
     def loadToken(self) -> None:
         # Try to load previously entered token and try
@@ -390,7 +491,6 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
         # Then actualizes connection states desplayed by GUI
         self._token = val
         if self.controller.establish_connection(self._token):
-            self.controller.retrieve_all()
             self.actualizePanel()
             self.labelConnState.setText(
                 "<font color='green'>Connection established</font>")
@@ -402,6 +502,10 @@ class QarnotCloudComputingGUI(QtGui.QWidget):
     def tokenFile(self) -> str:
         return App.ConfigGet('UserAppData')+'qarnot.txt'
 
+    @property
+    def indexFile(self) -> str:
+        return App.ConfigGet('UserAppData')+'qarnot_tasks.sqlite'
+
     @property
     def working_dir(self) -> str:
         if self._working_dir == '':
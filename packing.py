@@ -0,0 +1,193 @@
+import os
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import qarnot
+
+from femenums import FemState, TaskPhase
+from femtask import QarnotFemTask, UNPACK_COMMAND
+from transfer import INPUT_ARCHIVE, list_directory, pack_directory
+
+
+def instance_dir(instance: str) -> str:
+    # Return the directory of an instance's inputs and results in a
+    # packed task's buckets
+    return f'instance-{instance}'
+
+
+class QarnotPackedFemTask(QarnotFemTask):
+    # Several fem tasks computed by a single qarnot task, one instance
+    # each, so that small analyses (e.g the variants of a sweep) share
+    # the bucket creation, scheduling and container start of one task.
+    # Members are fem tasks whose inputs are written, all of the same
+    # solver. Their inputs are uploaded in a directory per instance, in
+    # which each instance runs the solver. Results are downloaded in the
+    # packed task's working directory then moved to the members' working
+    # directories. Members follow the packed task's state until their
+    # results are split, after which each is FINISHED or ERROR depending
+    # on its instance. Packed tasks have no FREECAD_* constants, so they
+    # cannot be retrieved from another session
+
+    def __init__(self, members: List[QarnotFemTask], name: str,
+                 working_dir: str = None) -> None:
+        if not len(members):
+            raise ValueError('a packed task needs at least one member')
+        solvers = {(member.solver_type, member.file) for member in members}
+        if len(solvers) > 1:
+            raise ValueError('members of a packed task must run the same ' +
+                             'solver on the same input file')
+        self.members = members
+        self._state = FemState.SETTING_UP
+        super().__init__(members[0].solver, name, working_dir)
+        self.prepared = True
+        # Instances run in parallel, the estimate is the largest member's
+        self.mesh_stats = self._largest_member().mesh_stats
+        # Members are written one after the other, the packed task's
+        # writing spans all of them
+        writes = [member.trace.get(TaskPhase.WRITING) for member in members]
+        writes = [span for span in writes if span is not None]
+        if len(writes):
+            self.trace.add(TaskPhase.WRITING,
+                           min(span.start for span in writes),
+                           max(span.end for span in writes))
+
+    @property
+    def state(self) -> FemState:
+        return self._state
+
+    @state.setter
+    def state(self, state: FemState) -> None:
+        self._state = state
+        if state in (FemState.COMPUTING, FemState.DOWNLOADING,
+                     FemState.ERROR):
+            for member in self.members:
+                if member.state < FemState.FINISHED:
+                    member.state = state
+
+    def setMachineAndDirectory(self):
+        # Members have the machines, the packed task only needs a
+        # directory to download results to
+        if self.working_dir is None:
+            self.working_dir = tempfile.mkdtemp(prefix=f'{self.name}_')
+        else:
+            os.makedirs(self.working_dir, exist_ok=True)
+
+    def prepare(self) -> bool:
+        # Members are written before they are packed
+        return True
+
+    def delete(self):
+        super().delete()
+        for member in self.members:
+            member.delete()
+
+    def create_task(self, conn: qarnot.Connection) -> None:
+        # Create a task with an instance per member, each running the
+        # solver in its own input directory
+        # Should be internal use
+        self.task = conn.create_task(self.name, self.profile,
+                                     len(self.members))
+        self.task.tags.append('FreeCAD macro')
+        repo, command = self._largest_member().solver_command()
+        if self.compress_inputs:
+            command = UNPACK_COMMAND + command
+        directory = instance_dir('${INSTANCE_ID}')
+        self.task.constants['DOCKER_REPO'] = repo
+        self.task.constants['DOCKER_CMD'] = \
+            f'bash -c "cd {directory} && {command}" '
+
+    def upload_inputs(self, conn: qarnot.Connection,
+                      on_upload: Optional[Callable[[int, int], None]]
+                      = None) -> None:
+        # Upload each member's input files in its instance directory
+        # Should be internal use
+        files: Dict[str, str] = {}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i, member in enumerate(self.members):
+                directory = instance_dir(str(i))
+                if self.compress_inputs:
+                    archive = os.path.join(tmp_dir, f'{i}.tar.gz')
+                    pack_directory(member.working_dir, archive)
+                    files[f'{directory}/{INPUT_ARCHIVE}'] = archive
+                    continue
+                for remote, local in \
+                        list_directory(member.working_dir).items():
+                    files[f'{directory}/{remote}'] = local
+            self.upload_files(conn, files, on_upload)
+
+    def on_done(self) -> None:
+        # A failed instance does not prevent others' results from being
+        # downloaded. The task is in ERROR only if no instance succeeded
+        if (self.task.state == 'Failure' and
+                len(self._succeeded_instances()) == 0):
+            super().on_done()
+        else:
+            self.measure_run()
+            self.state = FemState.DOWNLOADING
+            self.trace_run()
+
+    def measure_run(self) -> None:
+        # Members are measured on their instance. The packed task takes
+        # the longest run and the highest peak
+        for instance in self.task.completed_instances or []:
+            if (instance.state != 'Success' or
+                    not 0 <= instance.instance_id < len(self.members)):
+                continue
+            member = self.members[instance.instance_id]
+            member.run_time = instance.wall_time_sec
+            member.peak_memory_mb = instance.peak_memory_mb
+        run_times = [m.run_time for m in self.members if m.run_time]
+        peaks = [m.peak_memory_mb for m in self.members if m.peak_memory_mb]
+        self.run_time = max(run_times) if len(run_times) else None
+        self.peak_memory_mb = max(peaks) if len(peaks) else None
+
+    def split_results(self) -> int:
+        # Move each instance's downloaded results to its member's working
+        # directory. Members whose instance failed or left no result are
+        # put in ERROR, the others in FINISHED. Return the number of
+        # FINISHED members
+        succeeded = self._succeeded_instances()
+        finished = 0
+        for i, member in enumerate(self.members):
+            directory = os.path.join(self.working_dir, instance_dir(str(i)))
+            files = list_directory(directory) if os.path.isdir(directory) \
+                else {}
+            if i not in succeeded or not len(files):
+                member.state = FemState.ERROR
+                continue
+            for remote, local in files.items():
+                target = os.path.join(member.working_dir, *remote.split('/'))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(local, target)
+            member.state = FemState.FINISHED
+            finished += 1
+        return finished
+
+    def load_result(self) -> List[str]:
+        # Load the results of the FINISHED members
+        if (self.state == FemState.COMPUTING or
+                self.state == FemState.SETTING_UP):
+            raise RuntimeError("attempted to load an unfinished task")
+        for member in self.members:
+            if member.state == FemState.FINISHED:
+                member.load_result()
+                self.result_object_names += member.result_object_names
+        self.state = FemState.LOADED
+
+    def _largest_member(self) -> QarnotFemTask:
+        # The member with the biggest model, whose solver backend suits
+        # all instances
+        return max(self.members,
+                   key=lambda member: member.mesh_stats.dofs
+                   if member.mesh_stats is not None else 0)
+
+    def _succeeded_instances(self) -> List[int]:
+        # Ids of the instances that succeeded. Instances are all assumed
+        # to have succeeded if the task does not tell
+        instances = self.task.completed_instances or []
+        if not len(instances):
+            if self.task.state == 'Failure':
+                return []
+            return list(range(len(self.members)))
+        return [instance.instance_id for instance in instances
+                if instance.state == 'Success']
@@ -0,0 +1,197 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+import heapq
+import threading
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import qarnot
+from qarnot.task import Task
+
+
+class PollScheduler():
+    # Keeps the next time each task's state should be checked, in a heap
+    # sorted by that time. The interval between two checks is a fraction
+    # (backoff) of the time elapsed since the task's last state change,
+    # bounded by min_interval and max_interval. Check times therefore grow
+    # exponentially with the task age: short tasks are checked every
+    # min_interval while a task running for hours is checked every few
+    # minutes. The interval is reset when the task changes state.
+    # Times are in seconds, as returned by time.monotonic
+
+    def __init__(self, min_interval: float = 2.,
+                 max_interval: float = 300.,
+                 backoff: float = 0.1) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._heap: List[Tuple[float, str]] = []
+        # Current next check time, state and state change time of
+        # each task. Heap entries that do not match _next are outdated
+        self._next: Dict[str, float] = {}
+        self._states: Dict[str, Optional[str]] = {}
+        self._since: Dict[str, float] = {}
+
+    def __contains__(self, uuid: str) -> bool:
+        return uuid in self._next
+
+    def __len__(self) -> int:
+        return len(self._next)
+
+    def add(self, uuid: str, now: Optional[float] = None) -> None:
+        # Start scheduling a task, its first check is in min_interval
+        if now is None:
+            now = monotonic()
+        self._states[uuid] = None
+        self._since[uuid] = now
+        self._push(uuid, now + self.min_interval)
+
+    def remove(self, uuid: str) -> None:
+        # Stop scheduling a task
+        self._next.pop(uuid, None)
+        self._states.pop(uuid, None)
+        self._since.pop(uuid, None)
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        # Return the tasks whose check time has come
+        if now is None:
+            now = monotonic()
+        due = []
+        self._drop_outdated()
+        while len(self._heap) and self._heap[0][0] <= now:
+            time, uuid = heapq.heappop(self._heap)
+            if self._next.get(uuid) == time:
+                due.append((time, uuid))
+            self._drop_outdated()
+        # Due tasks stay scheduled until they are checked
+        for entry in due:
+            heapq.heappush(self._heap, entry)
+        return [uuid for _, uuid in due]
+
+    def checked(self, uuid: str, state: Optional[str],
+                now: Optional[float] = None) -> None:
+        # Tell the scheduler the task was checked and found in the given
+        # state, and schedule its next check
+        if uuid not in self._next:
+            return
+        if now is None:
+            now = monotonic()
+        if state != self._states[uuid]:
+            self._states[uuid] = state
+            self._since[uuid] = now
+        interval = (now - self._since[uuid]) * self.backoff
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self._push(uuid, now + interval)
+
+    def postpone(self, uuid: str, now: Optional[float] = None) -> None:
+        # Schedule the next check of a task that could not be checked,
+        # as if it was found in the same state
+        if uuid in self._next:
+            self.checked(uuid, self._states[uuid], now)
+
+    def time_to_next_check(self, now: Optional[float] = None) \
+            -> Optional[float]:
+        # Return the time in seconds before the next check, which may be
+        # negative if a check is late, or None if no task is scheduled
+        if now is None:
+            now = monotonic()
+        self._drop_outdated()
+        if not len(self._heap):
+            return None
+        return self._heap[0][0] - now
+
+    def _push(self, uuid: str, time: float) -> None:
+        self._next[uuid] = time
+        heapq.heappush(self._heap, (time, uuid))
+
+    def _drop_outdated(self) -> None:
+        while (len(self._heap) and
+               self._next.get(self._heap[0][1]) != self._heap[0][0]):
+            heapq.heappop(self._heap)
+
+
+class StateLister():
+    # Lists tasks tagged 'FreeCAD macro' on a worker thread to read the
+    # states of the given running tasks, so that the caller's thread
+    # makes no request. The listing is made page by page and stops once
+    # every given task was listed, pages being large enough for all of
+    # them, instead of fetching the whole history of the account. Tasks
+    # that are not found, e.g deleted elsewhere, are only looked for
+    # until the pages are older than the oldest given task, once qarnot
+    # is seen to list tasks newest first, see OldTaskDiscovery.
+    # on_listed is called from the worker thread with the given uuids,
+    # the listed tasks of them by uuid and the error that stopped the
+    # listing or None. It should only hand them over, e.g to
+    # QarnotController.post_event
+
+    def __init__(self, on_listed: Callable[[Set[str], Dict[str, Task],
+                                            Optional[Exception]], None],
+                 page_size: int = 50) -> None:
+        self.on_listed = on_listed
+        self.page_size = page_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='qarnot-poll')
+        self.future: Optional[Future] = None
+        self._cancelled = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def list(self, conn: qarnot.Connection, uuids: Set[str],
+             since: Optional[datetime] = None) -> bool:
+        # Start listing the tasks of uuids, created after since, a naive
+        # UTC date, if given. Return False if a listing is still running
+        if self.running or self._cancelled.is_set():
+            return False
+        self.future = self.executor.submit(self._run, conn, set(uuids),
+                                           since)
+        return True
+
+    def shutdown(self) -> None:
+        # Stop after the current page, on_listed is not called
+        self._cancelled.set()
+        self.executor.shutdown(wait=False)
+
+    def _run(self, conn: qarnot.Connection, uuids: Set[str],
+             since: Optional[datetime]) -> None:
+        listed: Dict[str, Task] = {}
+        error = None
+        try:
+            self._list_pages(conn, uuids, since, listed)
+        except Exception as err:
+            error = err
+        if not self._cancelled.is_set():
+            self.on_listed(uuids, listed, error)
+
+    def _list_pages(self, conn: qarnot.Connection, uuids: Set[str],
+                    since: Optional[datetime],
+                    listed: Dict[str, Task]) -> None:
+        token = None
+        # Creation date of the last task listed, and wether tasks were
+        # listed newest first so far, None until dates differ
+        previous: Optional[datetime] = None
+        newest_first: Optional[bool] = None
+        while len(listed) < len(uuids):
+            if self._cancelled.is_set():
+                return
+            page = conn.tasks_page(token, max(self.page_size, len(uuids)),
+                                   tags=['FreeCAD macro'])
+            for task in page.page_data:
+                if task.uuid in uuids:
+                    listed[task.uuid] = task
+            if not page.is_truncated or page.next_token is None:
+                return
+            dates = [task.creation_date for task in page.page_data
+                     if task.creation_date is not None]
+            for date in dates:
+                if previous is not None and date != previous:
+                    if newest_first is None:
+                        newest_first = date < previous
+                    elif newest_first != (date < previous):
+                        newest_first = False
+                previous = date
+            if (since is not None and newest_first and len(dates) and
+                    all(date < since for date in dates)):
+                return
+            token = page.next_token
@@ -0,0 +1,347 @@
+import math
+import os
+import re
+from time import monotonic
+from typing import List, Optional, Tuple
+
+from femenums import SolverType
+
+# Number of consecutive growing residuals, or increment cutbacks for
+# CalculiX, after which a run is considered diverging
+DIVERGENCE_COUNT = 3
+
+_FLOAT = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eEdD][-+]?\d+)?|' + \
+    r'[-+]?(?:[nN][aA][nN]|[iI][nN][fF])'
+
+
+def _float(text: str) -> float:
+    # Fortran writes exponents with a d
+    return float(text.lower().replace('d', 'e'))
+
+
+class TaskProgress():
+    # A snapshot of the progress of a computing task, as parsed from its
+    # stdout. fraction is between 0 and 1 and eta is the estimated number
+    # of seconds left, from the monotonic time given by time, each None
+    # if it cannot be told. phase describes what the solver is doing
+
+    def __init__(self, fraction: Optional[float] = None,
+                 eta: Optional[float] = None, phase: str = '',
+                 iteration: Optional[int] = None,
+                 residual: Optional[float] = None,
+                 diverging: bool = False,
+                 time: Optional[float] = None) -> None:
+        self.fraction = fraction
+        self.eta = eta
+        self.phase = phase
+        self.iteration = iteration
+        self.residual = residual
+        self.diverging = diverging
+        self.time = monotonic() if time is None else time
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TaskProgress):
+            return NotImplemented
+        return (self.fraction, self.eta, self.phase, self.iteration,
+                self.residual, self.diverging) == \
+            (other.fraction, other.eta, other.phase, other.iteration,
+             other.residual, other.diverging)
+
+    def eta_left(self, now: Optional[float] = None) -> Optional[float]:
+        # Seconds left at now, counting down from the estimate
+        if self.eta is None:
+            return None
+        now = monotonic() if now is None else now
+        return max(0., self.eta - (now - self.time))
+
+
+class ProgressParser():
+    # Parses a solver's stdout as it is fetched. feed is given the new
+    # text, which may end in the middle of a line, and returns wether the
+    # progress changed. Subclasses implement parse_line and update
+    # fraction, phase, iteration, residual and diverging. The ETA is
+    # extrapolated from how fast fraction grew since it was first known
+
+    def __init__(self) -> None:
+        self.fraction: Optional[float] = None
+        self.phase = ''
+        self.iteration: Optional[int] = None
+        self.residual: Optional[float] = None
+        self.diverging = False
+        self._partial = ''
+        self._start: Optional[Tuple[float, float]] = None
+        self._last: Optional[TaskProgress] = None
+        # Residuals of the current iterations, to detect divergence
+        self._residuals: List[float] = []
+
+    def feed(self, text: str) -> bool:
+        # Qarnot may send newlines escaped, as in format_task_output. A
+        # chunk ending between the two characters keeps the backslash
+        # in the partial line
+        text = (self._partial + text).replace('\\n', '\n')
+        lines = text.split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                self.parse_line(line)
+        progress = self.progress()
+        changed = progress != self._last
+        self._last = progress
+        return changed
+
+    def parse_line(self, line: str) -> None:
+        raise NotImplementedError()
+
+    def progress(self, now: Optional[float] = None) -> TaskProgress:
+        now = monotonic() if now is None else now
+        eta = None
+        if self.fraction is not None:
+            if self._start is None:
+                self._start = (now, self.fraction)
+            start_time, start_fraction = self._start
+            done = self.fraction - start_fraction
+            if done > 0 and now > start_time:
+                eta = (1 - self.fraction) * (now - start_time) / done
+        return TaskProgress(self.fraction, eta, self.phase, self.iteration,
+                            self.residual, self.diverging, now)
+
+    def add_residual(self, residual: float) -> None:
+        # Record an iteration's residual. A run diverges when residuals
+        # are not a number or grew DIVERGENCE_COUNT times in a row
+        self.residual = residual
+        if math.isnan(residual) or math.isinf(residual):
+            self.diverging = True
+            return
+        self._residuals.append(residual)
+        last = self._residuals[-DIVERGENCE_COUNT - 1:]
+        if (len(last) > DIVERGENCE_COUNT and
+                all(a < b for a, b in zip(last, last[1:]))):
+            self.diverging = True
+
+    def reset_eta(self) -> None:
+        # fraction restarts from 0, e.g at a new step, the ETA is
+        # extrapolated from how fast it grows from there
+        self._start = None
+
+    def reset_residuals(self) -> None:
+        # A new increment or time step started
+        self._residuals.clear()
+
+
+class CalculixProgress(ProgressParser):
+    # CalculiX prints each increment's step time and each iteration's
+    # largest residual force. Progress is the step time over the step
+    # period, and the ETA that of the current step. Increments cut back
+    # because of divergence are counted, a run is diverging once
+    # DIVERGENCE_COUNT of them follow each other
+
+    _STEP = re.compile(r'^STEP\s+(\d+)')
+    _INCREMENT = re.compile(r'^increment\s+(\d+)\s+attempt\s+(\d+)')
+    _STEP_TIME = re.compile(r'^actual step time\s*=\s*(' + _FLOAT + ')')
+    _ITERATION = re.compile(r'^iteration\s+(\d+)')
+    _RESIDUAL = re.compile(r'^largest residual force\s*=\s*(' + _FLOAT + ')',
+                           re.IGNORECASE)
+
+    def __init__(self, step_period: float = 1.) -> None:
+        super().__init__()
+        self.step_period = step_period
+        self.step = 0
+        self.increment = 0
+        self._cutbacks = 0
+
+    def parse_line(self, line: str) -> None:
+        match = self._STEP.match(line)
+        if match:
+            self.step = int(match.group(1))
+            self.fraction = 0.
+            self.reset_eta()
+            self.phase = f'step {self.step}'
+            return
+        match = self._INCREMENT.match(line)
+        if match:
+            self.increment = int(match.group(1))
+            self.iteration = None
+            self.phase = f'step {self.step}, increment {self.increment}'
+            self.reset_residuals()
+            return
+        match = self._STEP_TIME.match(line)
+        if match and self.step_period > 0:
+            self.fraction = min(1., _float(match.group(1)) /
+                                self.step_period)
+            return
+        match = self._ITERATION.match(line)
+        if match:
+            self.iteration = int(match.group(1))
+            return
+        match = self._RESIDUAL.match(line)
+        if match:
+            self.add_residual(_float(match.group(1)))
+            return
+        if line.startswith('divergence'):
+            self._cutbacks += 1
+            if self._cutbacks >= DIVERGENCE_COUNT:
+                self.diverging = True
+        elif line.startswith('convergence'):
+            self._cutbacks = 0
+            self.diverging = False
+        elif line.startswith('Job finished'):
+            self.fraction = 1.
+            self.phase = 'finished'
+
+
+class ElmerProgress(ProgressParser):
+    # ElmerSolver prints the time step and steady state iteration it is
+    # at, and each nonlinear iteration's relative change. Progress is
+    # counted in time steps, or in steady state iterations out of
+    # max_iterations for steady runs
+
+    _TIME = re.compile(r'^MAIN:\s*Time:\s*(\d+)\s*/\s*(\d+)')
+    _STEADY = re.compile(r'^MAIN:\s*Steady state iteration:\s*(\d+)',
+                         re.IGNORECASE)
+    _CHANGE = re.compile(r'^ComputeChange:.*\(ITER=\s*(\d+)\)\s*'
+                         r'\(NRM,RELC\):\s*\(\s*(' + _FLOAT + r')\s+(' +
+                         _FLOAT + r')\s*\)(?:\s*::\s*(.*))?')
+
+    def __init__(self, max_iterations: Optional[int] = None) -> None:
+        super().__init__()
+        self.max_iterations = max_iterations
+        self.time_step: Optional[Tuple[int, int]] = None
+        self.steady_iteration = 0
+
+    def parse_line(self, line: str) -> None:
+        match = self._TIME.match(line)
+        if match:
+            step, steps = int(match.group(1)), int(match.group(2))
+            self.time_step = (step, steps)
+            self.steady_iteration = 0
+            if steps > 0:
+                self.fraction = (step - 1) / steps
+            self.phase = f'time step {step}/{steps}'
+            self.reset_residuals()
+            return
+        match = self._STEADY.match(line)
+        if match:
+            self.steady_iteration = int(match.group(1))
+            if self.time_step is None and self.max_iterations:
+                self.fraction = min(1., (self.steady_iteration - 1) /
+                                    self.max_iterations)
+                self.phase = 'steady state iteration ' + \
+                    f'{self.steady_iteration}/{self.max_iterations}'
+            return
+        match = self._CHANGE.match(line)
+        if match:
+            self.iteration = int(match.group(1))
+            if self.iteration == 1:
+                self.reset_residuals()
+            self.add_residual(_float(match.group(3)))
+            if match.group(4):
+                self.phase = match.group(4).strip()
+            return
+        if line.startswith('ELMER SOLVER FINISHED'):
+            self.fraction = 1.
+            self.phase = 'finished'
+
+
+class Z88Progress(ProgressParser):
+    # Z88 only prints the phase it is in, and the iterations of its
+    # iterative solvers. Progress is counted in phases
+
+    PHASES = [('Z88I1', 'reading input'),
+              ('Z88I2', 'assembling'),
+              ('SICCG', 'solving'),
+              ('SORCG', 'solving'),
+              ('CHOLESKY', 'solving'),
+              ('Z88I3', 'computing stresses'),
+              ('Z88O', 'writing results')]
+    _ITERATION = re.compile(r'Iteration\s*:?\s*(\d+)(?:\D+(' + _FLOAT +
+                            r'))?', re.IGNORECASE)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._phases = []
+        for _, phase in self.PHASES:
+            if phase not in self._phases:
+                self._phases.append(phase)
+
+    def parse_line(self, line: str) -> None:
+        upper = line.upper()
+        for marker, phase in self.PHASES:
+            if marker in upper:
+                self.phase = phase
+                self.iteration = None
+                self.fraction = self._phases.index(phase) / len(self._phases)
+                return
+        match = self._ITERATION.search(line)
+        if match:
+            self.iteration = int(match.group(1))
+            if match.group(2):
+                self.add_residual(_float(match.group(2)))
+            return
+        if 'Z88R DONE' in upper or 'ENDE Z88R' in upper:
+            self.fraction = 1.
+            self.phase = 'finished'
+
+
+def ccx_step_period(inp_path: str) -> float:
+    # Return the time period of the first step of a CalculiX input file,
+    # 1 if it does not give one
+    procedures = ('*STATIC', '*DYNAMIC', '*HEAT TRANSFER',
+                  '*COUPLED TEMPERATURE-DISPLACEMENT',
+                  '*UNCOUPLED TEMPERATURE-DISPLACEMENT', '*VISCO')
+    try:
+        with open(inp_path, errors='replace') as f:
+            procedure = False
+            for line in f:
+                line = line.strip()
+                if procedure:
+                    if line.startswith('**'):
+                        continue
+                    fields = line.split(',')
+                    if line.startswith('*') or len(fields) < 2:
+                        return 1.
+                    return _float(fields[1]) or 1.
+                if line.upper().startswith(procedures):
+                    procedure = True
+    except (OSError, ValueError):
+        pass
+    return 1.
+
+
+def elmer_max_iterations(sif_path: str) -> Optional[int]:
+    # Return the steady state max iterations of an Elmer case file
+    pattern = re.compile(r'^\s*Steady State Max Iterations\s*=\s*(\d+)',
+                         re.IGNORECASE)
+    try:
+        with open(sif_path, errors='replace') as f:
+            for line in f:
+                match = pattern.match(line)
+                if match:
+                    return int(match.group(1))
+    except OSError:
+        pass
+    return None
+
+
+def create_progress_parser(solver_type: SolverType,
+                           working_dir: Optional[str] = None,
+                           file: Optional[str] = None) \
+        -> Optional[ProgressParser]:
+    # Return a parser for the stdout of a solver, configured from its
+    # input files in working_dir if they can be read. file is the name
+    # of CalculiX input file, without extension
+    if solver_type in (SolverType.CCX_TOOLS, SolverType.CCX):
+        step_period = 1.
+        if working_dir is not None and file is not None:
+            step_period = ccx_step_period(
+                os.path.join(working_dir, file + '.inp'))
+        return CalculixProgress(step_period)
+    if solver_type == SolverType.ELMER:
+        max_iterations = None
+        if working_dir is not None:
+            max_iterations = elmer_max_iterations(
+                os.path.join(working_dir, 'case.sif'))
+        return ElmerProgress(max_iterations)
+    if solver_type == SolverType.Z88:
+        return Z88Progress()
+    return None
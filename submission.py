@@ -0,0 +1,166 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, List, Optional
+
+import qarnot
+
+import FreeCAD as App
+
+from femtask import QarnotFemTask
+from femenums import SubmissionPhase
+
+
+class QarnotSubmission():
+    # A handle on a fem task waiting to be submitted. It is returned right
+    # away when a task is queued and follows it through the submission
+    # phases (writing, task creation, upload, submit). Once the phase is
+    # SUBMITTED, the fem task has an uuid and is computing
+
+    def __init__(self, fem_task: QarnotFemTask) -> None:
+        self.fem_task = fem_task
+        self.phase: SubmissionPhase = SubmissionPhase.QUEUED
+        self.future: Optional[Future] = None
+        # Bytes uploaded and to upload, set during the UPLOADING phase
+        self.uploaded: int = 0
+        self.upload_size: int = 0
+        # Connection the task is submitted with
+        self.conn: Optional[qarnot.Connection] = None
+
+    def cancel(self) -> bool:
+        # Cancel the submission if it has not started yet.
+        # Return wether it was cancelled
+        if self.phase == SubmissionPhase.QUEUED and self.future is None:
+            # Not written yet, SubmissionQueue.write_next skips it
+            self.phase = SubmissionPhase.CANCELLED
+            return True
+        return self.future is not None and self.future.cancel()
+
+    @property
+    def done(self) -> bool:
+        return self.phase in (SubmissionPhase.SUBMITTED,
+                              SubmissionPhase.FAILED,
+                              SubmissionPhase.CANCELLED)
+
+    @property
+    def name(self) -> str:
+        return self.fem_task.name
+
+    @property
+    def uuid(self) -> str:
+        return self.fem_task.uuid
+
+
+class SubmissionQueue():
+    # Writes fem tasks' inputs in order, one write_next call at a time,
+    # then runs the rest of their submissions (task creation, upload,
+    # submit) on a pool of worker threads so that it does not block the
+    # caller. Writing goes through FreeCAD documents, so write_next must
+    # be called from the GUI thread, e.g by QarnotController's events.
+    # notify is called with the submission each time its phase changes
+    # and notify_upload each time its upload progresses. They are called
+    # from the worker threads and should only hand over the event, e.g to
+    # QarnotController.post_event
+
+    def __init__(self, notify: Callable[[QarnotSubmission], None],
+                 notify_upload: Optional[
+                     Callable[[QarnotSubmission], None]] = None,
+                 max_workers: int = 4) -> None:
+        self.notify = notify
+        self.notify_upload = notify_upload
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='qarnot-submit')
+        self.submissions: List[QarnotSubmission] = []
+        # Submissions whose inputs are not written yet, in order
+        self._writes: Deque[QarnotSubmission] = deque()
+
+    def submit(self, fem_task: QarnotFemTask,
+               conn: qarnot.Connection) -> QarnotSubmission:
+        # Queue the fem task and return its submission handle. Its inputs
+        # are written by a later write_next call
+        submission = QarnotSubmission(fem_task)
+        submission.conn = conn
+        self.submissions.append(submission)
+        self._writes.append(submission)
+        return submission
+
+    def write_next(self) -> bool:
+        # Write the inputs of the next queued submission and hand the rest
+        # of it to the worker threads. Must be called from the GUI thread.
+        # Return wether a submission was written or failed to be
+        while len(self._writes):
+            submission = self._writes.popleft()
+            if submission.phase == SubmissionPhase.QUEUED:
+                break
+            # Cancelled before being written
+            self.notify(submission)
+        else:
+            return False
+        self._set_phase(submission, SubmissionPhase.WRITING)
+        try:
+            written = submission.fem_task.write()
+        except Exception as err:
+            App.Console.PrintError(f'{err}\n')
+            written = False
+        if not written:
+            self._set_phase(submission, SubmissionPhase.FAILED)
+            return True
+        submission.future = self.executor.submit(
+            self._run, submission, submission.conn)
+        submission.future.add_done_callback(
+            lambda future: self._on_done(submission, future))
+        return True
+
+    def writes_pending(self) -> bool:
+        # Return wether submissions wait for their inputs to be written
+        return any(submission.phase == SubmissionPhase.QUEUED
+                   for submission in self._writes)
+
+    def pending(self) -> List[QarnotSubmission]:
+        # Return submissions that are not done yet and forget the others
+        self.submissions = [s for s in self.submissions if not s.done]
+        return list(self.submissions)
+
+    def shutdown(self) -> None:
+        # Cancel queued submissions and let running ones finish
+        for submission in self.submissions:
+            if submission.cancel() and submission.future is None:
+                self.notify(submission)
+        self._writes.clear()
+        self.executor.shutdown(wait=False)
+
+    def _set_phase(self, submission: QarnotSubmission,
+                   phase: SubmissionPhase) -> None:
+        submission.phase = phase
+        self.notify(submission)
+
+    def _set_upload(self, submission: QarnotSubmission,
+                    uploaded: int, upload_size: int) -> None:
+        submission.uploaded = uploaded
+        submission.upload_size = upload_size
+        if self.notify_upload is not None:
+            self.notify_upload(submission)
+
+    def _run(self, submission: QarnotSubmission,
+             conn: qarnot.Connection) -> None:
+        t = submission.fem_task
+        try:
+            submitted = t.run(
+                conn, lambda phase: self._set_phase(submission, phase),
+                lambda uploaded, upload_size: self._set_upload(
+                    submission, uploaded, upload_size))
+        except Exception as err:
+            App.Console.PrintError(f'{err}\n')
+            submitted = False
+        if submitted:
+            self._set_phase(submission, SubmissionPhase.SUBMITTED)
+            return
+        # Clean up what may have been created on Qarnot's side
+        try:
+            t.delete()
+        except Exception as err:
+            App.Console.PrintError(f'{err}\n')
+        self._set_phase(submission, SubmissionPhase.FAILED)
+
+    def _on_done(self, submission: QarnotSubmission, future: Future) -> None:
+        if future.cancelled():
+            self._set_phase(submission, SubmissionPhase.CANCELLED)
@@ -0,0 +1,180 @@
+import os
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import FreeCAD as App
+
+from backend import SolverBackend
+from femenums import FemState
+from femtask import QarnotFemTask
+from packing import QarnotPackedFemTask
+from submission import QarnotSubmission
+
+
+def result_objects(task: QarnotFemTask) -> List[App.DocumentObject]:
+    # Return the result objects a loaded task created
+    doc = task.solver.Document
+    return [doc.getObject(name) for name in task.result_object_names
+            if doc.getObject(name) is not None]
+
+
+def max_displacement(task: QarnotFemTask) -> Optional[float]:
+    # Return the maximum displacement length found in a loaded task's
+    # result objects. Can be used with QarnotSweep.compare
+    lengths = [max(obj.DisplacementLengths) for obj in result_objects(task)
+               if len(getattr(obj, 'DisplacementLengths', []))]
+    if not len(lengths):
+        return None
+    return max(lengths)
+
+
+class DocumentOverrides():
+    # Context manager that sets properties of a document's objects and
+    # restores them on exit. Overrides are given as a dict whose keys are
+    # 'ObjectName.Property'. Gmsh mesh objects whose properties are
+    # overridden (e.g CharacteristicLengthMax) are meshed again and their
+    # previous mesh is restored on exit
+
+    def __init__(self, doc: App.Document, overrides: Dict[str, Any]) -> None:
+        self.doc = doc
+        self.overrides = overrides
+        self._previous: Dict[Tuple[str, str], Any] = {}
+        self._meshes: Dict[str, Any] = {}
+
+    def __enter__(self) -> 'DocumentOverrides':
+        try:
+            for key, value in self.overrides.items():
+                obj, prop = self._property(key)
+                if (obj.Name, prop) not in self._previous:
+                    self._previous[(obj.Name, prop)] = getattr(obj, prop)
+                if self._is_gmsh_mesh(obj) and obj.Name not in self._meshes:
+                    self._meshes[obj.Name] = obj.FemMesh.copy()
+                setattr(obj, prop, value)
+            self.doc.recompute()
+            for name in self._meshes:
+                self._remesh(self.doc.getObject(name))
+        except Exception:
+            # Leave the document as it was
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for (name, prop), value in self._previous.items():
+            setattr(self.doc.getObject(name), prop, value)
+        for name, mesh in self._meshes.items():
+            self.doc.getObject(name).FemMesh = mesh
+        self.doc.recompute()
+
+    def _property(self, key: str):
+        name, _, prop = key.partition('.')
+        obj = self.doc.getObject(name)
+        if obj is None or prop not in obj.PropertiesList:
+            raise AttributeError(f'{key} is not a property of ' +
+                                 f'document {self.doc.Name}')
+        return obj, prop
+
+    @staticmethod
+    def _is_gmsh_mesh(obj) -> bool:
+        return getattr(getattr(obj, 'Proxy', None), 'Type', None) == \
+            'Fem::MeshGmsh'
+
+    @staticmethod
+    def _remesh(obj) -> None:
+        from femmesh.gmshtools import GmshTools
+        error = GmshTools(obj).create_mesh()
+        if error:
+            raise RuntimeError(f'Meshing of {obj.Label} failed : {error}')
+
+
+class QarnotSweep():
+    # A group of fem tasks running variants of the same analysis. Each
+    # variant is a dict of property overrides (see DocumentOverrides)
+    # applied to the solver's document while the variant's input files
+    # are written. Variants are written one at a time by the controller
+    # (see QarnotController.start_sweep) and then uploaded and submitted
+    # like any other task, so unchanged meshes are uploaded once through
+    # the resource cache. If pack is set, written variants are instead
+    # computed by a single qarnot task once they are all written (see
+    # packing.QarnotPackedFemTask), which suits many short runs
+
+    def __init__(self, name: str, solver, variants: List[Dict[str, Any]],
+                 working_dir: str = None, pack: bool = False) -> None:
+        self.name = name
+        self.solver = solver
+        self.variants = variants
+        self.working_dir = working_dir
+        self.pack = pack
+        # Solver backend of the variants, None to choose it from the size
+        # of each variant's model
+        self.backend: Optional[SolverBackend] = None
+        # Submission of each variant, None until it is written or if
+        # writing failed. Packed variants share the packed task's
+        self.submissions: List[Optional[QarnotSubmission]] = \
+            [None for _ in variants]
+        # Fem task of each written variant, when packing
+        self.members: List[Optional[QarnotFemTask]] = \
+            [None for _ in variants]
+        # Task computing the variants, when packing
+        self.packed_task: Optional[QarnotPackedFemTask] = None
+        # Index of the next variant to write
+        self.next_variant: int = 0
+
+    def variant_name(self, i: int) -> str:
+        return f'{self.name}_{i}'
+
+    def make_variant_dir(self, i: int) -> str:
+        # Create the working directory of a variant. Each variant needs
+        # its own, which the solver's working directory settings do not
+        # guarantee (e.g a directory beside the document)
+        if self.working_dir is None:
+            return tempfile.mkdtemp(prefix=f'{self.variant_name(i)}_')
+        directory = os.path.join(self.working_dir, self.variant_name(i))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def make_pack_dir(self) -> Optional[str]:
+        # Return the directory packed results are downloaded to, None for
+        # a temporary directory
+        if self.working_dir is None:
+            return None
+        return os.path.join(self.working_dir, f'{self.name}_pack')
+
+    @property
+    def tasks(self) -> List[Optional[QarnotFemTask]]:
+        # Fem task of each variant, None if it was not written
+        if self.pack:
+            return list(self.members)
+        return [None if s is None else s.fem_task for s in self.submissions]
+
+    @property
+    def written(self) -> bool:
+        # Wether every variant was written (or failed to be)
+        return self.next_variant >= len(self.variants)
+
+    @property
+    def done(self) -> bool:
+        # Wether no variant is still being written, submitted or computed
+        if not self.written:
+            return False
+        return all(t is None or t.state > FemState.DOWNLOADING or
+                   (t.state < FemState.COMPUTING and (s is None or s.done))
+                   for s, t in zip(self.submissions, self.tasks))
+
+    def states(self) -> List[Optional[FemState]]:
+        return [None if t is None else t.state for t in self.tasks]
+
+    def list_task(self, states: Optional[List[FemState]] = None) \
+            -> List[QarnotFemTask]:
+        # Return the variants' tasks that are in the given states,
+        # or all of them if states is not specified
+        return [t for t in self.tasks if t is not None and
+                (states is None or t.state in states)]
+
+    def compare(self, extract: Callable[[QarnotFemTask], Any]) \
+            -> List[Tuple[Dict[str, Any], Any]]:
+        # Return (overrides, value) for each loaded variant, value being
+        # extract applied to the variant's task, e.g max_displacement
+        return [(variant, extract(t))
+                for variant, t in zip(self.variants, self.tasks)
+                if t is not None and t.state == FemState.LOADED]
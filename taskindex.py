@@ -0,0 +1,212 @@
+from datetime import datetime
+import json
+import sqlite3
+import threading
+from time import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Task constants kept in the index, those needed to retrieve a task
+INDEXED_CONSTANTS = ['FREECAD_DOCUMENT', 'FREECAD_SOLVER',
+                     'FREECAD_WORKING_DIR', 'CCX_TOOLS_INP_FILENAME']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    uuid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    creation_date TEXT NOT NULL,
+    constants TEXT NOT NULL,
+    state TEXT,
+    result_dir TEXT
+);
+CREATE TABLE IF NOT EXISTS states (
+    uuid TEXT NOT NULL REFERENCES tasks(uuid) ON DELETE CASCADE,
+    time REAL NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    uuid TEXT NOT NULL,
+    solver_type TEXT NOT NULL,
+    nodes INTEGER NOT NULL,
+    elements INTEGER NOT NULL,
+    dofs INTEGER NOT NULL,
+    run_time REAL NOT NULL,
+    peak_memory_mb REAL
+);
+CREATE TABLE IF NOT EXISTS resources (
+    uuid TEXT NOT NULL REFERENCES tasks(uuid) ON DELETE CASCADE,
+    key TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS resource_uses (
+    key TEXT PRIMARY KEY,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS states_uuid ON states(uuid);
+CREATE INDEX IF NOT EXISTS resources_uuid ON resources(uuid);
+CREATE INDEX IF NOT EXISTS tasks_creation_date ON tasks(creation_date);
+'''
+
+
+class IndexEntry():
+    # A task as recorded in the task index. creation_date is a naive
+    # UTC date, like qarnot's
+
+    def __init__(self, uuid: str, name: str, creation_date: datetime,
+                 constants: Dict[str, str], state: Optional[str] = None,
+                 result_dir: Optional[str] = None) -> None:
+        self.uuid = uuid
+        self.name = name
+        self.creation_date = creation_date
+        self.constants = constants
+        # Last known state, a FemState name or a qarnot task state
+        self.state = state
+        # Directory the results were downloaded to, if they were
+        self.result_dir = result_dir
+
+
+class TaskIndex():
+    # A SQLite database recording the tasks sent by the macro across
+    # sessions: their constants, state history and result directory,
+    # the resource cache files they reference, and the size, run time
+    # and memory of the models computed. Runs, and the last use of
+    # resource cache files, are kept once their task is removed, they
+    # feed the estimator and the cache eviction.
+    # The controller loads it at startup so previous tasks are known
+    # without listing them from qarnot, and without a connection.
+    # It can be used from several threads
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('PRAGMA foreign_keys = ON')
+            self._db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def record_task(self, uuid: str, name: str, creation_date: datetime,
+                    constants: Dict[str, str],
+                    state: Optional[str] = None) -> None:
+        # Add a task to the index, or update it if it is already there
+        constants = {key: value for key, value in constants.items()
+                     if key in INDEXED_CONSTANTS}
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO tasks (uuid, name, creation_date, constants) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT(uuid) DO UPDATE SET '
+                'name = excluded.name, constants = excluded.constants',
+                (uuid, name, creation_date.isoformat(),
+                 json.dumps(constants)))
+            if state is not None:
+                self._record_state(uuid, state)
+
+    def record_state(self, uuid: str, state: str) -> None:
+        # Record a task's state, if it changed since the last record
+        with self._lock, self._db:
+            self._record_state(uuid, state)
+
+    def record_results(self, uuid: str, result_dir: str) -> None:
+        with self._lock, self._db:
+            self._db.execute('UPDATE tasks SET result_dir = ? WHERE uuid = ?',
+                             (result_dir, uuid))
+
+    def record_resources(self, uuid: str, keys: Iterable[str]) -> None:
+        # Record the resource cache files an indexed task references,
+        # used now
+        keys = list(keys)
+        now = time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO resources (uuid, key) VALUES (?, ?)',
+                [(uuid, key) for key in keys])
+            self._db.executemany(
+                'INSERT INTO resource_uses (key, time) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET time = excluded.time',
+                [(key, now) for key in keys])
+
+    def resource_keys(self, used_since: Optional[float] = None) -> Set[str]:
+        # Return the resource cache files referenced by indexed tasks,
+        # and those used since used_since, a time as returned by
+        # time.time, if it is given
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT DISTINCT key FROM resources').fetchall()
+            if used_since is not None:
+                rows += self._db.execute(
+                    'SELECT key FROM resource_uses WHERE time >= ?',
+                    (used_since,)).fetchall()
+        return {key for key, in rows}
+
+    def record_run(self, uuid: str, solver_type: str, nodes: int,
+                   elements: int, dofs: int, run_time: float,
+                   peak_memory_mb: Optional[float]) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO runs (uuid, solver_type, nodes, elements, '
+                'dofs, run_time, peak_memory_mb) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (uuid, solver_type, nodes, elements, dofs, run_time,
+                 peak_memory_mb))
+
+    def runs(self) -> List[Tuple[str, int, int, int, float,
+                                 Optional[float]]]:
+        # Return the recorded runs' solver type, nodes, elements, degrees
+        # of freedom, run time and peak memory, oldest first
+        with self._lock:
+            return self._db.execute(
+                'SELECT solver_type, nodes, elements, dofs, run_time, '
+                'peak_memory_mb FROM runs ORDER BY rowid').fetchall()
+
+    def remove(self, uuid: str) -> None:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM tasks WHERE uuid = ?', (uuid,))
+
+    def __contains__(self, uuid: str) -> bool:
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM tasks WHERE uuid = ?',
+                                   (uuid,)).fetchone()
+        return row is not None
+
+    def entries(self, since: Optional[datetime] = None) -> List[IndexEntry]:
+        # Return the indexed tasks created after since, or all of them,
+        # oldest first
+        query = 'SELECT uuid, name, creation_date, constants, state, ' + \
+            'result_dir FROM tasks'
+        args: Tuple = ()
+        if since is not None:
+            query += ' WHERE creation_date >= ?'
+            args = (since.isoformat(),)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY creation_date',
+                                    args).fetchall()
+        return [IndexEntry(uuid, name, datetime.fromisoformat(date),
+                           json.loads(constants), state, result_dir)
+                for uuid, name, date, constants, state, result_dir in rows]
+
+    def newest_creation_date(self) -> Optional[datetime]:
+        # Return the creation date of the newest indexed task, if any
+        with self._lock:
+            row = self._db.execute(
+                'SELECT MAX(creation_date) FROM tasks').fetchone()
+        return datetime.fromisoformat(row[0]) if row[0] else None
+
+    def history(self, uuid: str) -> List[Tuple[datetime, str]]:
+        # Return the states a task went through with the local time they
+        # were recorded at
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT time, state FROM states WHERE uuid = ? '
+                'ORDER BY time, rowid', (uuid,)).fetchall()
+        return [(datetime.fromtimestamp(t), state) for t, state in rows]
+
+    def _record_state(self, uuid: str, state: str) -> None:
+        row = self._db.execute('SELECT state FROM tasks WHERE uuid = ?',
+                               (uuid,)).fetchone()
+        if row is None or row[0] == state:
+            return
+        self._db.execute('UPDATE tasks SET state = ? WHERE uuid = ?',
+                         (state, uuid))
+        self._db.execute('INSERT INTO states (uuid, time, state) '
+                         'VALUES (?, ?, ?)', (uuid, time(), state))
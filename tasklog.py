@@ -0,0 +1,374 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from time import monotonic
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import qarnot
+from qarnot.exceptions import MissingTaskException
+from qarnot.task import Task
+
+from femtask import QARNOT_RUNNING_STATES
+
+# Default number of characters kept of each output of a task
+LOG_MAX_CHARS = 1 << 20
+# Maximum number of tasks whose output an OutputPoller fetches per poll
+OUTPUT_POLL_MAX_TASKS = 10
+# Size of the chunks outputs are read in
+_CHUNK_SIZE = 1 << 16
+
+
+class LogBuffer():
+    # A ring buffer keeping the last max_chars characters written to it.
+    # Text is kept as the chunks it was appended in, and the oldest
+    # chunks are dropped, or cut, once the buffer is full
+
+    def __init__(self, max_chars: int = LOG_MAX_CHARS) -> None:
+        self.max_chars = max_chars
+        self._chunks: Deque[str] = deque()
+        self._size = 0
+        # Number of characters dropped since the buffer was created
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def append(self, text: str) -> str:
+        # Add text at the end of the buffer and return the part of it
+        # that is kept
+        if len(text) > self.max_chars:
+            self.dropped += len(text) - self.max_chars
+            text = text[-self.max_chars:]
+        with self._lock:
+            self._chunks.append(text)
+            self._size += len(text)
+            while self._size > self.max_chars:
+                excess = self._size - self.max_chars
+                first = self._chunks[0]
+                if len(first) <= excess:
+                    self._chunks.popleft()
+                    self._size -= len(first)
+                    self.dropped += len(first)
+                else:
+                    self._chunks[0] = first[excess:]
+                    self._size -= excess
+                    self.dropped += excess
+        return text
+
+    def text(self) -> str:
+        with self._lock:
+            return ''.join(self._chunks)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._chunks.clear()
+            self._size = 0
+
+    def tail(self, max_chars: int) -> str:
+        # Return the last max_chars characters of the buffer
+        with self._lock:
+            chunks = []
+            size = 0
+            for chunk in reversed(self._chunks):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= max_chars:
+                    break
+        return ''.join(reversed(chunks))[-max_chars:]
+
+    def __len__(self) -> int:
+        return self._size
+
+
+def read_output(task: Task, name: str, max_chars: int,
+                fresh: bool = True) -> str:
+    # Return the last max_chars characters of a task's 'stdout' or
+    # 'stderr': of what it wrote since it was last read if fresh is set,
+    # which moves qarnot's cursor as fresh_stdout does, or of its whole
+    # output otherwise, of which only the last bytes are asked for. The
+    # response is read in chunks, so a long output is not loaded whole
+    # in memory. Without the sdk internals this relies on, e.g for
+    # fakes, the Task's methods are used
+    response = _output_response(task, name, max_chars, fresh)
+    if response is None:
+        method = getattr(task, f'fresh_{name}' if fresh else name)
+        return method()[-max_chars:]
+    with response:
+        if response.status_code == 404:
+            raise MissingTaskException(response.text)
+        if response.status_code == 416:
+            # No byte to send, the output is empty
+            return ''
+        qarnot.raise_on_error(response)
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        buffer = LogBuffer(max_chars)
+        for chunk in response.iter_content(_CHUNK_SIZE,
+                                           decode_unicode=True):
+            buffer.append(chunk)
+    return buffer.text()
+
+
+def _output_response(task: Task, name: str, max_chars: int, fresh: bool):
+    # Make the request of Task.stdout, stderr, fresh_stdout or
+    # fresh_stderr with a streamed response, None if the sdk does not
+    # have the internals it needs
+    connection = getattr(task, '_connection', None)
+    get_url = getattr(qarnot, 'get_url', None)
+    if connection is None or get_url is None or task.uuid is None:
+        return None
+    try:
+        url = get_url(f'task {name}', uuid=task.uuid)
+    except KeyError:
+        return None
+    if fresh:
+        return connection._post(url, stream=True)
+    # A character takes up to 4 bytes in utf-8
+    return connection._get(url, stream=True,
+                           headers={'Range': f'bytes=-{4 * max_chars}'})
+
+
+class TaskOutput():
+    # The stdout and stderr of a task read so far, each kept in a
+    # LogBuffer of max_chars characters. Qarnot sends fresh output once:
+    # once an output was read with a fresh read, what was written before
+    # is only in its buffer. A task should therefore have a single
+    # TaskOutput, shared by its readers (log streams, output poller),
+    # which read it through read one at a time
+
+    def __init__(self, max_chars: int = LOG_MAX_CHARS) -> None:
+        self.stdout = LogBuffer(max_chars)
+        self.stderr = LogBuffer(max_chars)
+        # Outputs read with fresh reads, qarnot's cursor moved
+        self._fresh: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def buffer(self, name: str) -> LogBuffer:
+        return self.stdout if name == 'stdout' else self.stderr
+
+    def read(self, task: Task, name: str, follow: bool = True) -> str:
+        # Return the new text of a task's output, to append to its buffer.
+        # If follow is set, it is what was written since the last read,
+        # or the tail of the whole output on the first read. Otherwise,
+        # e.g for a task that is over, the tail of the whole output is
+        # read once and qarnot's cursor left for a following reader
+        with self._lock:
+            if not follow and name not in self._fresh:
+                if len(self.buffer(name)):
+                    return ''
+                return read_output(task, name, self.stdout.max_chars, False)
+            self._fresh.add(name)
+            return read_output(task, name, self.stdout.max_chars)
+
+    def follow(self) -> None:
+        # Drop the outputs read without following them, a fresh read
+        # sends them again
+        with self._lock:
+            for name in ('stdout', 'stderr'):
+                if name not in self._fresh:
+                    self.buffer(name).clear()
+
+
+class LogSubscription():
+    # Returned by TaskLogStream.subscribe, cancel stops the calls
+
+    def __init__(self, stream: 'TaskLogStream',
+                 on_output: Callable[[str, str], None],
+                 on_done: Callable[[Optional[Exception]], None],
+                 passive: bool = False) -> None:
+        self.stream = stream
+        self.on_output = on_output
+        self.on_done = on_done
+        self.passive = passive
+
+    def cancel(self) -> None:
+        self.stream.unsubscribe(self)
+
+
+class TaskLogStream():
+    # Fetches the stdout and stderr of a task on a worker thread, into
+    # output, the task's TaskOutput. Only the tail of the output written
+    # so far is fetched, see TaskOutput.read. If follow is set and the
+    # task is running, what is written next is then fetched every
+    # interval seconds until the task is over or the stream is
+    # cancelled. Qarnot sends fresh output once, so a task should have a
+    # single stream at a time, shared by its readers through subscribe.
+    # The output read so far, including by previous streams of the task,
+    # is sent first to new subscribers. The stream stops once it has no
+    # subscriber but passive ones, e.g progress parsing, which only reads
+    # the output while someone follows the log
+    # Subscribers' on_output is called with 'stdout' or 'stderr' and the
+    # new text, and on_done once the stream is over, with the error that
+    # stopped it or None. They are called from the worker thread and
+    # should only parse the output or hand it over, e.g to
+    # QarnotController.post_event
+
+    def __init__(self, task: Task, follow: bool = True,
+                 interval: float = 5,
+                 output: Optional[TaskOutput] = None) -> None:
+        self.task = task
+        self.follow = follow
+        self.interval = interval
+        self.output = output if output is not None else TaskOutput()
+        if follow:
+            self.output.follow()
+        self.stdout = self.output.stdout
+        self.stderr = self.output.stderr
+        self.subscriptions: List[LogSubscription] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='qarnot-log')
+        self.future: Optional[Future] = None
+        self._cancelled = threading.Event()
+        # Subscribers are called with it held, so they get the buffers
+        # then the following output without gap nor duplicate
+        self._lock = threading.RLock()
+
+    def start(self) -> None:
+        self.future = self.executor.submit(self._run)
+        self.executor.shutdown(wait=False)
+
+    def cancel(self) -> None:
+        # Stop following the task. Returns right away, the worker thread
+        # stops after its current request
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def running(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def subscribe(self, on_output: Callable[[str, str], None],
+                  on_done: Callable[[Optional[Exception]], None],
+                  passive: bool = False) -> LogSubscription:
+        # Send the buffered output to on_output, then the output fetched
+        # next. Passive subscribers only get the output fetched next
+        subscription = LogSubscription(self, on_output, on_done, passive)
+        with self._lock:
+            for name, buffer in (('stdout', self.stdout),
+                                 ('stderr', self.stderr)):
+                if len(buffer) and not passive:
+                    on_output(name, buffer.text())
+            if self.done:
+                on_done(self.error)
+            else:
+                self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: LogSubscription) -> None:
+        with self._lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            if all(s.passive for s in self.subscriptions):
+                self.cancel()
+
+    def _run(self) -> None:
+        error = None
+        try:
+            self._stream()
+        except Exception as err:
+            error = err
+        with self._lock:
+            self.done = True
+            self.error = error
+            subscriptions = self.subscriptions
+            self.subscriptions = []
+            for subscription in subscriptions:
+                subscription.on_done(error)
+
+    def _stream(self) -> None:
+        self._read()
+        if not self.follow:
+            return
+        running = self._is_running()
+        while running and not self._cancelled.wait(self.interval):
+            # Output written before the task ended is fetched after its
+            # state says so
+            running = self._is_running()
+            self._read()
+
+    def _read(self) -> None:
+        for name in ('stdout', 'stderr'):
+            self._add(name, self.output.read(self.task, name, self.follow))
+
+    def _is_running(self) -> bool:
+        self.task.update(True)
+        return self.task.state in QARNOT_RUNNING_STATES
+
+    def _add(self, name: str, text: str) -> None:
+        # The text is kept even if the stream is cancelled, qarnot will
+        # not send it again
+        if not len(text):
+            return
+        with self._lock:
+            text = self.output.buffer(name).append(text)
+            if self._cancelled.is_set():
+                return
+            for subscription in self.subscriptions:
+                subscription.on_output(name, text)
+
+
+class OutputPoller():
+    # Fetches the fresh stdout of many tasks on a single worker thread,
+    # instead of a stream per task, e.g to parse their progress. poll
+    # is given tasks with their TaskOutput and queues a fetch of at most
+    # max_tasks of them, those fetched the longest ago first, so the
+    # number of requests does not grow with the number of tasks: with
+    # more tasks, each task's output is fetched less often. Tasks still
+    # queued by a previous poll are not queued twice. The new text is
+    # appended to the task's output, see TaskOutput.read, and on_output
+    # called from the worker thread with the task's uuid and the text.
+    # Failed fetches are retried by a next poll
+
+    def __init__(self, on_output: Callable[[str, str], None],
+                 max_tasks: int = OUTPUT_POLL_MAX_TASKS) -> None:
+        self.on_output = on_output
+        self.max_tasks = max_tasks
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='qarnot-output')
+        self._lock = threading.Lock()
+        self._queued: Set[str] = set()
+        # Monotonic time of the last poll of each task
+        self._polled: Dict[str, float] = {}
+        self._cancelled = threading.Event()
+
+    def poll(self, tasks: List[Tuple[Task, TaskOutput]]) -> None:
+        if self._cancelled.is_set():
+            return
+        now = monotonic()
+        with self._lock:
+            tasks = sorted((entry for entry in tasks
+                            if entry[0].uuid not in self._queued),
+                           key=lambda entry:
+                           self._polled.get(entry[0].uuid, 0.))
+            tasks = tasks[:self.max_tasks]
+            for task, _ in tasks:
+                self._queued.add(task.uuid)
+                self._polled[task.uuid] = now
+        if len(tasks):
+            self.executor.submit(self._fetch, tasks)
+
+    def forget(self, uuid: str) -> None:
+        with self._lock:
+            self._polled.pop(uuid, None)
+
+    def shutdown(self) -> None:
+        # Drop queued fetches. Returns right away, the worker thread stops
+        # after its current request
+        self._cancelled.set()
+        self.executor.shutdown(wait=False)
+
+    def _fetch(self, tasks: List[Tuple[Task, TaskOutput]]) -> None:
+        for task, output in tasks:
+            if self._cancelled.is_set():
+                return
+            with self._lock:
+                self._queued.discard(task.uuid)
+            try:
+                text = output.read(task, 'stdout')
+            except Exception:
+                continue
+            if len(text):
+                self.on_output(task.uuid, output.stdout.append(text))
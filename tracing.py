@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+import json
+import threading
+from time import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from femenums import TaskPhase
+
+
+class Span():
+    # A timed phase of a task. Times are seconds since the epoch so that
+    # spans of different threads and sessions can be compared
+
+    def __init__(self, phase: TaskPhase, start: float, end: float) -> None:
+        self.phase = phase
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'phase': self.phase.name, 'start': self.start,
+                'end': self.end, 'duration': self.duration}
+
+    def __repr__(self) -> str:
+        return f'Span({self.phase.name}, {self.duration:.3f} s)'
+
+
+class TaskTrace():
+    # The phases of a fem task, from the writing of its inputs to the
+    # loading of its results. Phases are timed from submission worker
+    # threads, download worker threads and the GUI thread. A phase timed
+    # again (e.g results loaded twice) replaces the previous span
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._spans: Dict[TaskPhase, Span] = {}
+        self._starts: Dict[TaskPhase, float] = {}
+
+    def begin(self, phase: TaskPhase, at: Optional[float] = None) -> None:
+        # Start timing phase, now or at the given time
+        with self._lock:
+            self._starts[phase] = time() if at is None else at
+
+    def end(self, phase: TaskPhase, at: Optional[float] = None) -> None:
+        # Stop timing phase, now or at the given time. Nothing is recorded
+        # if it was not begun
+        with self._lock:
+            start = self._starts.pop(phase, None)
+            if start is not None:
+                self._spans[phase] = Span(phase, start,
+                                          time() if at is None else at)
+
+    @contextmanager
+    def span(self, phase: TaskPhase):
+        # Context manager timing phase, recorded even if it raises
+        self.begin(phase)
+        try:
+            yield
+        finally:
+            self.end(phase)
+
+    def add(self, phase: TaskPhase, start: float, end: float) -> None:
+        # Record a phase timed elsewhere, e.g on qarnot's side
+        with self._lock:
+            self._spans[phase] = Span(phase, start, max(start, end))
+
+    def get(self, phase: TaskPhase) -> Optional[Span]:
+        with self._lock:
+            return self._spans.get(phase)
+
+    @property
+    def spans(self) -> List[Span]:
+        # Recorded spans, in the order of their phases
+        with self._lock:
+            return [self._spans[phase] for phase in TaskPhase
+                    if phase in self._spans]
+
+    def durations(self) -> Dict[str, float]:
+        return {span.phase.name: span.duration for span in self.spans}
+
+    def __repr__(self) -> str:
+        return f'TaskTrace({self.spans})'
+
+
+class TraceRecord():
+    # The trace of a task with what identifies it in exports
+
+    def __init__(self, uuid: str, name: str, solver_type: str,
+                 trace: TaskTrace) -> None:
+        self.uuid = uuid
+        self.name = name
+        self.solver_type = solver_type
+        self.trace = trace
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'uuid': self.uuid, 'name': self.name,
+                'solver_type': self.solver_type,
+                'spans': [span.to_dict() for span in self.trace.spans]}
+
+
+def summarize(records: Iterable[TraceRecord]) -> Dict[str, Dict[str, float]]:
+    # Number of tasks, total, mean and maximum duration in seconds of each
+    # phase, to see where the time of many runs goes
+    durations: Dict[TaskPhase, List[float]] = {}
+    for record in records:
+        for span in record.trace.spans:
+            durations.setdefault(span.phase, []).append(span.duration)
+    summary = {}
+    for phase in TaskPhase:
+        if phase not in durations:
+            continue
+        values = durations[phase]
+        summary[phase.name] = {'count': len(values), 'total': sum(values),
+                               'mean': sum(values) / len(values),
+                               'max': max(values)}
+    return summary
+
+
+def traces_json(records: List[TraceRecord]) -> Dict[str, Any]:
+    # The traces and their summary as a JSON serializable dict
+    return {'tasks': [record.to_dict() for record in records],
+            'summary': summarize(records)}
+
+
+def chrome_trace(records: List[TraceRecord]) -> Dict[str, Any]:
+    # The traces in the Chrome trace event format, to open in
+    # chrome://tracing or Perfetto. Each task is a thread of a single
+    # process, its phases complete events. Times are microseconds
+    events: List[Dict[str, Any]] = [
+        {'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+         'args': {'name': 'FreeCAD Qarnot tasks'}}]
+    for tid, record in enumerate(records, 1):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                       'tid': tid, 'args': {'name': record.name}})
+        for span in record.trace.spans:
+            events.append({'name': span.phase.name, 'cat': 'fem',
+                           'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': span.start * 1e6,
+                           'dur': span.duration * 1e6,
+                           'args': {'uuid': record.uuid,
+                                    'solver_type': record.solver_type}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_traces(records: List[TraceRecord], path: str,
+                 chrome: bool = False) -> None:
+    # Write the traces to path as JSON, in the Chrome trace event format
+    # if chrome is set
+    data = chrome_trace(records) if chrome else traces_json(records)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
@@ -0,0 +1,356 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatch
+import gzip
+import hashlib
+import os
+import posixpath
+import tarfile
+import threading
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from boto3.s3.transfer import TransferConfig
+import qarnot
+from qarnot.advanced_bucket import \
+    BucketPrefixFiltering, PrefixResourcesTransformation
+from qarnot.bucket import Bucket
+from qarnot.exceptions import MissingBucketException
+from qarnot.task import Task
+
+# Name of the bucket shared by all tasks to store big input files
+RESOURCE_CACHE_BUCKET = 'freecad-macro-resource-cache'
+# Files smaller than this are uploaded in the task's own input bucket
+RESOURCE_CACHE_MIN_SIZE = 1 << 20
+# Files of the resource cache uploaded longer ago than this and that no
+# known task references are evicted
+RESOURCE_CACHE_MAX_AGE = timedelta(days=7)
+# Files bigger than this are uploaded in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 << 20
+# Name of the archive inputs are packed in, when compressed
+INPUT_ARCHIVE = 'qarnot-inputs.tar.gz'
+
+# Hashes of files already hashed in this session, by path, size and
+# modification time, so unchanged files are not read again
+_hashes: Dict[Tuple[str, int, int], str] = {}
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path: str) -> str:
+    # Return the sha256 hex digest of a file's content
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    with _hashes_lock:
+        _hashes[key] = digest
+    return digest
+
+
+def list_directory(directory: str) -> Dict[str, str]:
+    # Return the files in directory and its subdirectories, as a dict
+    # of unix-like paths relative to directory to local paths
+    files = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            local = os.path.join(dirpath, filename)
+            remote = os.path.relpath(local, directory).replace(os.sep, '/')
+            files[remote] = local
+    return files
+
+
+def pack_directory(directory: str, archive: str) -> None:
+    # Pack the files of directory in a gzip compressed tar archive. The
+    # archive only depends on the files' paths and content (entries are
+    # sorted, dates and owners are reset) so that packing the same inputs
+    # twice gives the same archive, which the resource cache can reuse
+    with open(archive, 'wb') as f, \
+            gzip.GzipFile('', 'wb', 6, f, mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode='w',
+                         format=tarfile.PAX_FORMAT) as tar:
+        for remote, local in sorted(list_directory(directory).items()):
+            info = tar.gettarinfo(local, arcname=remote)
+            info.mtime = 0
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            with open(local, 'rb') as content:
+                tar.addfile(info, content)
+
+
+class TransferProgress():
+    # Counts bytes transferred by several threads and reports the total
+    # to callback(done, total), at most every interval seconds and once
+    # the transfer is complete
+
+    def __init__(self, total: int,
+                 callback: Optional[Callable[[int, int], None]] = None,
+                 interval: float = 0.2) -> None:
+        self.total = total
+        self.done = 0
+        self.callback = callback
+        self.interval = interval
+        self._last_report = 0.
+        self._lock = threading.Lock()
+
+    def add(self, amount: int) -> None:
+        with self._lock:
+            self.done += amount
+            now = monotonic()
+            if (now - self._last_report < self.interval and
+                    self.done < self.total):
+                return
+            self._last_report = now
+            done = self.done
+        if self.callback is not None:
+            self.callback(done, self.total)
+
+
+def upload_files(conn: qarnot.Connection,
+                 uploads: List[Tuple[Bucket, str, str]],
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 max_workers: int = 4,
+                 chunk_size: int = UPLOAD_CHUNK_SIZE) -> None:
+    # Upload files given as (bucket, remote, local) tuples. Files are
+    # uploaded in parallel and big files are split in chunks uploaded in
+    # parallel too. Uploaded bytes are reported to progress(sent, total)
+    config = TransferConfig(multipart_threshold=chunk_size,
+                            multipart_chunksize=chunk_size,
+                            max_concurrency=max_workers)
+    counter = TransferProgress(
+        sum(os.path.getsize(local) for _, _, local in uploads), progress)
+
+    def upload(bucket: Bucket, remote: str, local: str) -> None:
+        with open(local, 'rb') as f:
+            conn.s3client.upload_fileobj(f, bucket.uuid, remote,
+                                         Config=config,
+                                         Callback=counter.add)
+
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='qarnot-upload') as pool:
+        futures = [pool.submit(upload, *u) for u in uploads]
+        for future in futures:
+            # Raise the first error, if any
+            future.result()
+
+
+def matches(remote: str, patterns: Optional[List[str]]) -> bool:
+    # Return wether the file name matches one of the patterns (shell-style
+    # wildcards), or True if patterns is None
+    if patterns is None:
+        return True
+    name = posixpath.basename(remote)
+    return any(fnmatch(name, pattern) for pattern in patterns)
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def download_results(conn: qarnot.Connection, bucket: Bucket,
+                     output_dir: str,
+                     patterns: Optional[List[str]] = None,
+                     cancelled: Optional[threading.Event] = None,
+                     max_workers: int = 4,
+                     chunk_size: int = UPLOAD_CHUNK_SIZE) -> List[str]:
+    # Download the result files whose name matches one of the patterns,
+    # or all of them if patterns is None, keeping their path relative to
+    # output_dir. Files are streamed to disk in parallel, big files in
+    # parallel chunks. Raise DownloadCancelled if cancelled is set before
+    # the end. Return the downloaded files' local paths
+    config = TransferConfig(multipart_threshold=chunk_size,
+                            multipart_chunksize=chunk_size,
+                            max_concurrency=max_workers)
+    keys = [obj.key for obj in bucket.list_files()
+            if not obj.key.endswith('/') and matches(obj.key, patterns)]
+
+    def check_cancelled(amount: int = 0) -> None:
+        if cancelled is not None and cancelled.is_set():
+            raise DownloadCancelled()
+
+    def download(key: str) -> str:
+        check_cancelled()
+        local = os.path.join(output_dir, *key.split('/'))
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        conn.s3client.download_file(bucket.uuid, key, local, Config=config,
+                                    Callback=check_cancelled)
+        return local
+
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='qarnot-download') as pool:
+        futures = [pool.submit(download, key) for key in keys]
+        return [future.result() for future in futures]
+
+
+class DownloadQueue():
+    # Downloads results of finished tasks on a bounded pool of worker
+    # threads. notify(uuid, error) is called from the worker thread once
+    # a download is over, with error None if it succeeded. It should only
+    # hand over the event, e.g to QarnotController.post_event
+
+    def __init__(self, conn: qarnot.Connection,
+                 notify: Callable[[str, Optional[Exception]], None],
+                 max_workers: int = 4) -> None:
+        self.conn = conn
+        self.notify = notify
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='qarnot-results')
+        # Cancel flag of pending downloads, by task uuid
+        self._cancelled: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def download(self, uuid: str, bucket: Bucket, output_dir: str,
+                 patterns: Optional[List[str]] = None) -> None:
+        # Queue the download of the results of task uuid
+        cancelled = threading.Event()
+        with self._lock:
+            self._cancelled[uuid] = cancelled
+        self.executor.submit(self._run, uuid, bucket, output_dir,
+                             patterns, cancelled)
+
+    def cancel(self, uuid: str) -> None:
+        # Cancel the download of the results of task uuid, if pending
+        with self._lock:
+            if uuid in self._cancelled:
+                self._cancelled[uuid].set()
+
+    def pending(self) -> List[str]:
+        # Return the uuids of tasks whose results are being downloaded
+        with self._lock:
+            return list(self._cancelled.keys())
+
+    def shutdown(self) -> None:
+        for uuid in self.pending():
+            self.cancel(uuid)
+        self.executor.shutdown(wait=False)
+
+    def _run(self, uuid: str, bucket: Bucket, output_dir: str,
+             patterns: Optional[List[str]],
+             cancelled: threading.Event) -> None:
+        error = None
+        try:
+            if cancelled.is_set():
+                raise DownloadCancelled()
+            download_results(self.conn, bucket, output_dir, patterns,
+                             cancelled)
+        except Exception as err:
+            error = err
+        with self._lock:
+            self._cancelled.pop(uuid, None)
+        self.notify(uuid, error)
+
+
+def delete_task(task: Task) -> None:
+    # Delete a task with its result bucket and resources buckets, except
+    # the resource cache bucket which other tasks may reference
+    resources = [bucket for bucket in task.resources
+                 if bucket.uuid != RESOURCE_CACHE_BUCKET]
+    task.delete(purge_resources=False, purge_results=True)
+    for bucket in resources:
+        try:
+            bucket.delete()
+        except MissingBucketException:
+            pass
+
+
+class ResourceCache():
+    # A bucket shared by all tasks in which big input files are stored
+    # under their content hash, as '<hash>/<path hash>/<path>'. A task
+    # references each file through a view of the bucket filtered on the
+    # file's directory, which only holds that file, with the directory
+    # stripped so that the file appears at its path in the task's working
+    # directory. Files such as meshes that did not change since a
+    # previous submission are thus not uploaded again. Nothing else
+    # deletes files from the bucket, evict removes the old ones no task
+    # references. The cache assumes a single client: evict only knows
+    # the uses of this machine, through its task index, and the upload
+    # dates, a file reused by another client since it was uploaded may
+    # be evicted and is then uploaded again by that client's next
+    # submission
+
+    def __init__(self, conn: qarnot.Connection,
+                 name: str = RESOURCE_CACHE_BUCKET,
+                 min_size: int = RESOURCE_CACHE_MIN_SIZE) -> None:
+        self.bucket: Bucket = conn.create_bucket(name)
+        self.min_size = min_size
+        # Keys known to be in the bucket, keys used in this session,
+        # which are never evicted, and keys being deleted by evict
+        self._keys: Set[str] = set()
+        self._used: Set[str] = set()
+        self._deleting: Set[str] = set()
+        self._lock = threading.Lock()
+        self._deleted = threading.Condition(self._lock)
+
+    def accepts(self, local: str) -> bool:
+        # Return wether the file is big enough to go through the cache
+        return os.path.getsize(local) >= self.min_size
+
+    def contains(self, key: str) -> bool:
+        # A file being deleted is waited for, then uploaded again
+        with self._lock:
+            self._used.add(key)
+            while key in self._deleting:
+                self._deleted.wait()
+            if key in self._keys:
+                return True
+        for obj in self.bucket.directory(key):
+            if obj.key == key:
+                with self._lock:
+                    self._keys.add(key)
+                return True
+        return False
+
+    def add(self, key: str) -> None:
+        # Tell the cache key was uploaded
+        with self._lock:
+            self._keys.add(key)
+            self._used.add(key)
+
+    def evict(self, referenced: Iterable[str],
+              max_age: timedelta = RESOURCE_CACHE_MAX_AGE) -> int:
+        # Delete the files uploaded more than max_age ago, except the
+        # referenced keys, e.g those used recently, and those used in
+        # this session. Return the number of files deleted
+        referenced = set(referenced)
+        oldest = datetime.now(timezone.utc) - max_age
+        victims = [obj.key for obj in self.bucket.list_files()
+                   if obj.key not in referenced and
+                   obj.last_modified < oldest]
+        evicted = 0
+        for key in victims:
+            # Files are deleted one at a time outside the lock, contains
+            # waits for the file it looks for if it is being deleted
+            with self._lock:
+                if key in self._used:
+                    continue
+                self._deleting.add(key)
+            try:
+                self.bucket.delete_file(key)
+            finally:
+                with self._lock:
+                    self._deleting.discard(key)
+                    self._keys.discard(key)
+                    self._deleted.notify_all()
+            evicted += 1
+        return evicted
+
+    @staticmethod
+    def key(local: str, remote: str) -> str:
+        # Return the key under which the file is stored in the cache
+        path_hash = hashlib.sha256(remote.encode()).hexdigest()[:16]
+        return posixpath.join(file_hash(local), path_hash, remote)
+
+    def view(self, key: str) -> Bucket:
+        # Return the bucket view to add to a task's resources so that
+        # the file stored under key, alone in its directory, appears in
+        # its working directory
+        directory = '/'.join(key.split('/')[:2]) + '/'
+        return self.bucket \
+            .with_filtering(BucketPrefixFiltering(directory)) \
+            .with_resource_transformation(
+                PrefixResourcesTransformation(directory))